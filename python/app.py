@@ -1,13 +1,24 @@
 from datetime import timedelta
 from dotenv import load_dotenv
-from flask import Flask, request, Response, send_from_directory
+from flask import Flask, request, Response
 from os import urandom
 from os.path import exists, join
 from requests import request as requests_send
 
+from database.hierarchy import hierarchy_init
 from database.main import database_init
+from database.retention import retention_init
+from database.search import search_init
+from database.usage import usage_init
+from security.hashing import hashing_init
 from security.login import login_blueprint
+from storage.download import download_blueprint
+from storage.gc import gc_init
+from storage.purge import purge_init
+from storage.search import search_blueprint
+from storage.upload import upload_blueprint
 from util.misc import DATE_FORMAT, DEVELOPMENT
+from util.static import StaticManifest
 from util.logger import LogBasicConfig, setup_logger, GetLogger, LOG_INFO
 
 
@@ -46,8 +57,21 @@ setup_logger('debug', join(app.root_path, 'logs', 'debug.log'))
 access_log = GetLogger('access')
 
 database_init(app)
+hierarchy_init(app)
+retention_init(app)
+usage_init(app)
+search_init(app)
+hashing_init(app)
+gc_init(app)
+purge_init(app)
 
 app.register_blueprint(login_blueprint)
+app.register_blueprint(download_blueprint)
+app.register_blueprint(upload_blueprint)
+app.register_blueprint(search_blueprint)
+
+# the Angular bundle is read into memory once, requests never touch the filesystem
+static_manifest = None if DEVELOPMENT else StaticManifest(join(app.root_path, 'web'))
 
 
 @app.errorhandler(404)
@@ -69,13 +93,7 @@ def error_handler_404(*_, **__):
         response = Response(res.content, res.status_code, headers)  # noqa
         return response
     else:
-        path = request.path
-        if path and path.startswith('/'):
-            path = path[1:]
-        if path != '' and exists(join(app.root_path, 'web', path)):
-            return send_from_directory(join(app.root_path, 'web'), path), 200
-        else:
-            return send_from_directory(join(app.root_path, 'web'), 'index.html'), 200
+        return static_manifest.response(request.path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+from argparse import ArgumentParser
+from os import makedirs
+from os.path import abspath, dirname, join
+from random import Random
+from shutil import rmtree, which
+from subprocess import run
+from tempfile import mkdtemp
+from time import perf_counter
+import sys
+import typing as t
+
+sys.path.insert(0, dirname(dirname(dirname(abspath(__file__)))))
+
+from python.util.blob import blob_path, hash_file, move_into_store  # noqa: E402
+
+
+# the old path needs sha3_256sum, openssl prints the same 'name= digest' line where it is missing
+HASH_COMMAND = ['sha3_256sum'] if which('sha3_256sum') else ['openssl', 'dgst', '-sha3-256']
+
+
+def subprocess_store(location: str, path: str) -> t.Tuple[str,int]:
+    """
+    The previous Entry.alternate_write: one process each for the hash, the size and the move
+    """
+    hash_ = run([*HASH_COMMAND, path], capture_output=True, text=True, check=True).stdout.strip().split('= ')[1]
+    size = int(run(['stat', '--printf=%s', path], capture_output=True, text=True, check=True).stdout)
+    dest_path = blob_path(location, hash_)
+    makedirs(dirname(dest_path), exist_ok=True)
+    run(['mv', path, dest_path], check=True)
+    return hash_, size
+
+
+def native_store(location: str, path: str) -> t.Tuple[str,int]:
+    """
+    The current Entry.alternate_write without the database
+    """
+    hash_, size = hash_file(path)
+    move_into_store(location, path, hash_)
+    return hash_, size
+
+
+def write_files(directory: str, count: int, size: int, seed: bytes) -> t.List[str]:
+    makedirs(directory)
+    paths = []
+    # the same seed writes the same files for both paths, so their results can be compared
+    block = Random(seed).randbytes(min(size, 1024 * 1024))
+    for i in range(count):
+        path = join(directory, f'{i}.bin')
+        with open(path, 'wb') as f:
+            # every file gets distinct content so no blob is deduplicated
+            f.write(seed + i.to_bytes(8, 'big'))
+            written = len(seed) + 8
+            while written < size:
+                written += f.write(block[:size - written])
+        paths.append(path)
+    return paths
+
+
+def measure(store: t.Callable[[str,str],t.Tuple[str,int]], root: str, name: str, count: int, size: int) -> t.Tuple[float,t.List[t.Tuple[str,int]]]:
+    location = join(root, name, 'drive')
+    paths = write_files(join(root, name, 'source'), count, size, f'{count}x{size}'.encode())
+    start = perf_counter()
+    result = [store(location, path) for path in paths]
+    return perf_counter() - start, result
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Compares the in-process hashing and storing of files with the previous subprocess path')
+    parser.add_argument('--small-count', type=int, default=10000)
+    parser.add_argument('--small-size', type=int, default=4096)
+    parser.add_argument('--large-count', type=int, default=3)
+    parser.add_argument('--large-size', type=int, default=256 * 1024 * 1024)
+    parser.add_argument('--directory', default=None, help='where the files are written, on the filesystem of the drives to measure')
+    args = parser.parse_args()
+    root = mkdtemp(dir=args.directory)
+    try:
+        print(f'old path hashes with: {" ".join(HASH_COMMAND)}')
+        for label, count, size in [('small', args.small_count, args.small_size), ('large', args.large_count, args.large_size)]:
+            seconds = {}
+            hashes = {}
+            for name, store in [('subprocess', subprocess_store), ('native', native_store)]:
+                seconds[name], hashes[name] = measure(store, root, f'{label}-{name}', count, size)
+                mib = count * size / 1024 / 1024
+                print(f'{label:5} {name:10} {count:6} x {size:>10} B: {seconds[name]:8.3f} s, {count / seconds[name]:9.1f} files/s, {mib / seconds[name]:8.1f} MiB/s')
+            assert hashes['subprocess'] == hashes['native'], 'both paths must produce the same hashes and sizes'
+            print(f'{label:5} speedup {seconds["subprocess"] / seconds["native"]:.1f}x')
+    finally:
+        rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+from argparse import ArgumentParser
+from flask import Flask, g
+from os.path import abspath, dirname, join
+from shutil import rmtree
+from sqlite3 import connect as sqlite_connect
+from tempfile import mkdtemp
+from time import perf_counter
+import sys
+import typing as t
+
+sys.path.insert(0, dirname(dirname(dirname(abspath(__file__)))))
+
+from python.database.hierarchy import closure_insert  # noqa: E402
+from python.database.main import DATABASE_PRAGMAS, query_db, transaction  # noqa: E402
+from python.database.migrations import run_migrations  # noqa: E402
+from python.database.search import search_index_entries  # noqa: E402
+from python.database.usage import apply_usage_delta, subtree_usage  # noqa: E402
+from python.util.misc import now_timestamp  # noqa: E402
+from python.util.rand import rand_id  # noqa: E402
+
+
+PYTHON_ROOT = dirname(dirname(abspath(__file__)))
+FILES_PER_FOLDER = 1000
+
+
+def insert_entry(id_: str, type_: str, name: str, parent_id: t.Union[str,None]) -> None:
+    """
+    The statements of Entry.save for a new entry
+    """
+    now = now_timestamp()
+    if not query_db('SELECT id, parent_id, type, partition_id, deleted, size, name FROM entries WHERE id=?', (id_,), True):
+        size = 4096 if type_ == 'file' else None
+        query_db(
+            'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (id_, type_, name, parent_id, 'user#bench', 'partition#bench', now, now, now, None, 0, size, None, 0, None, None, None)
+        )
+        closure_insert(id_, parent_id)
+        apply_usage_delta({}, subtree_usage(id_))
+        search_index_entries([id_])
+
+
+def insert_entries(count: int, mode: str) -> None:
+    """
+    Inserts entries with the given transaction boundaries, every entry claims its id with rand_id
+    :param count: the amount of entries, one folder per FILES_PER_FOLDER files
+    :param mode: `autocommit` commits every statement like query_db did before transaction() existed,
+                 `transaction` is Entry.save with its own transaction, `bulk` inserts everything in one transaction
+    """
+    parent_id = None
+
+    def insert(i: int) -> None:
+        nonlocal parent_id
+        id_ = rand_id('entry')
+        if i % (FILES_PER_FOLDER + 1) == 0:
+            insert_entry(id_, 'folder', f'folder {i}', None)
+            parent_id = id_
+        else:
+            insert_entry(id_, 'file', f'report {i}.pdf', parent_id)
+
+    if mode == 'bulk':
+        with transaction():
+            for i in range(count):
+                insert(i)
+    elif mode == 'transaction':
+        for i in range(count):
+            with transaction():
+                insert(i)
+    else:
+        for i in range(count):
+            insert(i)
+
+
+def create_database(path: str, pragmas: t.List[str]):
+    conn = sqlite_connect(path, timeout=5)
+    for pragma in pragmas:
+        conn.execute(pragma)
+    with open(join(PYTHON_ROOT, 'database/create.sql'), 'r') as f:
+        create = f.read()
+    run_migrations(conn, create)
+    conn.executescript(create)
+    conn.execute("INSERT INTO users VALUES ('user#bench', 'bench', 'bench@localhost', '', '', '', 0, 0, 0, 0, 'dark', 'en')")
+    conn.execute("INSERT INTO drives VALUES ('drive#bench', '/tmp', 'bench', '')")
+    conn.execute("INSERT INTO partitions VALUES ('partition#bench', 'drive#bench', 'bench', 'user#bench', 0, 0, 0, 0, NULL, 0)")
+    conn.commit()
+    return conn
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Measures inserting entries with a commit per statement, a transaction per entry and one transaction for all')
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--modes', default='autocommit,transaction,bulk')
+    parser.add_argument('--pragmas', choices=['app', 'default'], default='app', help='the pragmas of the connection pool or none, i.e. a rollback journal with synchronous=FULL')
+    parser.add_argument('--directory', default=None, help='where the database is created, on the filesystem to measure')
+    args = parser.parse_args()
+    app = Flask(__name__)
+    root = mkdtemp(dir=args.directory)
+    try:
+        for mode in args.modes.split(','):
+            conn = create_database(join(root, f'{mode}.sqlite'), DATABASE_PRAGMAS if args.pragmas == 'app' else [])
+            with app.app_context():
+                g._database = conn
+                start = perf_counter()
+                insert_entries(args.count, mode)
+                seconds = perf_counter() - start
+                rows = query_db('SELECT COUNT(*) FROM entries', (), True)[0]
+            conn.close()
+            assert rows == args.count
+            print(f'{args.pragmas:7} {mode:11} {args.count:7} entries: {seconds:8.2f} s, {args.count / seconds:9.1f} entries/s')
+    finally:
+        rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+from time import perf_counter
+import sys
+import typing as t
+
+from ua_parser import user_agent_parser
+
+sys.path.insert(0, dirname(dirname(dirname(abspath(__file__)))))
+
+from python.security.user_agent import fast_families, full_families, user_agent_fingerprint  # noqa: E402
+
+
+CORPUS_PATH = join(dirname(dirname(abspath(__file__))), 'tests', 'user_agents.txt')
+
+
+def cold(parse: t.Callable[[str],t.Any]) -> t.Callable[[str],t.Any]:
+    def call(user_agent: str) -> t.Any:
+        # ua-parser keeps the last 200 results, which would hold the whole corpus
+        user_agent_parser._PARSE_CACHE.clear()
+        return parse(user_agent)
+    return call
+
+
+def measure(parse: t.Callable[[str],t.Any], corpus: t.List[str], rounds: int) -> float:
+    start = perf_counter()
+    for _ in range(rounds):
+        for user_agent in corpus:
+            parse(user_agent)
+    return (perf_counter() - start) / (rounds * len(corpus))
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Measures parsing the User-Agent header into the session fingerprint')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+    with open(CORPUS_PATH, 'r') as f:
+        corpus = [line.rstrip('\n') for line in f if line.strip()]
+    mismatches = [user_agent for user_agent in corpus if fast_families(user_agent) != full_families(user_agent)]
+    print(f'{len(corpus)} user agents, {len(mismatches)} where the fast path differs from user_agents.parse')
+    for user_agent in mismatches:
+        print(f'  {fast_families(user_agent)} != {full_families(user_agent)}: {user_agent}')
+    # clients send few distinct headers, after the first request of each the fingerprint comes from the cache
+    for user_agent in corpus:
+        user_agent_fingerprint(user_agent)
+    results = [
+        ('user_agents.parse', measure(cold(full_families), corpus, args.rounds)),
+        ('fast path', measure(cold(fast_families), corpus, args.rounds)),
+        ('fingerprint, cached', measure(user_agent_fingerprint, corpus, args.rounds)),
+    ]
+    for name, seconds in results:
+        print(f'{name:20} {seconds * 1e6:10.1f} us per header, {results[0][1] / seconds:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+from flask import g
+import typing as t
+
+from .main import query_db_in
+
+
+__all__ = [
+    'NO_ACCESS',
+    'READ',
+    'WRITE',
+    'partition_permissions',
+    'entry_permissions',
+    'filter_accessible',
+    'clear_acl_cache',
+]
+
+
+NO_ACCESS = 0
+READ = 1
+WRITE = 2
+
+
+def _cache() -> t.Dict[t.Tuple[str,str,str],int]:
+    # lives on the app context, so permissions are resolved at most once per request
+    return g.setdefault('_acl_cache', {})
+
+
+def clear_acl_cache() -> None:
+    """
+    Forgets the permissions resolved during this request, e.g. after a share was added or an entry was moved
+    :return:
+    """
+    g.pop('_acl_cache', None)
+
+
+def partition_permissions(user_id: str, partition_ids: t.Iterable[str]) -> t.Dict[str,int]:
+    """
+    Resolves the permission of a user on many partitions with one query per batch
+    :param user_id: the id of the user
+    :param partition_ids: the ids of the partitions
+    :return: the permission level per partition id, WRITE for the owner, otherwise from partition_shares
+    """
+    cache = _cache()
+    result = {}
+    missing = []
+    for partition_id in set(partition_ids):
+        level = cache.get((user_id, 'partition', partition_id))
+        if level is None:
+            missing.append(partition_id)
+        else:
+            result[partition_id] = level
+    for row in query_db_in(
+        'SELECT partitions.id, CASE WHEN partitions.owner_id=? THEN 2 ELSE COALESCE(MAX(partition_shares.allow_write) + 1, 0) END '
+        'FROM partitions LEFT JOIN partition_shares ON partition_shares.partition_id=partitions.id AND partition_shares.user_id=? '
+        'WHERE partitions.id IN ({}) GROUP BY partitions.id',
+        missing,
+        (user_id, user_id)
+    ):
+        result[row[0]] = cache[(user_id, 'partition', row[0])] = row[1]
+    for partition_id in missing:
+        result.setdefault(partition_id, NO_ACCESS)
+    return result
+
+
+def entry_permissions(user_id: str, entries: t.Iterable[t.Any]) -> t.Dict[str,int]:
+    """
+    Resolves the effective permission of a user on many entries in one pass:
+    the owner of an entry may write, otherwise the strongest of the partition share and the shares of the entry and all its ancestors applies
+    :param user_id: the id of the user
+    :param entries: the entries
+    :return: the permission level per entry id
+    """
+    cache = _cache()
+    result = {}
+    pending = []
+    for entry in entries:
+        level = cache.get((user_id, 'entry', entry.id_))
+        if level is not None:
+            result[entry.id_] = level
+        elif entry.owner_id == user_id:
+            result[entry.id_] = cache[(user_id, 'entry', entry.id_)] = WRITE
+        else:
+            pending.append(entry)
+    if not pending:
+        return result
+    partitions = partition_permissions(user_id, [entry.partition_id for entry in pending])
+    shared = dict(query_db_in(
+        'SELECT entry_closure.descendant_id, MAX(entry_shares.allow_write) + 1 FROM entry_closure '
+        'JOIN entry_shares ON entry_shares.entry_id=entry_closure.ancestor_id AND entry_shares.user_id=? '
+        'WHERE entry_closure.descendant_id IN ({}) GROUP BY entry_closure.descendant_id',
+        [entry.id_ for entry in pending if partitions[entry.partition_id] < WRITE],
+        (user_id,)
+    ))
+    for entry in pending:
+        level = max(partitions[entry.partition_id], shared.get(entry.id_, NO_ACCESS))
+        result[entry.id_] = cache[(user_id, 'entry', entry.id_)] = level
+    return result
+
+
+def filter_accessible(user_id: str, entries: t.Iterable[t.Any], level: int=READ) -> t.List[t.Any]:
+    """
+    Keeps the entries a user may access, with a constant amount of queries regardless of the amount of entries
+    :param user_id: the id of the user
+    :param entries: the entries, e.g. a folder listing
+    :param level: the required permission, READ or WRITE
+    :return: the accessible entries in their original order
+    """
+    entries = list(entries)
+    permissions = entry_permissions(user_id, entries)
+    return [entry for entry in entries if permissions[entry.id_] >= level]
@@ -1,12 +1,20 @@
 import typing as t
 
-from ..main import query_db
+from ..main import query_db, query_db_in, transaction
 from ...util.rand import rand_id
 
 import partition as partition_module
 
 
 class Drive:
+    COLUMNS = 'drives.id, drives.location, drives.name, drives.description'
+    __slots__ = (
+        '_id',
+        '_location',
+        '_name',
+        '_description',
+    )
+
     def __init__(
             self,
             id_: t.Union[str,None]=None,
@@ -14,12 +22,10 @@ class Drive:
             name: str='',
             description: str='',
     ):
-        self._id = ''
+        self._id = None
         self._location = ''
         self._name = ''
         self._description = ''
-        if id_ is None:
-            id_ = rand_id('drive')
         self.id_ = id_
         self.location = location
         self.name = name
@@ -37,54 +43,90 @@ class Drive:
         }
 
     def save(self) -> None:
+        if self._id is None:
+            self._id = rand_id('drive')
         if not self._id:
             raise ValueError('Drive ID is not set')
-        if not query_db('SELECT id FROM drives WHERE id=?', (self._id,), True):
-            query_db(
-                'INSERT INTO drives VALUES (?, ?, ?, ?)',
-                (
-                    self._id,
-                    self._location,
-                    self._name,
-                    self._description,
+        with transaction():
+            if not query_db('SELECT id FROM drives WHERE id=?', (self._id,), True):
+                query_db(
+                    'INSERT INTO drives VALUES (?, ?, ?, ?)',
+                    (
+                        self._id,
+                        self._location,
+                        self._name,
+                        self._description,
+                    )
                 )
-            )
-        else:
-            query_db(
-                'UPDATE drives SET location=?, name=?, description=? WHERE id=?',
-                (
-                    self._location,
-                    self._name,
-                    self._description,
-                    self._id,
+            else:
+                query_db(
+                    'UPDATE drives SET location=?, name=?, description=? WHERE id=?',
+                    (
+                        self._location,
+                        self._name,
+                        self._description,
+                        self._id,
+                    )
                 )
-            )
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Drive':
+        return cls(
+            id_=row[0],
+            location=row[1],
+            name=row[2],
+            description=row[3],
+        )
+
+    @classmethod
+    def get_location_of_partition(cls, partition_id: str) -> str:
+        db_result = query_db(
+            'SELECT drives.location FROM partitions JOIN drives ON drives.id=partitions.drive_id WHERE partitions.id=?',
+            (partition_id,),
+            True
+        )
+        if not db_result:
+            raise ValueError(f"No drive for partition {partition_id} has been found.")
+        return db_result[0]
+
+    @classmethod
+    def from_rows(cls, rows: t.Iterable[tuple]) -> t.List['Drive']:
+        return [cls.from_row(row) for row in rows]
 
     @classmethod
     def load(cls, id_: str) -> 'Drive':
         db_result = query_db(
-            'SELECT id, location, name, description FROM drives WHERE id=?',
+            f'SELECT {cls.COLUMNS} FROM drives WHERE id=?',
             (id_,),
             True
         )
         if not db_result:
             raise ValueError(f"No drive with id {id_} has been found.")
-        return Drive(
-            id_=db_result[0],
-            location=db_result[1],
-            name=db_result[2],
-            description=db_result[3],
-        )
+        return cls.from_row(db_result)
+
+    @classmethod
+    def load_many(cls, ids: t.Iterable[str]) -> t.List['Drive']:
+        ids = list(ids)
+        by_id = {row[0]: cls.from_row(row) for row in query_db_in(f'SELECT {cls.COLUMNS} FROM drives WHERE id IN ({{}})', ids)}
+        return [by_id[id_] for id_ in ids if id_ in by_id]
 
     def to_json(self) -> dict:
-        return self.__dict__()
+        return {
+            'id_': self.id_,
+            'location': self.location,
+            'name': self.name,
+            'description': self.description,
+        }
 
     @property
     def id_(self) -> str:
+        # ids are allocated lazily, objects which are never saved or referenced do not touch the database
+        if self._id is None:
+            self._id = rand_id('drive')
         return self._id
 
     @id_.setter
-    def id_(self, value: str) -> None:
+    def id_(self, value: t.Union[str,None]) -> None:
         self._id = value
 
     @property
@@ -112,5 +154,5 @@ class Drive:
         self._description = value
 
     def get_partitions(self) -> t.List[partition_module.Partition]:
-        result = query_db('SELECT id FROM partitions WHERE drive_id=?', (self.id_,))
-        return [partition_module.Partition.load(row[0]) for row in result]
+        result = query_db(f'SELECT {partition_module.Partition.COLUMNS} FROM partitions WHERE drive_id=?', (self.id_,))
+        return partition_module.Partition.from_rows(result)
@@ -1,20 +1,47 @@
 from datetime import datetime
-from hashlib import sha3_256
-from os import makedirs
-from os.path import join, dirname
-import subprocess
+from json import dumps as json_dumps
 import typing as t
 
-from ..main import query_db
-from ...util.misc import DATE_FORMAT
+from ..acl import READ, WRITE, clear_acl_cache, entry_permissions
+from ..hierarchy import closure_insert, closure_move, is_descendant
+from ..main import query_db, query_db_in, transaction
+from ..search import search_index_entries
+from ..usage import apply_usage_delta, free_space, subtree_usage
+from ...util.blob import CHUNK_SIZE, blob_path, hash_file, iter_blob, move_into_store, store_stream
+from ...util.misc import format_timestamp, from_timestamp, to_timestamp
 from ...util.rand import rand_id
 
 import drive as drive_module
 import partition as partition_module
+import tag as tag_module
 import user as user_module
 
 
 class Entry:
+    COLUMNS = 'entries.id, entries.type, entries.name, entries.parent_id, entries.owner_id, entries.partition_id, entries.created, entries.edited, entries.viewed, entries.deleted, entries.hidden, entries.size, entries.hash, entries.encrypted, entries.encryption_hash, entries.target_id, entries.target_partition_id'
+    __slots__ = (
+        '_id',
+        '_type',
+        '_name',
+        '_parent_id',
+        '_owner_id',
+        '_partition_id',
+        '_created',
+        '_edited',
+        '_viewed',
+        '_deleted',
+        '_hidden',
+        '_size',
+        '_hash',
+        '_encrypted',
+        '_encryption_hash',
+        '_target_id',
+        '_target_partition_id',
+        '_created_datetime',
+        '_edited_datetime',
+        '_viewed_datetime',
+        '_deleted_datetime',
+    )
 
     def __init__(
             self,
@@ -24,10 +51,10 @@ class Entry:
             parent_id: t.Union[str,None]=None,
             owner_id: str='',
             partition_id: str='',
-            created: t.Union[datetime,str,None]=None,
-            edited: t.Union[datetime,str,None]=None,
-            viewed: t.Union[datetime,str,None]=None,
-            deleted: t.Union[datetime,str,None]=None,
+            created: t.Union[datetime,str,int,None]=None,
+            edited: t.Union[datetime,str,int,None]=None,
+            viewed: t.Union[datetime,str,int,None]=None,
+            deleted: t.Union[datetime,str,int,None]=None,
             hidden: t.Union[bool,int]=0,
             size: t.Union[int,None]=None,
             hash_: t.Union[str,None]=None,
@@ -36,16 +63,20 @@ class Entry:
             target_id: t.Union[str,None]=None,
             target_partition_id: t.Union[str,None]=None,
     ):
-        self._id = ''
+        self._id = None
         self._type = ''
         self._name = ''
         self._parent_id = ''
         self._owner_id = ''
         self._partition_id = ''
-        self._created = ''
-        self._edited = ''
-        self._viewed = ''
-        self._deleted = ''
+        self._created = 0
+        self._created_datetime = None
+        self._edited = 0
+        self._edited_datetime = None
+        self._viewed = 0
+        self._viewed_datetime = None
+        self._deleted = None
+        self._deleted_datetime = None
         self._hidden = 0
         self._size = 0
         self._hash = ''
@@ -53,8 +84,6 @@ class Entry:
         self._encryption_hash = ''
         self._target_id = ''
         self._target_partition_id = ''
-        if id_ is None:
-            id_ = rand_id('entry')
         if created is None:
             created = datetime.now()
         if edited is None:
@@ -104,99 +133,146 @@ class Entry:
         }
 
     def save(self) -> None:
+        if self._id is None:
+            self._id = rand_id('entry')
         if not self._id:
             raise ValueError('Entry ID is not set')
-        if not query_db('SELECT id FROM entries WHERE id=?', (self._id,), True):
-            query_db(
-                'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                (
-                    self._id,
-                    self._type,
-                    self._name,
-                    self._parent_id,
-                    self._owner_id,
-                    self._partition_id,
-                    self._created,
-                    self._edited,
-                    self._viewed,
-                    self._deleted,
-                    self._hidden,
-                    self._size,
-                    self._hash,
-                    self._encrypted,
-                    self._encryption_hash,
-                    self._target_id,
-                    self._target_partition_id,
+        with transaction():
+            existing = query_db('SELECT id, parent_id, type, partition_id, deleted, size, name FROM entries WHERE id=?', (self._id,), True)
+            if not existing:
+                query_db(
+                    'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        self._id,
+                        self._type,
+                        self._name,
+                        self._parent_id,
+                        self._owner_id,
+                        self._partition_id,
+                        self._created,
+                        self._edited,
+                        self._viewed,
+                        self._deleted,
+                        self._hidden,
+                        self._size,
+                        self._hash,
+                        self._encrypted,
+                        self._encryption_hash,
+                        self._target_id,
+                        self._target_partition_id,
+                    )
                 )
-            )
-        else:
-            query_db(
-                'UPDATE entries SET type=?, name=?, parent_id=?, owner_id=?, partition_id=?, created=?, edited=?, viewed=?, deleted=?, hidden=?, size=?, hash=?, encrypted=?, encryption_hash=?, target_id=?, target_partition_id=? WHERE id=?',
-                (
-                    self._type,
-                    self._name,
-                    self._parent_id,
-                    self._owner_id,
-                    self._partition_id,
-                    self._created,
-                    self._edited,
-                    self._viewed,
-                    self._deleted,
-                    self._hidden,
-                    self._size,
-                    self._hash,
-                    self._encrypted,
-                    self._encryption_hash,
-                    self._target_id,
-                    self._target_partition_id,
-                    self._id,
+                closure_insert(self._id, self._parent_id)
+                apply_usage_delta({}, subtree_usage(self._id))
+                search_index_entries([self._id])
+            else:
+                # writes, deletes, restores and moves change the usage of the partition
+                accounted = (existing[1] or None, existing[2], existing[3], existing[4] is None, existing[5]) != (self._parent_id or None, self._type, self._partition_id, self._deleted is None, self._size)
+                before = subtree_usage(self._id) if accounted else {}
+                if (existing[1] or None) != (self._parent_id or None):
+                    closure_move(self._id, self._parent_id)
+                    # inherited shares depend on the ancestors
+                    clear_acl_cache()
+                query_db(
+                    'UPDATE entries SET type=?, name=?, parent_id=?, owner_id=?, partition_id=?, created=?, edited=?, viewed=?, deleted=?, hidden=?, size=?, hash=?, encrypted=?, encryption_hash=?, target_id=?, target_partition_id=? WHERE id=?',
+                    (
+                        self._type,
+                        self._name,
+                        self._parent_id,
+                        self._owner_id,
+                        self._partition_id,
+                        self._created,
+                        self._edited,
+                        self._viewed,
+                        self._deleted,
+                        self._hidden,
+                        self._size,
+                        self._hash,
+                        self._encrypted,
+                        self._encryption_hash,
+                        self._target_id,
+                        self._target_partition_id,
+                        self._id,
+                    )
                 )
-            )
+                if accounted:
+                    apply_usage_delta(before, subtree_usage(self._id))
+                if (existing[6], existing[3], existing[4] is None) != (self._name, self._partition_id, self._deleted is None):
+                    search_index_entries([self._id])
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Entry':
+        return cls(
+            id_=row[0],
+            type_=row[1],
+            name=row[2],
+            parent_id=row[3],
+            owner_id=row[4],
+            partition_id=row[5],
+            created=row[6],
+            edited=row[7],
+            viewed=row[8],
+            deleted=row[9],
+            hidden=row[10],
+            size=row[11],
+            hash_=row[12],
+            encrypted=row[13],
+            encryption_hash=row[14],
+            target_id=row[15],
+            target_partition_id=row[16],
+        )
+
+    @classmethod
+    def from_rows(cls, rows: t.Iterable[tuple]) -> t.List['Entry']:
+        return [cls.from_row(row) for row in rows]
 
     @classmethod
     def load(cls, id_: str) -> 'Entry':
         db_result = query_db(
-            'SELECT id, type, name, parent_id, owner_id, partition_id, created, edited, viewed, deleted, hidden, size, hash, encrypted, encryption_hash, target_id, target_partition_id FROM entries WHERE id=?',
+            f'SELECT {cls.COLUMNS} FROM entries WHERE id=?',
             (id_,),
             True
         )
         if not db_result:
             raise ValueError(f"No entry with id {id_} has been found.")
-        return Entry(
-            id_=db_result[0],
-            type_=db_result[1],
-            name=db_result[2],
-            parent_id=db_result[3],
-            owner_id=db_result[4],
-            partition_id=db_result[5],
-            created=db_result[6],
-            edited=db_result[7],
-            viewed=db_result[8],
-            deleted=db_result[9],
-            hidden=db_result[10],
-            size=db_result[11],
-            hash_=db_result[12],
-            encrypted=db_result[13],
-            encryption_hash=db_result[14],
-            target_id=db_result[15],
-            target_partition_id=db_result[16],
-        )
+        return cls.from_row(db_result)
+
+    @classmethod
+    def load_many(cls, ids: t.Iterable[str]) -> t.List['Entry']:
+        ids = list(ids)
+        by_id = {row[0]: cls.from_row(row) for row in query_db_in(f'SELECT {cls.COLUMNS} FROM entries WHERE id IN ({{}})', ids)}
+        return [by_id[id_] for id_ in ids if id_ in by_id]
 
     def to_json(self) -> dict:
-        data = self.__dict__()
-        data['created'] = data['created'].strftime(DATE_FORMAT)
-        data['edited'] = data['edited'].strftime(DATE_FORMAT)
-        data['viewed'] = data['viewed'].strftime(DATE_FORMAT)
-        if data['deleted']:
-            data['deleted'] = data['deleted'].strftime(DATE_FORMAT)
-        return data
+        return {
+            'id_': self.id_,
+            'type_': self.type_,
+            'name': self.name,
+            'parent_id': self.parent_id,
+            'owner_id': self.owner_id,
+            'partition_id': self.partition_id,
+            'created': format_timestamp(self._created),
+            'edited': format_timestamp(self._edited),
+            'viewed': format_timestamp(self._viewed),
+            'deleted': format_timestamp(self._deleted),
+            'hidden': self.hidden,
+            'size': self.size,
+            'hash_': self.hash_,
+            'encrypted': self.encrypted,
+            'encryption_hash': self.encryption_hash,
+            'target_id': self.target_id,
+            'target_partition_id': self.target_partition_id,
+        }
 
     @property
     def id_(self) -> str:
+        # ids are allocated lazily, objects which are never saved or referenced do not touch the database
+        if self._id is None:
+            self._id = rand_id('entry')
         return self._id
 
     @id_.setter
-    def id_(self, value: str) -> None:
+    def id_(self, value: t.Union[str,None]) -> None:
         self._id = value
 
     @property
@@ -241,51 +317,47 @@ class Entry:
 
     @property
     def created(self) -> datetime:
-        return datetime.strptime(self._created, DATE_FORMAT)
+        if self._created_datetime is None:
+            self._created_datetime = from_timestamp(self._created)
+        return self._created_datetime
 
     @created.setter
-    def created(self, value: t.Union[datetime,str]) -> None:
-        if isinstance(value, datetime):
-            self._created = value.strftime(DATE_FORMAT)
-        else:
-            self._created = value
+    def created(self, value: t.Union[datetime,str,int]) -> None:
+        self._created = to_timestamp(value)
+        self._created_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def edited(self) -> datetime:
-        return datetime.strptime(self._edited, DATE_FORMAT)
+        if self._edited_datetime is None:
+            self._edited_datetime = from_timestamp(self._edited)
+        return self._edited_datetime
 
     @edited.setter
-    def edited(self, value: t.Union[datetime,str]) -> None:
-        if isinstance(value, datetime):
-            self._edited = value.strftime(DATE_FORMAT)
-        else:
-            self._edited = value
+    def edited(self, value: t.Union[datetime,str,int]) -> None:
+        self._edited = to_timestamp(value)
+        self._edited_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def viewed(self) -> datetime:
-        return datetime.strptime(self._viewed, DATE_FORMAT)
+        if self._viewed_datetime is None:
+            self._viewed_datetime = from_timestamp(self._viewed)
+        return self._viewed_datetime
 
     @viewed.setter
-    def viewed(self, value: t.Union[datetime,str]) -> None:
-        if isinstance(value, datetime):
-            self._viewed = value.strftime(DATE_FORMAT)
-        else:
-            self._viewed = value
+    def viewed(self, value: t.Union[datetime,str,int]) -> None:
+        self._viewed = to_timestamp(value)
+        self._viewed_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def deleted(self) -> t.Union[datetime,None]:
-        if self._deleted:
-            return datetime.strptime(self._deleted, DATE_FORMAT)
-        return None
+        if self._deleted is not None and self._deleted_datetime is None:
+            self._deleted_datetime = from_timestamp(self._deleted)
+        return self._deleted_datetime
 
     @deleted.setter
-    def deleted(self, value: t.Union[datetime,str,None]) -> None:
-        if value is None:
-            self._deleted = None
-        elif isinstance(value, datetime):
-            self._deleted = value.strftime(DATE_FORMAT)
-        else:
-            self._deleted = value
+    def deleted(self, value: t.Union[datetime,str,int,None]) -> None:
+        self._deleted = to_timestamp(value)
+        self._deleted_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def hidden(self) -> bool:
@@ -359,14 +431,86 @@ class Entry:
     def get_drive(self) -> drive_module.Drive:
         return self.get_partition().get_drive()
 
+    def get_ancestors(self) -> t.List['Entry']:
+        # ordered from the root folder down to the direct parent
+        result = query_db(
+            f'SELECT {Entry.COLUMNS} FROM entry_closure JOIN entries ON entries.id=entry_closure.ancestor_id '
+            f'WHERE entry_closure.descendant_id=? AND entry_closure.depth>0 AND entries.deleted IS NULL ORDER BY entry_closure.depth DESC',
+            (self._id,)
+        )
+        return Entry.from_rows(result)
+
+    def is_inside(self, folder_id: str) -> bool:
+        return folder_id != self._id and is_descendant(self._id, folder_id)
+
+    def count_descendants(self) -> int:
+        # entries below a deleted folder are not counted, even if they are not deleted themselves
+        return query_db(
+            'SELECT COUNT(*) FROM entry_closure AS below JOIN entries ON entries.id=below.descendant_id '
+            'WHERE below.ancestor_id=? AND below.depth>0 AND entries.deleted IS NULL AND NOT EXISTS ('
+            'SELECT 1 FROM entry_closure AS above JOIN entries AS ancestor ON ancestor.id=above.ancestor_id '
+            'WHERE above.descendant_id=below.descendant_id AND above.depth>0 AND above.depth<below.depth AND ancestor.deleted IS NOT NULL'
+            ')',
+            (self._id,),
+            True
+        )[0]
+
+    def get_descendants(self, max_depth: t.Union[int,None]=None) -> t.List['Entry']:
+        # depth-first pre-order with siblings sorted by name, deleted entries and everything below them are skipped
+        result = query_db(
+            f'WITH RECURSIVE descendants(id, depth, sort_key) AS ('
+            f'SELECT id, 1, char(1) || name || char(2) || id FROM entries WHERE parent_id=? AND deleted IS NULL '
+            f'UNION ALL SELECT entries.id, descendants.depth + 1, descendants.sort_key || char(1) || entries.name || char(2) || entries.id '
+            f'FROM descendants JOIN entries ON entries.parent_id=descendants.id '
+            f'WHERE entries.deleted IS NULL AND (? IS NULL OR descendants.depth < ?)'
+            f') SELECT {Entry.COLUMNS} FROM descendants JOIN entries ON entries.id=descendants.id ORDER BY descendants.sort_key',
+            (self._id, max_depth, max_depth)
+        )
+        return Entry.from_rows(result)
+
+    @classmethod
+    def resolve_path(cls, partition_id: str, path: str) -> 'Entry':
+        names = [name for name in path.split('/') if name]
+        if not names:
+            raise ValueError('Path is empty')
+        db_result = query_db(
+            f'WITH RECURSIVE parts(idx, name) AS (SELECT key, value FROM json_each(?)), '
+            f'walk(id, depth) AS ('
+            f'SELECT entries.id, 1 FROM parts JOIN entries ON entries.name=parts.name '
+            f'WHERE parts.idx=0 AND entries.partition_id=? AND entries.parent_id IS NULL AND entries.deleted IS NULL '
+            f'UNION ALL SELECT entries.id, walk.depth + 1 FROM walk JOIN parts ON parts.idx=walk.depth JOIN entries ON entries.parent_id=walk.id AND entries.name=parts.name '
+            f'WHERE entries.deleted IS NULL'
+            f') SELECT {cls.COLUMNS} FROM walk JOIN entries ON entries.id=walk.id WHERE walk.depth=? LIMIT 1',
+            (json_dumps(names), partition_id, len(names)),
+            True
+        )
+        if not db_result:
+            raise ValueError(f"No entry at {path} has been found.")
+        return cls.from_row(db_result)
+
+    def get_tags(self, implied: bool=False) -> t.List[tag_module.Tag]:
+        # implied tags also contain every ancestor of the tags set directly on the entry
+        if implied:
+            result = query_db(
+                f'SELECT DISTINCT {tag_module.Tag.COLUMNS} FROM tag_relations JOIN tag_closure ON tag_closure.descendant_id=tag_relations.tag_id '
+                f'JOIN tags ON tags.id=tag_closure.ancestor_id WHERE tag_relations.entry_id=?',
+                (self._id,)
+            )
+        else:
+            result = query_db(
+                f'SELECT {tag_module.Tag.COLUMNS} FROM tag_relations JOIN tags ON tags.id=tag_relations.tag_id WHERE tag_relations.entry_id=?',
+                (self._id,)
+            )
+        return tag_module.Tag.from_rows(result)
+
     def is_shared(self) -> bool:
         return bool(query_db('SELECT id FROM entry_shares WHERE entry_id=?', (self._id,), True))
 
     def can_user_access(self, user_id: str) -> bool:
-        return (user_id == self._owner_id) or bool(query_db('SELECT id FROM entry_shares WHERE entry_id=? AND user_id=?', (self._id, user_id), True))
+        return entry_permissions(user_id, [self])[self.id_] >= READ
 
     def can_user_edit(self, user_id: str) -> bool:
-        return (user_id == self._owner_id) or bool(query_db('SELECT id FROM entry_shares WHERE entry_id=? AND user_id=? AND allow_write=1', (self._id, user_id), True))
+        return entry_permissions(user_id, [self])[self.id_] >= WRITE
 
     def update_edited(self) -> None:
         self.edited = datetime.now()
@@ -375,7 +519,7 @@ class Entry:
         self.viewed = datetime.now()
 
     def get_path(self) -> str:
-        return join(self.get_drive().location, self._hash[:2], self._hash[2:4], self._hash[4:])
+        return blob_path(drive_module.Drive.get_location_of_partition(self._partition_id), self._hash)
 
     def read(self) -> bytes:
         if self._type != 'file':
@@ -385,39 +529,42 @@ class Entry:
             content = f.read()
         return content
 
+    def read_stream(self, chunk_size: int=CHUNK_SIZE) -> t.Iterator[bytes]:
+        if self._type != 'file':
+            raise ValueError('Entry is not a file')
+        self.update_viewed()
+        return iter_blob(self.get_path(), chunk_size)
+
     def write(self, content: bytes) -> None:
+        self.write_stream((content,))
+
+    def write_allowance(self) -> t.Union[int,None]:
+        """
+        Computes how large the content of this file may become without exceeding the capacity of its partition
+        :return: the maximum size in bytes, None if the partition has no capacity limit
+        """
+        free = free_space(self._partition_id)
+        if free is None:
+            return None
+        # the content which is replaced frees its space
+        return free + subtree_usage(self._id).get(self._partition_id, (0, 0))[0]
+
+    def write_stream(self, source: t.Union[t.BinaryIO,t.Iterable[bytes]], chunk_size: int=CHUNK_SIZE) -> None:
         if self._type != 'file':
             raise ValueError('Entry is not a file')
+        hash_, size = store_stream(self.get_drive().location, source, chunk_size, self.write_allowance())
         self.update_edited()
         self.update_viewed()
-        hash_ = sha3_256(content).hexdigest()
-        self._hash = hash_
-        self._size = len(content)
-        path = join(self.get_drive().location, hash_[:2], hash_[2:4], hash_[4:])
-        makedirs(dirname(path), exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(content)
+        self._hash, self._size = hash_, size
 
     def alternate_write(self, path: str) -> None:
         if self._type != 'file':
             raise ValueError('Entry is not a file')
+        hash_, size = hash_file(path)
+        allowance = self.write_allowance()
+        if allowance is not None and size > allowance:
+            raise ValueError('The partition does not have enough free space')
+        move_into_store(self.get_drive().location, path, hash_)
         self.update_edited()
         self.update_viewed()
-        hash_result = subprocess.run(
-            ['sha3_256sum', path],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        hash_output = hash_result.stdout.strip()
-        self._hash = hash_output.split('= ')[1]
-        size_result = subprocess.run(
-            ['stat', '--printf=%s', path],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        self._size = int(size_result.stdout)
-        dest_path = join(self.get_drive().location, self._hash[:2], self._hash[2:4], self._hash[4:])
-        makedirs(dirname(dest_path), exist_ok=True)
-        subprocess.run(['mv', path, dest_path], check=True)
+        self._hash, self._size = hash_, size
@@ -1,8 +1,10 @@
 from datetime import datetime
 import typing as t
 
-from ..main import query_db
-from ...util.misc import DATE_FORMAT
+from ..acl import READ, WRITE, partition_permissions
+from ..main import query_db, query_db_in, transaction
+from ..usage import partition_usage
+from ...util.misc import format_timestamp, from_timestamp, to_timestamp
 from ...util.rand import rand_id
 
 import drive as drive_module
@@ -11,6 +13,23 @@ import entry as entry_module
 
 
 class Partition:
+    COLUMNS = 'partitions.id, partitions.drive_id, partitions.name, partitions.owner_id, partitions.capacity, partitions.created, partitions.edited, partitions.viewed, partitions.deleted, partitions.hidden'
+    __slots__ = (
+        '_id',
+        '_drive_id',
+        '_name',
+        '_owner_id',
+        '_capacity',
+        '_created',
+        '_edited',
+        '_viewed',
+        '_deleted',
+        '_hidden',
+        '_created_datetime',
+        '_edited_datetime',
+        '_viewed_datetime',
+        '_deleted_datetime',
+    )
 
     def __init__(
             self,
@@ -19,24 +38,26 @@ class Partition:
             name: str='',
             owner_id: str='',
             capacity: int=0,
-            created: t.Union[datetime,str,None]=None,
-            edited: t.Union[datetime,str,None]=None,
-            viewed: t.Union[datetime,str,None]=None,
-            deleted: t.Union[datetime,str,None]=None,
+            created: t.Union[datetime,str,int,None]=None,
+            edited: t.Union[datetime,str,int,None]=None,
+            viewed: t.Union[datetime,str,int,None]=None,
+            deleted: t.Union[datetime,str,int,None]=None,
             hidden: t.Union[bool,int]=0,
     ):
-        self._id = ''
+        self._id = None
         self._drive_id = ''
         self._name = ''
         self._owner_id = ''
         self._capacity = 0
-        self._created = ''
-        self._edited = ''
-        self._viewed = ''
-        self._deleted = ''
+        self._created = 0
+        self._created_datetime = None
+        self._edited = 0
+        self._edited_datetime = None
+        self._viewed = 0
+        self._viewed_datetime = None
+        self._deleted = None
+        self._deleted_datetime = None
         self._hidden = 0
-        if id_ is None:
-            id_ = rand_id('partition')
         if created is None:
             created = datetime.now()
         if edited is None:
@@ -72,78 +93,103 @@ class Partition:
         }
 
     def save(self) -> None:
+        if self._id is None:
+            self._id = rand_id('partition')
         if not self._id:
             raise ValueError('Partition ID is not set')
-        if not query_db('SELECT id FROM partitions WHERE id=?', (self._id,), True):
-            query_db(
-                'INSERT INTO partitions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                (
-                    self._id,
-                    self._drive_id,
-                    self._name,
-                    self._owner_id,
-                    self._capacity,
-                    self._created,
-                    self._edited,
-                    self._viewed,
-                    self._deleted,
-                    self._hidden,
+        with transaction():
+            if not query_db('SELECT id FROM partitions WHERE id=?', (self._id,), True):
+                query_db(
+                    'INSERT INTO partitions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        self._id,
+                        self._drive_id,
+                        self._name,
+                        self._owner_id,
+                        self._capacity,
+                        self._created,
+                        self._edited,
+                        self._viewed,
+                        self._deleted,
+                        self._hidden,
+                    )
                 )
-            )
-        else:
-            query_db(
-                'UPDATE partitions SET drive_id=?, name=?, owner_id=?, capacity=?, created=?, edited=?, viewed=?, deleted=?, hidden=? WHERE id=?',
-                (
-                    self._drive_id,
-                    self._name,
-                    self._owner_id,
-                    self._capacity,
-                    self._created,
-                    self._edited,
-                    self._viewed,
-                    self._deleted,
-                    self._hidden,
-                    self._id,
+            else:
+                query_db(
+                    'UPDATE partitions SET drive_id=?, name=?, owner_id=?, capacity=?, created=?, edited=?, viewed=?, deleted=?, hidden=? WHERE id=?',
+                    (
+                        self._drive_id,
+                        self._name,
+                        self._owner_id,
+                        self._capacity,
+                        self._created,
+                        self._edited,
+                        self._viewed,
+                        self._deleted,
+                        self._hidden,
+                        self._id,
+                    )
                 )
-            )
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Partition':
+        return cls(
+            id_=row[0],
+            drive_id=row[1],
+            name=row[2],
+            owner_id=row[3],
+            capacity=row[4],
+            created=row[5],
+            edited=row[6],
+            viewed=row[7],
+            deleted=row[8],
+            hidden=row[9],
+        )
+
+    @classmethod
+    def from_rows(cls, rows: t.Iterable[tuple]) -> t.List['Partition']:
+        return [cls.from_row(row) for row in rows]
 
     @classmethod
     def load(cls, id_: str) -> 'Partition':
         db_result = query_db(
-            'SELECT id, drive_id, name, owner_id, capacity, created, edited, viewed, deleted, hidden FROM partitions WHERE id=?',
+            f'SELECT {cls.COLUMNS} FROM partitions WHERE id=?',
             (id_,),
             True
         )
         if not db_result:
             raise ValueError(f"No partition with id {id_} has been found.")
-        return Partition(
-            id_=db_result[0],
-            drive_id=db_result[1],
-            name=db_result[2],
-            owner_id=db_result[3],
-            capacity=db_result[4],
-            created=db_result[5],
-            edited=db_result[6],
-            viewed=db_result[7],
-            deleted=db_result[8],
-            hidden=db_result[9],
-        )
+        return cls.from_row(db_result)
+
+    @classmethod
+    def load_many(cls, ids: t.Iterable[str]) -> t.List['Partition']:
+        ids = list(ids)
+        by_id = {row[0]: cls.from_row(row) for row in query_db_in(f'SELECT {cls.COLUMNS} FROM partitions WHERE id IN ({{}})', ids)}
+        return [by_id[id_] for id_ in ids if id_ in by_id]
 
     def to_json(self) -> dict:
-        data = self.__dict__()
-        data['created'] = data['created'].strftime(DATE_FORMAT)
-        data['edited'] = data['edited'].strftime(DATE_FORMAT)
-        data['viewed'] = data['viewed'].strftime(DATE_FORMAT)
-        if data['deleted']:
-            data['deleted'] = data['deleted'].strftime(DATE_FORMAT)
-        return data
+        return {
+            'id_': self.id_,
+            'drive_id': self.drive_id,
+            'name': self.name,
+            'owner_id': self.owner_id,
+            'capacity': self.capacity,
+            'created': format_timestamp(self._created),
+            'edited': format_timestamp(self._edited),
+            'viewed': format_timestamp(self._viewed),
+            'deleted': format_timestamp(self._deleted),
+            'hidden': self.hidden,
+        }
 
     @property
     def id_(self) -> str:
+        # ids are allocated lazily, objects which are never saved or referenced do not touch the database
+        if self._id is None:
+            self._id = rand_id('partition')
         return self._id
 
     @id_.setter
-    def id_(self, value: str) -> None:
+    def id_(self, value: t.Union[str,None]) -> None:
         self._id = value
 
     @property
@@ -180,51 +226,47 @@ class Partition:
 
     @property
     def created(self) -> datetime:
-        return datetime.strptime(self._created, DATE_FORMAT)
+        if self._created_datetime is None:
+            self._created_datetime = from_timestamp(self._created)
+        return self._created_datetime
 
     @created.setter
-    def created(self, value: t.Union[datetime,str]) -> None:
-        if isinstance(value, datetime):
-            self._created = value.strftime(DATE_FORMAT)
-        else:
-            self._created = value
+    def created(self, value: t.Union[datetime,str,int]) -> None:
+        self._created = to_timestamp(value)
+        self._created_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def edited(self) -> datetime:
-        return datetime.strptime(self._edited, DATE_FORMAT)
+        if self._edited_datetime is None:
+            self._edited_datetime = from_timestamp(self._edited)
+        return self._edited_datetime
 
     @edited.setter
-    def edited(self, value: t.Union[datetime,str]) -> None:
-        if isinstance(value, datetime):
-            self._edited = value.strftime(DATE_FORMAT)
-        else:
-            self._edited = value
+    def edited(self, value: t.Union[datetime,str,int]) -> None:
+        self._edited = to_timestamp(value)
+        self._edited_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def viewed(self) -> datetime:
-        return datetime.strptime(self._viewed, DATE_FORMAT)
+        if self._viewed_datetime is None:
+            self._viewed_datetime = from_timestamp(self._viewed)
+        return self._viewed_datetime
 
     @viewed.setter
-    def viewed(self, value: t.Union[datetime,str]) -> None:
-        if isinstance(value, datetime):
-            self._viewed = value.strftime(DATE_FORMAT)
-        else:
-            self._viewed = value
+    def viewed(self, value: t.Union[datetime,str,int]) -> None:
+        self._viewed = to_timestamp(value)
+        self._viewed_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def deleted(self) -> t.Union[datetime,None]:
-        if self._deleted:
-            return datetime.strptime(self._deleted, DATE_FORMAT)
-        return None
+        if self._deleted is not None and self._deleted_datetime is None:
+            self._deleted_datetime = from_timestamp(self._deleted)
+        return self._deleted_datetime
 
     @deleted.setter
-    def deleted(self, value: t.Union[datetime,str,None]) -> None:
-        if value is None:
-            self._deleted = None
-        elif isinstance(value, datetime):
-            self._deleted = value.strftime(DATE_FORMAT)
-        else:
-            self._deleted = value
+    def deleted(self, value: t.Union[datetime,str,int,None]) -> None:
+        self._deleted = to_timestamp(value)
+        self._deleted_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def hidden(self) -> bool:
@@ -241,18 +283,21 @@ class Partition:
         return user_module.User.load(self._owner_id)
 
     def get_entries(self) -> t.List[entry_module.Entry]:
-        result = query_db('SELECT id FROM entries WHERE partition_id=? AND deleted IS NULL', (self.id_,))
-        return [entry_module.Entry.load(row[0]) for row in result]
+        result = query_db(f'SELECT {entry_module.Entry.COLUMNS} FROM entries WHERE partition_id=? AND deleted IS NULL', (self.id_,))
+        return entry_module.Entry.from_rows(result)
 
     def root_entries(self) -> t.List[entry_module.Entry]:
-        result = query_db('SELECT id FROM entries WHERE partition_id=? AND parent_id IS NULL AND deleted IS NULL', (self.id_,))
-        return [entry_module.Entry.load(row[0]) for row in result]
+        result = query_db(f'SELECT {entry_module.Entry.COLUMNS} FROM entries WHERE partition_id=? AND parent_id IS NULL AND deleted IS NULL', (self.id_,))
+        return entry_module.Entry.from_rows(result)
+
+    def get_usage(self) -> t.Tuple[int,int]:
+        return partition_usage(self.id_)
 
     def is_shared(self) -> bool:
         return bool(query_db('SELECT id FROM partition_shares WHERE partition_id=?', (self.id_,), True))
 
     def can_user_access(self, user: user_module.User) -> bool:
-        return (user.id_ == self.owner_id) or bool(query_db('SELECT id FROM partition_shares WHERE partition_id=? AND user_id=?', (self.id_, user.id_), True))
+        return partition_permissions(user.id_, [self.id_])[self.id_] >= READ
 
     def can_user_edit(self, user: user_module.User) -> bool:
-        return (user.id_ == self.owner_id) or bool(query_db('SELECT id FROM partition_shares WHERE partition_id=? AND user_id=? AND allow_write=1', (self.id_, user.id_), True))
+        return partition_permissions(user.id_, [self.id_])[self.id_] >= WRITE
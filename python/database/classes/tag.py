@@ -1,28 +1,38 @@
 from datetime import datetime
 import typing as t
 
-from ..main import query_db
-from ...util.misc import DATE_FORMAT
+from ..hierarchy import tag_closure_insert, tag_closure_link, tag_closure_unlink
+from ..main import query_db, query_db_in, transaction
+from ..search import search_index_entries
+from ...util.misc import format_timestamp, from_timestamp, now_timestamp, to_timestamp
 from ...util.rand import rand_id
 
 
 class Tag:
+    COLUMNS = 'tags.id, tags.name, tags.description, tags.created, tags.owner_id'
+    __slots__ = (
+        '_id',
+        '_name',
+        '_description',
+        '_created',
+        '_owner_id',
+        '_created_datetime',
+    )
 
     def __init__(
             self,
             id_: t.Union[str,None]=None,
             name: str='',
             description: str='',
-            created: t.Union[datetime,str,None]=None,
+            created: t.Union[datetime,str,int,None]=None,
             owner_id: str='',
     ):
-        self._id = ''
+        self._id = None
         self._name = ''
         self._description = ''
-        self._created = ''
+        self._created = 0
+        self._created_datetime = None
         self._owner_id = ''
-        if id_ is None:
-            id_ = rand_id('tag')
         if created is None:
             created = datetime.now()
         self.id_ = id_
@@ -44,59 +54,87 @@ class Tag:
         }
 
     def save(self) -> None:
+        if self._id is None:
+            self._id = rand_id('tag')
         if not self._id:
             raise ValueError('Tag ID is not set')
-        if not query_db('SELECT id FROM tags WHERE id=?', (self._id,), True):
-            query_db(
-                'INSERT INTO tags VALUES (?, ?, ?, ?, ?)',
-                (
-                    self._id,
-                    self._name,
-                    self._description,
-                    self._created,
-                    self._owner_id,
+        with transaction():
+            existing = query_db('SELECT id, name, description FROM tags WHERE id=?', (self._id,), True)
+            if not existing:
+                query_db(
+                    'INSERT INTO tags VALUES (?, ?, ?, ?, ?)',
+                    (
+                        self._id,
+                        self._name,
+                        self._description,
+                        self._created,
+                        self._owner_id,
+                    )
                 )
-            )
-        else:
-            query_db(
-                'UPDATE tags SET name=?, description=?, created=?, owner_id=? WHERE id=?',
-                (
-                    self._name,
-                    self._description,
-                    self._created,
-                    self._owner_id,
-                    self._id,
+                tag_closure_insert(self._id)
+            else:
+                query_db(
+                    'UPDATE tags SET name=?, description=?, created=?, owner_id=? WHERE id=?',
+                    (
+                        self._name,
+                        self._description,
+                        self._created,
+                        self._owner_id,
+                        self._id,
+                    )
                 )
-            )
+                if (existing[1], existing[2]) != (self._name, self._description):
+                    search_index_entries(row[0] for row in query_db('SELECT entry_id FROM tag_relations WHERE tag_id=?', (self._id,)))
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Tag':
+        return cls(
+            id_=row[0],
+            name=row[1],
+            description=row[2],
+            created=row[3],
+            owner_id=row[4],
+        )
+
+    @classmethod
+    def from_rows(cls, rows: t.Iterable[tuple]) -> t.List['Tag']:
+        return [cls.from_row(row) for row in rows]
 
     @classmethod
     def load(cls, id_: str) -> 'Tag':
         db_result = query_db(
-            'SELECT id, name, description, created, owner_id FROM tags WHERE id=?',
+            f'SELECT {cls.COLUMNS} FROM tags WHERE id=?',
             (id_,),
             True
         )
         if not db_result:
             raise ValueError(f"No tag with id {id_} has been found.")
-        return Tag(
-            id_=db_result[0],
-            name=db_result[1],
-            description=db_result[2],
-            created=db_result[3],
-            owner_id=db_result[4],
-        )
+        return cls.from_row(db_result)
+
+    @classmethod
+    def load_many(cls, ids: t.Iterable[str]) -> t.List['Tag']:
+        ids = list(ids)
+        by_id = {row[0]: cls.from_row(row) for row in query_db_in(f'SELECT {cls.COLUMNS} FROM tags WHERE id IN ({{}})', ids)}
+        return [by_id[id_] for id_ in ids if id_ in by_id]
 
     def to_json(self) -> dict:
-        data = self.__dict__()
-        data['created'] = data['created'].strftime(DATE_FORMAT)
-        return data
+        return {
+            'id_': self.id_,
+            'name': self.name,
+            'description': self.description,
+            'created': format_timestamp(self._created),
+            'owner_id': self.owner_id,
+        }
 
     @property
     def id_(self) -> str:
+        # ids are allocated lazily, objects which are never saved or referenced do not touch the database
+        if self._id is None:
+            self._id = rand_id('tag')
         return self._id
 
     @id_.setter
-    def id_(self, value: str) -> None:
+    def id_(self, value: t.Union[str,None]) -> None:
         self._id = value
 
     @property
@@ -117,14 +155,14 @@ class Tag:
 
     @property
     def created(self) -> datetime:
-        return datetime.strptime(self._created, DATE_FORMAT)
+        if self._created_datetime is None:
+            self._created_datetime = from_timestamp(self._created)
+        return self._created_datetime
 
     @created.setter
-    def created(self, value: t.Union[datetime,str]) -> None:
-        if isinstance(value, datetime):
-            self._created = value.strftime(DATE_FORMAT)
-        else:
-            self._created = value
+    def created(self, value: t.Union[datetime,str,int]) -> None:
+        self._created = to_timestamp(value)
+        self._created_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def owner_id(self) -> str:
@@ -133,3 +171,51 @@ class Tag:
     @owner_id.setter
     def owner_id(self, value: str) -> None:
         self._owner_id = value
+
+    def get_parents(self) -> t.List['Tag']:
+        return Tag.from_rows(query_db(
+            f'SELECT {Tag.COLUMNS} FROM tag_tag_relations JOIN tags ON tags.id=tag_tag_relations.parent_id WHERE tag_tag_relations.tag_id=?',
+            (self._id,)
+        ))
+
+    def get_children(self) -> t.List['Tag']:
+        return Tag.from_rows(query_db(
+            f'SELECT {Tag.COLUMNS} FROM tag_tag_relations JOIN tags ON tags.id=tag_tag_relations.tag_id WHERE tag_tag_relations.parent_id=?',
+            (self._id,)
+        ))
+
+    def get_ancestors(self) -> t.List['Tag']:
+        return Tag.from_rows(query_db(
+            f'SELECT {Tag.COLUMNS} FROM tag_closure JOIN tags ON tags.id=tag_closure.ancestor_id WHERE tag_closure.descendant_id=? AND tag_closure.ancestor_id!=?',
+            (self._id, self._id)
+        ))
+
+    def get_descendants(self) -> t.List['Tag']:
+        return Tag.from_rows(query_db(
+            f'SELECT {Tag.COLUMNS} FROM tag_closure JOIN tags ON tags.id=tag_closure.descendant_id WHERE tag_closure.ancestor_id=? AND tag_closure.descendant_id!=?',
+            (self._id, self._id)
+        ))
+
+    def add_parent(self, parent_id: str) -> None:
+        with transaction():
+            if query_db('SELECT id FROM tag_tag_relations WHERE tag_id=? AND parent_id=?', (self.id_, parent_id), True):
+                return
+            tag_closure_link(self.id_, parent_id)
+            query_db('INSERT INTO tag_tag_relations VALUES (?, ?, ?, ?)', (rand_id('tag_tag_relation'), self.id_, parent_id, now_timestamp()))
+
+    def remove_parent(self, parent_id: str) -> None:
+        with transaction():
+            removed = query_db('DELETE FROM tag_tag_relations WHERE tag_id=? AND parent_id=? RETURNING id', (self._id, parent_id))
+            for _ in removed:
+                tag_closure_unlink(self._id, parent_id)
+
+    def tag_entry(self, entry_id: str) -> None:
+        with transaction():
+            if not query_db('SELECT id FROM tag_relations WHERE tag_id=? AND entry_id=?', (self.id_, entry_id), True):
+                query_db('INSERT INTO tag_relations VALUES (?, ?, ?, ?)', (rand_id('tag_relation'), self.id_, entry_id, now_timestamp()))
+                search_index_entries([entry_id])
+
+    def untag_entry(self, entry_id: str) -> None:
+        with transaction():
+            query_db('DELETE FROM tag_relations WHERE tag_id=? AND entry_id=?', (self._id, entry_id))
+            search_index_entries([entry_id])
@@ -1,14 +1,32 @@
 from datetime import datetime
 import typing as t
 
-from ..main import query_db
-from ...util.misc import DATE_FORMAT
+from ..main import query_db, query_db_in, transaction
+from ...util.misc import format_timestamp, from_timestamp, to_timestamp
 from ...util.rand import rand_id
 
 import partition as partition_module
 
 
 class User:
+    COLUMNS = 'users.id, users.username, users.email, users.password, users.salt, users.totp, users.created_at, users.last_login, users.tos_accepted, users.balance, users.theme, users.locale'
+    __slots__ = (
+        '_id',
+        '_username',
+        '_email',
+        '_password',
+        '_salt',
+        '_totp',
+        '_created_at',
+        '_last_login',
+        '_tos_accepted',
+        '_balance',
+        '_theme',
+        '_locale',
+        '_created_at_datetime',
+        '_last_login_datetime',
+        '_tos_accepted_datetime',
+    )
 
     def __init__(
             self,
@@ -18,27 +36,28 @@ class User:
             password: str='',
             salt: str='',
             totp: str='',
-            created_at: t.Union[datetime,str,None]=None,
-            last_login: t.Union[datetime,str,None]=None,
-            tos_accepted: t.Union[datetime,str,None]=None,
+            created_at: t.Union[datetime,str,int,None]=None,
+            last_login: t.Union[datetime,str,int,None]=None,
+            tos_accepted: t.Union[datetime,str,int,None]=None,
             balance: int=0,
             theme: str='',
             locale: str='',
     ):
-        self._id = ''
+        self._id = None
         self._username = ''
         self._email = ''
         self._password = ''
         self._salt = ''
         self._totp = ''
-        self._created_at = ''
-        self._last_login = ''
-        self._tos_accepted = ''
+        self._created_at = 0
+        self._created_at_datetime = None
+        self._last_login = 0
+        self._last_login_datetime = None
+        self._tos_accepted = 0
+        self._tos_accepted_datetime = None
         self._balance = 0
         self._theme = ''
         self._locale = ''
-        if id_ is None:
-            id_ = rand_id('user')
         if created_at is None:
             created_at = datetime.now()
         if last_login is None:
@@ -78,82 +97,111 @@ class User:
         }
 
     def save(self) -> None:
+        if self._id is None:
+            self._id = rand_id('user')
         if not self._id:
             raise ValueError('User ID is not set')
-        if not query_db('SELECT id FROM users WHERE id=?', (self._id,), True):
-            query_db(
-                'INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                (
-                    self._id,
-                    self._username,
-                    self._email,
-                    self._password,
-                    self._salt,
-                    self._totp,
-                    self._created_at,
-                    self._last_login,
-                    self._tos_accepted,
-                    self._balance,
-                    self._theme,
-                    self._locale,
+        with transaction():
+            if not query_db('SELECT id FROM users WHERE id=?', (self._id,), True):
+                query_db(
+                    'INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        self._id,
+                        self._username,
+                        self._email,
+                        self._password,
+                        self._salt,
+                        self._totp,
+                        self._created_at,
+                        self._last_login,
+                        self._tos_accepted,
+                        self._balance,
+                        self._theme,
+                        self._locale,
+                    )
                 )
-            )
-        else:
-            query_db(
-                'UPDATE users SET username=?, email=?, password=?, salt=?, totp=?, created_at=?, last_login=?, tos_accepted=?, balance=?, theme=?, locale=? WHERE id=?',
-                (
-                    self._username,
-                    self._email,
-                    self._password,
-                    self._salt,
-                    self._totp,
-                    self._created_at,
-                    self._last_login,
-                    self._tos_accepted,
-                    self._balance,
-                    self._theme,
-                    self._locale,
-                    self._id,
+            else:
+                query_db(
+                    'UPDATE users SET username=?, email=?, password=?, salt=?, totp=?, created_at=?, last_login=?, tos_accepted=?, balance=?, theme=?, locale=? WHERE id=?',
+                    (
+                        self._username,
+                        self._email,
+                        self._password,
+                        self._salt,
+                        self._totp,
+                        self._created_at,
+                        self._last_login,
+                        self._tos_accepted,
+                        self._balance,
+                        self._theme,
+                        self._locale,
+                        self._id,
+                    )
                 )
-            )
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'User':
+        return cls(
+            id_=row[0],
+            username=row[1],
+            email=row[2],
+            password=row[3],
+            salt=row[4],
+            totp=row[5],
+            created_at=row[6],
+            last_login=row[7],
+            tos_accepted=row[8],
+            balance=row[9],
+            theme=row[10],
+            locale=row[11],
+        )
+
+    @classmethod
+    def from_rows(cls, rows: t.Iterable[tuple]) -> t.List['User']:
+        return [cls.from_row(row) for row in rows]
 
     @classmethod
     def load(cls, id_: str) -> 'User':
         db_result = query_db(
-            'SELECT id, username, email, password, salt, totp, created_at, last_login, tos_accepted, balance, theme, locale FROM users WHERE id=?',
+            f'SELECT {cls.COLUMNS} FROM users WHERE id=?',
             (id_,),
             True
         )
         if not db_result:
             raise ValueError(f"No user with id {id_} has been found.")
-        return User(
-            id_=db_result[0],
-            username=db_result[1],
-            email=db_result[2],
-            password=db_result[3],
-            salt=db_result[4],
-            totp=db_result[5],
-            created_at=db_result[6],
-            last_login=db_result[7],
-            tos_accepted=db_result[8],
-            balance=db_result[9],
-            theme=db_result[10],
-            locale=db_result[11],
-        )
+        return cls.from_row(db_result)
+
+    @classmethod
+    def load_many(cls, ids: t.Iterable[str]) -> t.List['User']:
+        ids = list(ids)
+        by_id = {row[0]: cls.from_row(row) for row in query_db_in(f'SELECT {cls.COLUMNS} FROM users WHERE id IN ({{}})', ids)}
+        return [by_id[id_] for id_ in ids if id_ in by_id]
 
     def to_json(self) -> dict:
-        data = self.__dict__()
-        data['created_at'] = data['created_at'].strftime(DATE_FORMAT)
-        data['last_login'] = data['last_login'].strftime(DATE_FORMAT)
-        data['tos_accepted'] = data['tos_accepted'].strftime(DATE_FORMAT)
-        return data
+        return {
+            'id_': self.id_,
+            'username': self.username,
+            'email': self.email,
+            'password': self.password,
+            'salt': self.salt,
+            'totp': self.totp,
+            'created_at': format_timestamp(self._created_at),
+            'last_login': format_timestamp(self._last_login),
+            'tos_accepted': format_timestamp(self._tos_accepted),
+            'balance': self.balance,
+            'theme': self.theme,
+            'locale': self.locale,
+        }
 
     @property
     def id_(self) -> str:
+        # ids are allocated lazily, objects which are never saved or referenced do not touch the database
+        if self._id is None:
+            self._id = rand_id('user')
         return self._id
 
     @id_.setter
-    def id_(self, value: str) -> None:
+    def id_(self, value: t.Union[str,None]) -> None:
         self._id = value
 
     @property
@@ -198,36 +246,36 @@ class User:
 
     @property
     def created_at(self) -> datetime:
-        return datetime.strptime(self._created_at, DATE_FORMAT)
+        if self._created_at_datetime is None:
+            self._created_at_datetime = from_timestamp(self._created_at)
+        return self._created_at_datetime
 
     @created_at.setter
-    def created_at(self, value: t.Union[datetime,str]) -> None:
-        if isinstance(value, datetime):
-            self._created_at = value.strftime(DATE_FORMAT)
-        else:
-            self._created_at = value
+    def created_at(self, value: t.Union[datetime,str,int]) -> None:
+        self._created_at = to_timestamp(value)
+        self._created_at_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def last_login(self) -> datetime:
-        return datetime.strptime(self._last_login, DATE_FORMAT)
+        if self._last_login_datetime is None:
+            self._last_login_datetime = from_timestamp(self._last_login)
+        return self._last_login_datetime
 
     @last_login.setter
-    def last_login(self, value: t.Union[datetime,str]) -> None:
-        if isinstance(value, datetime):
-            self._last_login = value.strftime(DATE_FORMAT)
-        else:
-            self._last_login = value
+    def last_login(self, value: t.Union[datetime,str,int]) -> None:
+        self._last_login = to_timestamp(value)
+        self._last_login_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def tos_accepted(self) -> datetime:
-        return datetime.strptime(self._tos_accepted, DATE_FORMAT)
+        if self._tos_accepted_datetime is None:
+            self._tos_accepted_datetime = from_timestamp(self._tos_accepted)
+        return self._tos_accepted_datetime
 
     @tos_accepted.setter
-    def tos_accepted(self, value: t.Union[datetime,str]) -> None:
-        if isinstance(value, datetime):
-            self._tos_accepted = value.strftime(DATE_FORMAT)
-        else:
-            self._tos_accepted = value
+    def tos_accepted(self, value: t.Union[datetime,str,int]) -> None:
+        self._tos_accepted = to_timestamp(value)
+        self._tos_accepted_datetime = value.replace(microsecond=0) if isinstance(value, datetime) else None
 
     @property
     def balance(self) -> int:
@@ -254,10 +302,13 @@ class User:
         self._locale = value
 
     def get_own_partitions(self) -> t.List[partition_module.Partition]:
-        result = query_db('SELECT id FROM partitions WHERE owner_id=?', (self.id_,))
-        return [partition_module.Partition.load(row[0]) for row in result]
+        result = query_db(f'SELECT {partition_module.Partition.COLUMNS} FROM partitions WHERE owner_id=?', (self.id_,))
+        return partition_module.Partition.from_rows(result)
 
     def get_accessible_partitions(self) -> t.List[partition_module.Partition]:
-        own_partitions = self.get_own_partitions()
-        result = query_db('SELECT partition_id FROM partition_shares WHERE user_id=?', (self.id_,))
-        return own_partitions + [partition_module.Partition.load(row[0]) for row in result]
+        result = query_db(
+            f'SELECT {partition_module.Partition.COLUMNS} FROM partitions WHERE owner_id=? '
+            f'UNION ALL SELECT {partition_module.Partition.COLUMNS} FROM partition_shares JOIN partitions ON partitions.id=partition_shares.partition_id WHERE partition_shares.user_id=?',
+            (self.id_, self.id_)
+        )
+        return partition_module.Partition.from_rows(result)
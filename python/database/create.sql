@@ -1,6 +1,7 @@
 CREATE TABLE IF NOT EXISTS used_ids (
     id TEXT PRIMARY KEY,
-    created TEXT NOT NULL
+    created INTEGER NOT NULL,
+    table_name TEXT NULL  -- the table whose primary key keeps the id unique once saved, null if the id must be kept forever
 );
 CREATE TABLE IF NOT EXISTS ips (
     ip TEXT PRIMARY KEY,
@@ -14,9 +15,9 @@ CREATE TABLE IF NOT EXISTS users (
     password TEXT NOT NULL,
     salt TEXT NOT NULL,
     totp TEXT NOT NULL,
-    created_at TEXT NOT NULL,
-    last_login TEXT NOT NULL,
-    tos_accepted TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    last_login INTEGER NOT NULL,
+    tos_accepted INTEGER NOT NULL,
     balance INTEGER NOT NULL,
     theme TEXT NOT NULL,
     locale TEXT NOT NULL
@@ -24,14 +25,14 @@ CREATE TABLE IF NOT EXISTS users (
 CREATE TABLE IF NOT EXISTS sessions (
     id TEXT PRIMARY KEY,
     user_id TEXT NOT NULL,
-    created TEXT NOT NULL,
-    expires TEXT NOT NULL,
+    created INTEGER NOT NULL,
+    expires INTEGER NOT NULL,
     browser TEXT NOT NULL,
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
 CREATE TABLE IF NOT EXISTS used_totp (
     otp TEXT NOT NULL,
-    expiry TEXT NOT NULL,
+    expiry INTEGER NOT NULL,
     user_id TEXT NOT NULL,
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
@@ -47,10 +48,10 @@ CREATE TABLE IF NOT EXISTS partitions (
     name TEXT NOT NULL,
     owner_id TEXT NOT NULL,
     capacity INTEGER NOT NULL,
-    created TEXT NOT NULL,
-    edited TEXT NOT NULL,
-    viewed TEXT NOT NULL,
-    deleted TEXT NULL,  -- null if not deleted, else datetime
+    created INTEGER NOT NULL,
+    edited INTEGER NOT NULL,
+    viewed INTEGER NOT NULL,
+    deleted INTEGER NULL,  -- null if not deleted, else unix seconds
     hidden INTEGER NOT NULL, -- 0 for visible, 1 for hidden
     FOREIGN KEY (drive_id) REFERENCES drives(id),
     FOREIGN KEY (owner_id) REFERENCES users(id)
@@ -62,10 +63,10 @@ CREATE TABLE IF NOT EXISTS entries(
     parent_id TEXT NULL,  -- null if in root folder
     owner_id TEXT NOT NULL,
     partition_id TEXT NOT NULL,
-    created TEXT NOT NULL,
-    edited TEXT NOT NULL,
-    viewed TEXT NOT NULL,
-    deleted TEXT NULL,  -- null if not deleted, else datetime
+    created INTEGER NOT NULL,
+    edited INTEGER NOT NULL,
+    viewed INTEGER NOT NULL,
+    deleted INTEGER NULL,  -- null if not deleted, else unix seconds
     hidden INTEGER NOT NULL, -- 0 for visible, 1 for hidden
 
     -- file specific
@@ -88,7 +89,7 @@ CREATE TABLE IF NOT EXISTS tags(
     id TEXT PRIMARY KEY,
     name TEXT NOT NULL,
     description TEXT NOT NULL,
-    created TEXT NOT NULL,
+    created INTEGER NOT NULL,
     owner_id TEXT NOT NULL,
     FOREIGN KEY (owner_id) REFERENCES users(id)
 );
@@ -96,7 +97,7 @@ CREATE TABLE IF NOT EXISTS tag_relations(
     id TEXT PRIMARY KEY,
     tag_id TEXT NOT NULL,
     entry_id TEXT NOT NULL,
-    created TEXT NOT NULL,
+    created INTEGER NOT NULL,
     FOREIGN KEY (tag_id) REFERENCES tags(id),
     FOREIGN KEY (entry_id) REFERENCES entries(id)
 );
@@ -104,7 +105,7 @@ CREATE TABLE IF NOT EXISTS tag_tag_relations(
     id TEXT PRIMARY KEY,
     tag_id TEXT NOT NULL,
     parent_id TEXT NOT NULL,
-    created TEXT NOT NULL,
+    created INTEGER NOT NULL,
     FOREIGN KEY (tag_id) REFERENCES tags(id),
     FOREIGN KEY (parent_id) REFERENCES tags(id)
 );
@@ -113,7 +114,7 @@ CREATE TABLE IF NOT EXISTS entry_shares(
     entry_id TEXT NOT NULL,
     owner_id TEXT NOT NULL,
     user_id TEXT NOT NULL,
-    created TEXT NOT NULL,
+    created INTEGER NOT NULL,
     allow_write INTEGER NOT NULL,  -- 0 for read-only, 1 for read-write
     FOREIGN KEY (entry_id) REFERENCES entries(id),
     FOREIGN KEY (owner_id) REFERENCES users(id),
@@ -124,7 +125,7 @@ CREATE TABLE IF NOT EXISTS partition_shares(
     partition_id TEXT NOT NULL,
     owner_id TEXT NOT NULL,
     user_id TEXT NOT NULL,
-    created TEXT NOT NULL,
+    created INTEGER NOT NULL,
     allow_write INTEGER NOT NULL,  -- 0 for read-only, 1 for read-write
     FOREIGN KEY (partition_id) REFERENCES partitions(id),
     FOREIGN KEY (owner_id) REFERENCES users(id),
@@ -138,3 +139,93 @@ CREATE TABLE IF NOT EXISTS settings(
     type TEXT NOT NULL,
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
+CREATE TABLE IF NOT EXISTS upload_sessions(
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    partition_id TEXT NOT NULL,
+    parent_id TEXT NULL,  -- null if in root folder
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    created INTEGER NOT NULL,
+    expires INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'open',  -- 'open' or 'finalizing'
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (partition_id) REFERENCES partitions(id),
+    FOREIGN KEY (parent_id) REFERENCES entries(id)
+);
+CREATE TABLE IF NOT EXISTS upload_chunks(
+    upload_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    hash TEXT NOT NULL,  -- sha3_256 of the chunk
+    claimed INTEGER NULL,  -- time the chunk started to be written, null once it is on disk
+    PRIMARY KEY (upload_id, idx),
+    FOREIGN KEY (upload_id) REFERENCES upload_sessions(id)
+);
+CREATE INDEX IF NOT EXISTS entries_hash ON entries(hash);
+CREATE TABLE IF NOT EXISTS entry_closure(
+    ancestor_id TEXT NOT NULL,
+    descendant_id TEXT NOT NULL,
+    depth INTEGER NOT NULL,  -- 0 for the entry itself
+    PRIMARY KEY (ancestor_id, descendant_id),
+    FOREIGN KEY (ancestor_id) REFERENCES entries(id),
+    FOREIGN KEY (descendant_id) REFERENCES entries(id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entry_closure_descendant ON entry_closure(descendant_id, depth);
+CREATE INDEX IF NOT EXISTS users_email ON users(email);
+CREATE INDEX IF NOT EXISTS used_ids_reservations ON used_ids(created) WHERE table_name IS NOT NULL;
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions(expires);
+CREATE INDEX IF NOT EXISTS sessions_user ON sessions(user_id);
+CREATE INDEX IF NOT EXISTS used_totp_user_otp ON used_totp(user_id, otp);
+CREATE INDEX IF NOT EXISTS used_totp_expiry ON used_totp(expiry);
+CREATE INDEX IF NOT EXISTS partitions_owner ON partitions(owner_id);
+CREATE INDEX IF NOT EXISTS partitions_drive ON partitions(drive_id);
+CREATE INDEX IF NOT EXISTS entries_partition_parent ON entries(partition_id, parent_id, deleted);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries(parent_id, deleted, name);
+CREATE INDEX IF NOT EXISTS entries_deleted ON entries(deleted, id) WHERE deleted IS NOT NULL;
+CREATE INDEX IF NOT EXISTS entries_target ON entries(target_id) WHERE target_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS entries_target_partition ON entries(target_partition_id) WHERE target_partition_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS partitions_deleted ON partitions(deleted) WHERE deleted IS NOT NULL;
+CREATE INDEX IF NOT EXISTS tags_owner ON tags(owner_id);
+CREATE TABLE IF NOT EXISTS tag_closure(
+    ancestor_id TEXT NOT NULL,
+    descendant_id TEXT NOT NULL,
+    paths INTEGER NOT NULL,  -- amount of distinct paths from the ancestor down to the descendant, 1 for the tag itself
+    PRIMARY KEY (ancestor_id, descendant_id),
+    FOREIGN KEY (ancestor_id) REFERENCES tags(id),
+    FOREIGN KEY (descendant_id) REFERENCES tags(id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tag_closure_descendant ON tag_closure(descendant_id);
+CREATE INDEX IF NOT EXISTS tag_relations_tag ON tag_relations(tag_id, entry_id);
+CREATE INDEX IF NOT EXISTS tag_relations_entry ON tag_relations(entry_id, tag_id);
+CREATE INDEX IF NOT EXISTS tag_tag_relations_tag ON tag_tag_relations(tag_id, parent_id);
+CREATE INDEX IF NOT EXISTS tag_tag_relations_parent ON tag_tag_relations(parent_id, tag_id);
+CREATE INDEX IF NOT EXISTS entry_shares_entry_user ON entry_shares(entry_id, user_id, allow_write);
+CREATE INDEX IF NOT EXISTS entry_shares_user ON entry_shares(user_id);
+CREATE INDEX IF NOT EXISTS partition_shares_partition_user ON partition_shares(partition_id, user_id, allow_write);
+CREATE INDEX IF NOT EXISTS partition_shares_user ON partition_shares(user_id, partition_id);
+CREATE INDEX IF NOT EXISTS settings_user_key ON settings(user_id, key);
+CREATE INDEX IF NOT EXISTS upload_sessions_expires ON upload_sessions(expires);
+CREATE INDEX IF NOT EXISTS upload_sessions_partition ON upload_sessions(partition_id, expires);
+CREATE INDEX IF NOT EXISTS upload_sessions_parent ON upload_sessions(parent_id) WHERE parent_id IS NOT NULL;
+CREATE TABLE IF NOT EXISTS partition_usage(
+    partition_id TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL,  -- size of all files which are not deleted and not below a deleted folder
+    files INTEGER NOT NULL,
+    FOREIGN KEY (partition_id) REFERENCES partitions(id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS cache_generations(
+    name TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL  -- incremented whenever cached rows of this kind are invalidated
+);
+CREATE TABLE IF NOT EXISTS entry_search_rows(
+    id INTEGER PRIMARY KEY,  -- rowid of the entry in entry_search, stable across VACUUM
+    entry_id TEXT NOT NULL UNIQUE,
+    FOREIGN KEY (entry_id) REFERENCES entries(id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS entry_search USING fts5(
+    name,
+    tags,  -- names and descriptions of the tags of the entry
+    scope,  -- one trigram derived from the id of the partition, see search.scope_token
+    tokenize='trigram'
+);
@@ -0,0 +1,237 @@
+import typing as t
+
+from .main import query_db, query_db_in, transaction
+
+
+__all__ = [
+    'hierarchy_init',
+    'closure_insert',
+    'closure_move',
+    'closure_delete',
+    'is_descendant',
+    'rebuild_closure',
+    'check_closure',
+    'tag_closure_insert',
+    'tag_closure_link',
+    'tag_closure_unlink',
+    'is_tag_descendant',
+    'rebuild_tag_closure',
+]
+
+
+TAG_MAX_DEPTH = 64
+
+# every (ancestor, descendant) pair of the tag DAG with the amount of distinct paths between them, the argument is TAG_MAX_DEPTH.
+# each path is walked once, the depth limit stops the walk on cycles created before the table existed
+TAG_CLOSURE_FILL = (
+    'WITH RECURSIVE walk(ancestor_id, descendant_id, depth) AS ('
+    'SELECT id, id, 0 FROM tags '
+    'UNION ALL SELECT tag_tag_relations.parent_id, walk.descendant_id, walk.depth + 1 FROM walk '
+    'JOIN tag_tag_relations ON tag_tag_relations.tag_id=walk.ancestor_id WHERE walk.depth<?'
+    ') INSERT INTO tag_closure SELECT ancestor_id, descendant_id, COUNT(*) FROM walk WHERE true GROUP BY ancestor_id, descendant_id'
+)
+
+# every (ancestor, descendant) pair of the entries tree, including each entry with itself at depth 0
+EXPECTED_CLOSURE = (
+    'WITH RECURSIVE expected(ancestor_id, descendant_id, depth) AS ('
+    'SELECT id, id, 0 FROM entries WHERE partition_id=? '
+    'UNION ALL SELECT entries.parent_id, expected.descendant_id, expected.depth + 1 FROM expected JOIN entries ON entries.id=expected.ancestor_id '
+    'WHERE entries.parent_id IS NOT NULL'
+    ') '
+)
+# fills the closure rows of one partition, the argument is the id of the partition
+CLOSURE_FILL = f'INSERT OR IGNORE INTO entry_closure {EXPECTED_CLOSURE} SELECT ancestor_id, descendant_id, depth FROM expected'
+
+
+def closure_insert(entry_id: str, parent_id: t.Union[str,None]) -> None:
+    """
+    Adds a new entry to the closure table
+    :param entry_id: the id of the new entry
+    :param parent_id: the id of its parent, None if in root folder
+    :return:
+    """
+    query_db('INSERT OR IGNORE INTO entry_closure VALUES (?, ?, 0)', (entry_id, entry_id))
+    if parent_id:
+        query_db(
+            'INSERT OR IGNORE INTO entry_closure SELECT ancestor_id, ?, depth + 1 FROM entry_closure WHERE descendant_id=?',
+            (entry_id, parent_id)
+        )
+
+
+def is_descendant(entry_id: str, ancestor_id: str) -> bool:
+    """
+    Checks if an entry is inside a folder, at any depth
+    :param entry_id: the id of the entry
+    :param ancestor_id: the id of the folder
+    :return: True if the entry is the folder itself or below it
+    """
+    return bool(query_db('SELECT depth FROM entry_closure WHERE ancestor_id=? AND descendant_id=?', (ancestor_id, entry_id), True))
+
+
+def closure_move(entry_id: str, parent_id: t.Union[str,None]) -> None:
+    """
+    Re-links the subtree of an entry below a new parent
+    :param entry_id: the id of the moved entry
+    :param parent_id: the id of the new parent, None if moved to the root folder
+    :return:
+    """
+    if parent_id and is_descendant(parent_id, entry_id):
+        raise ValueError('An entry cannot be moved into itself')
+    query_db(
+        'DELETE FROM entry_closure WHERE descendant_id IN (SELECT descendant_id FROM entry_closure WHERE ancestor_id=?) '
+        'AND ancestor_id IN (SELECT ancestor_id FROM entry_closure WHERE descendant_id=? AND ancestor_id!=?)',
+        (entry_id, entry_id, entry_id)
+    )
+    if parent_id:
+        query_db(
+            'INSERT OR IGNORE INTO entry_closure SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1 '
+            'FROM entry_closure AS above JOIN entry_closure AS below WHERE above.descendant_id=? AND below.ancestor_id=?',
+            (parent_id, entry_id)
+        )
+
+
+def closure_delete(entry_ids: t.List[str]) -> None:
+    """
+    Removes hard-deleted entries from the closure table
+    :param entry_ids: the ids of the deleted entries
+    :return:
+    """
+    with transaction():
+        query_db_in('DELETE FROM entry_closure WHERE descendant_id IN ({})', entry_ids)
+        query_db_in('DELETE FROM entry_closure WHERE ancestor_id IN ({})', entry_ids)
+
+
+def rebuild_closure() -> int:
+    """
+    Recomputes the closure table from entries.parent_id, one partition per transaction
+    :return: the amount of rows in the rebuilt table
+    """
+    for row in query_db('SELECT id FROM partitions'):
+        with transaction():
+            query_db('DELETE FROM entry_closure WHERE descendant_id IN (SELECT id FROM entries WHERE partition_id=?)', (row[0],))
+            query_db(CLOSURE_FILL, (row[0],))
+    # rows of entries which do not exist anymore
+    query_db('DELETE FROM entry_closure WHERE descendant_id NOT IN (SELECT id FROM entries)')
+    return query_db('SELECT COUNT(*) FROM entry_closure', (), True)[0]
+
+
+def check_closure() -> t.Dict[str,int]:
+    """
+    Compares the closure table with the tree formed by entries.parent_id
+    :return: the amount of missing and superfluous rows
+    """
+    report = {'missing': 0, 'extra': 0}
+    for row in query_db('SELECT id FROM partitions'):
+        report['missing'] += query_db(
+            f'{EXPECTED_CLOSURE} SELECT COUNT(*) FROM (SELECT ancestor_id, descendant_id, depth FROM expected '
+            f'EXCEPT SELECT entry_closure.ancestor_id, entry_closure.descendant_id, entry_closure.depth FROM entry_closure JOIN entries ON entries.id=entry_closure.descendant_id WHERE entries.partition_id=?)',
+            (row[0], row[0]),
+            True
+        )[0]
+        report['extra'] += query_db(
+            f'{EXPECTED_CLOSURE} SELECT COUNT(*) FROM (SELECT entry_closure.ancestor_id, entry_closure.descendant_id, entry_closure.depth FROM entry_closure JOIN entries ON entries.id=entry_closure.descendant_id WHERE entries.partition_id=? '
+            f'EXCEPT SELECT ancestor_id, descendant_id, depth FROM expected)',
+            (row[0], row[0]),
+            True
+        )[0]
+    report['extra'] += query_db(
+        'SELECT COUNT(*) FROM entry_closure WHERE descendant_id NOT IN (SELECT id FROM entries) OR ancestor_id NOT IN (SELECT id FROM entries)',
+        (),
+        True
+    )[0]
+    return report
+
+
+def tag_closure_insert(tag_id: str) -> None:
+    """
+    Adds a new tag to the tag closure table
+    :param tag_id: the id of the new tag
+    :return:
+    """
+    query_db('INSERT OR IGNORE INTO tag_closure VALUES (?, ?, 1)', (tag_id, tag_id))
+
+
+def is_tag_descendant(tag_id: str, ancestor_id: str) -> bool:
+    """
+    Checks if a tag is below another tag, at any depth
+    :param tag_id: the id of the tag
+    :param ancestor_id: the id of the possible ancestor
+    :return: True if the tag is the ancestor itself or below it
+    """
+    return bool(query_db('SELECT paths FROM tag_closure WHERE ancestor_id=? AND descendant_id=?', (ancestor_id, tag_id), True))
+
+
+def _tag_link_pairs(tag_id: str, parent_id: str) -> t.List[tuple]:
+    # every ancestor of the parent combined with every descendant of the tag, weighted by the amount of paths the edge adds
+    return query_db(
+        'SELECT above.ancestor_id, below.descendant_id, above.paths * below.paths FROM tag_closure AS above JOIN tag_closure AS below '
+        'WHERE above.descendant_id=? AND below.ancestor_id=?',
+        (parent_id, tag_id)
+    )
+
+
+def tag_closure_link(tag_id: str, parent_id: str) -> None:
+    """
+    Adds the edge of a new tag_tag_relations row to the tag closure table
+    :param tag_id: the id of the child tag
+    :param parent_id: the id of the parent tag
+    :return:
+    """
+    if is_tag_descendant(parent_id, tag_id):
+        raise ValueError('A tag cannot be its own ancestor')
+    tag_closure_insert(tag_id)
+    tag_closure_insert(parent_id)
+    query_db(
+        'INSERT INTO tag_closure SELECT above.ancestor_id, below.descendant_id, above.paths * below.paths FROM tag_closure AS above JOIN tag_closure AS below '
+        'WHERE above.descendant_id=? AND below.ancestor_id=? '
+        'ON CONFLICT (ancestor_id, descendant_id) DO UPDATE SET paths=paths + excluded.paths',
+        (parent_id, tag_id)
+    )
+
+
+def tag_closure_unlink(tag_id: str, parent_id: str) -> None:
+    """
+    Removes the edge of a deleted tag_tag_relations row from the tag closure table, pairs still connected by another path stay
+    :param tag_id: the id of the child tag
+    :param parent_id: the id of the parent tag
+    :return:
+    """
+    with transaction():
+        for ancestor_id, descendant_id, paths in _tag_link_pairs(tag_id, parent_id):
+            query_db('UPDATE tag_closure SET paths=paths - ? WHERE ancestor_id=? AND descendant_id=?', (paths, ancestor_id, descendant_id))
+            query_db('DELETE FROM tag_closure WHERE ancestor_id=? AND descendant_id=? AND paths<=0', (ancestor_id, descendant_id))
+
+
+def rebuild_tag_closure() -> int:
+    """
+    Recomputes the tag closure table from tag_tag_relations
+    :return: the amount of rows in the rebuilt table
+    """
+    with transaction():
+        query_db('DELETE FROM tag_closure')
+        query_db(TAG_CLOSURE_FILL, (TAG_MAX_DEPTH,))
+    return query_db('SELECT COUNT(*) FROM tag_closure', (), True)[0]
+
+
+def hierarchy_init(app) -> None:
+    @app.cli.command('rebuild-hierarchy')
+    def rebuild_hierarchy() -> None:
+        """
+        Recomputes the entry closure table from scratch
+        """
+        print(f"rebuilt entry closure with {rebuild_closure()} rows")
+
+    @app.cli.command('check-hierarchy')
+    def check_hierarchy() -> None:
+        """
+        Reports differences between the entry closure table and entries.parent_id
+        """
+        report = check_closure()
+        print(f"{report['missing']} missing rows, {report['extra']} superfluous rows")
+
+    @app.cli.command('rebuild-tag-hierarchy')
+    def rebuild_tag_hierarchy() -> None:
+        """
+        Recomputes the tag closure table from scratch
+        """
+        print(f"rebuilt tag closure with {rebuild_tag_closure()} rows")
@@ -1,30 +1,162 @@
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from flask import g
-from os import path
+from os import environ, getpid, path
 from os.path import join
+from re import compile as re_compile, IGNORECASE
 from sqlite3 import connect as sqlite_connect, Connection as SQLite_Connection
+from threading import Condition
+from time import perf_counter
+import typing as t
+
+from ..util.logger import GetLogger
 
 
 __all__ = [
     'database_init',
     'get_db',
     'query_db',
+    'query_db_in',
+    'transaction',
+    'QUERY_BATCH_SIZE',
+    'explain_query',
+    'ConnectionPool',
+    'pool_stats',
 ]
 
 
 load_dotenv()
 
+QUERY_BATCH_SIZE = 500
+QUERY_PLAN_AUDIT = environ.get('QUERY_PLAN_AUDIT', '') == '1'
+# tables which grow with the amount of users, files or logins and must never be scanned on the request path
+LARGE_TABLES = {
+    'used_ids',
+    'users',
+    'sessions',
+    'used_totp',
+    'partitions',
+    'entries',
+    'entry_closure',
+    'entry_search_rows',
+    'tags',
+    'tag_closure',
+    'tag_relations',
+    'tag_tag_relations',
+    'entry_shares',
+    'partition_shares',
+    'settings',
+    'upload_sessions',
+    'upload_chunks',
+}
+# 'FROM table alias', 'JOIN table AS alias' and 'table AS alias' in a comma join, the query plan only names the alias
+TABLE_ALIAS = re_compile(r'(?:\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)|\b(\w+)\s+AS\s+(\w+))', IGNORECASE)
+SQL_KEYWORDS = {'AS', 'ON', 'USING', 'WHERE', 'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'CROSS', 'NATURAL', 'GROUP', 'ORDER', 'LIMIT', 'UNION', 'EXCEPT', 'INTERSECT', 'INDEXED', 'NOT', 'RETURNING', 'SET', 'WINDOW', 'HAVING'}
+
+# Use absolute path to ensure consistent database location
+DATABASE_PATH = environ.get('DATABASE_PATH', '') or path.join(path.dirname(path.abspath(__file__)), 'database.sqlite')
+DATABASE_POOL_SIZE = int(environ.get('DATABASE_POOL_SIZE', '8'))
+DATABASE_POOL_TIMEOUT = float(environ.get('DATABASE_POOL_TIMEOUT', '30'))
+DATABASE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f"PRAGMA cache_size=-{int(environ.get('DATABASE_CACHE_KIB', '65536'))}",
+    f"PRAGMA mmap_size={int(environ.get('DATABASE_MMAP_BYTES', str(256 * 1024 * 1024)))}",
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA foreign_keys=ON',
+    'PRAGMA temp_store=MEMORY',
+]
+
+_audited_queries = set()
+
+
+class ConnectionPool:
+
+    def __init__(self, database_path: str, size: int, timeout: float):
+        self._database_path = database_path
+        self._size = size
+        self._timeout = timeout
+        self._condition = Condition()
+        self._idle: t.List[SQLite_Connection] = []
+        self._open = 0
+        self._pid = getpid()
+        self._stats = {'opens': 0, 'reuses': 0, 'waits': 0, 'wait_time': 0.0}
+
+    def _connect(self) -> SQLite_Connection:
+        # connections move between the threads of a worker, but are only used by one thread at a time
+        conn = sqlite_connect(self._database_path, timeout=5, check_same_thread=False)
+        for pragma in DATABASE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _check_fork(self) -> None:
+        # connections must not be shared between worker processes forked after the pool was used
+        if self._pid != getpid():
+            self._pid = getpid()
+            self._idle = []
+            self._open = 0
+
+    def acquire(self) -> SQLite_Connection:
+        with self._condition:
+            self._check_fork()
+            if not self._idle and self._open >= self._size:
+                start = perf_counter()
+                self._stats['waits'] += 1
+                if not self._condition.wait_for(lambda: self._idle or self._open < self._size, self._timeout):
+                    raise TimeoutError('No database connection available')
+                self._stats['wait_time'] += perf_counter() - start
+            if self._idle:
+                self._stats['reuses'] += 1
+                return self._idle.pop()
+            self._open += 1
+            self._stats['opens'] += 1
+        try:
+            return self._connect()
+        except BaseException:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, conn: SQLite_Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        with self._condition:
+            if self._pid != getpid():
+                return
+            self._idle.append(conn)
+            self._condition.notify()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                **self._stats,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+                'size': self._size,
+            }
+
+
+_pool = ConnectionPool(DATABASE_PATH, DATABASE_POOL_SIZE, DATABASE_POOL_TIMEOUT)
+
+
+def pool_stats() -> dict:
+    """
+    Gets the usage statistics of the connection pool of this worker
+    :return: the amount of opened and reused connections, waits and the total time spent waiting in seconds
+    """
+    return _pool.stats()
+
 
 def get_db() -> SQLite_Connection:
     """
-    Gets the database instance
+    Gets the database instance, borrowed from the connection pool until the end of the app context
     :return: a pointer to the database
     """
     db = getattr(g, '_database', None)
     if db is None:
-        # Use absolute path to ensure consistent database location
-        db_path = path.join(path.dirname(path.abspath(__file__)), 'database.sqlite')
-        db = g._database = sqlite_connect(db_path)
+        db = g._database = _pool.acquire()
     return db
 
 
@@ -37,28 +169,111 @@ def query_db(query, args=(), one=False) -> list | tuple:
     :return: the data from the database
     """
     conn = get_db()
+    if QUERY_PLAN_AUDIT and query not in _audited_queries:
+        _audited_queries.add(query)
+        for detail in explain_query(query, args):
+            GetLogger('debug').warning(f"full scan ({detail}) in query: {query}")
     cur = conn.execute(query, args)
     result = cur.fetchall()
-    conn.commit()
+    # read-only statements do not open a transaction, writes are committed by the outermost transaction() if any
+    if conn.in_transaction and not g.get('_transaction_depth', 0):
+        conn.commit()
     cur.close()
     return (result[0] if result else None) if one else result
 
 
+@contextmanager
+def transaction() -> t.Iterator[SQLite_Connection]:
+    """
+    Runs all queries inside the block as one atomic unit with a single commit, nested blocks become savepoints
+    :return: a pointer to the database
+    """
+    conn = get_db()
+    depth = g.get('_transaction_depth', 0)
+    if depth:
+        conn.execute(f'SAVEPOINT transaction_{depth}')
+    else:
+        if conn.in_transaction:
+            conn.commit()
+        # take the write lock up front, upgrading a read transaction later could fail with SQLITE_BUSY
+        conn.execute('BEGIN IMMEDIATE')
+    g._transaction_depth = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        g._transaction_depth = depth
+        if depth:
+            conn.execute(f'ROLLBACK TO transaction_{depth}')
+            conn.execute(f'RELEASE transaction_{depth}')
+        else:
+            conn.rollback()
+        raise
+    g._transaction_depth = depth
+    if depth:
+        conn.execute(f'RELEASE transaction_{depth}')
+    else:
+        conn.commit()
+
+
+def explain_query(query, args=()) -> t.List[str]:
+    """
+    Finds the full table scans of large tables in the query plan of a statement
+    :param query: the query as a SQL statement
+    :param args: arguments to be inserted into the query
+    :return: the details of the offending steps of the query plan
+    """
+    aliases = {}
+    for table, alias, as_table, as_alias in TABLE_ALIAS.findall(query):
+        table, alias = (table, alias) if table else (as_table, as_alias)
+        if table in LARGE_TABLES and alias.upper() not in SQL_KEYWORDS:
+            aliases[alias] = table
+    plan = get_db().execute('EXPLAIN QUERY PLAN ' + query, args).fetchall()
+    result = []
+    for row in plan:
+        if not row[3].startswith('SCAN '):
+            continue
+        name = row[3].split(' ')[1]
+        if name in LARGE_TABLES:
+            result.append(row[3])
+        elif name in aliases:
+            result.append(f'{row[3]} ({aliases[name]})')
+    return result
+
+
+def query_db_in(query, values, args=()) -> list:
+    """
+    Runs a SQL query with an IN clause over many values, in batches to stay below the parameter limit of SQLite
+    :param query: the query as a SQL statement with `{}` in place of the IN placeholders
+    :param values: the values for the IN clause
+    :param args: arguments to be inserted into the query before the IN values
+    :return: the data from the database
+    """
+    values = list(values)
+    result = []
+    for i in range(0, len(values), QUERY_BATCH_SIZE):
+        batch = values[i:i + QUERY_BATCH_SIZE]
+        result += query_db(query.format(', '.join('?' * len(batch))), (*args, *batch))
+    return result
+
+
 def database_init(app) -> None:
     @app.teardown_appcontext
     def close_connection(exception=None) -> None:  # noqa
         """
-        destroys the database point
+        returns the database point to the connection pool
         :param exception: unused
         :return:
         """
-        db = getattr(g, '_database', None)
+        db = g.pop('_database', None)
         if db is not None:
-            db.close()
+            _pool.release(db)
+    # migrations share their queries with the modules which keep the derived tables up to date, which import this module
+    from .migrations import run_migrations
     with app.app_context():
         with open(join(app.root_path, 'database/create.sql'), 'r') as f:
             _create = f.read()
         _conn = get_db()
+        # migrations run first, create.sql may reference columns which they add
+        run_migrations(_conn, _create)
         _conn.executescript(_create)
         _conn.commit()
-        _conn.close()
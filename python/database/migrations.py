@@ -0,0 +1,236 @@
+from sqlite3 import Connection as SQLite_Connection
+import typing as t
+
+from .hierarchy import CLOSURE_FILL, TAG_CLOSURE_FILL, TAG_MAX_DEPTH
+from .search import ENTRY_TAG_TEXT, scope_token
+from .usage import PARTITION_USAGE
+
+__all__ = [
+    'SCHEMA_VERSION',
+    'run_migrations',
+]
+
+
+MIGRATION_BATCH_SIZE = 10000
+
+# columns which used to hold '%Y-%m-%d_%H-%M-%S' strings in local time and hold unix seconds since schema version 1
+EPOCH_COLUMNS = {
+    'used_ids': ['created'],
+    'users': ['created_at', 'last_login', 'tos_accepted'],
+    'sessions': ['created', 'expires'],
+    'used_totp': ['expiry'],
+    'partitions': ['created', 'edited', 'viewed', 'deleted'],
+    'entries': ['created', 'edited', 'viewed', 'deleted'],
+    'tags': ['created'],
+    'tag_relations': ['created'],
+    'tag_tag_relations': ['created'],
+    'entry_shares': ['created'],
+    'partition_shares': ['created'],
+    'upload_sessions': ['created', 'expires'],
+}
+
+
+def table_ddl(create_script: str, table: str) -> str:
+    """
+    Extracts the CREATE TABLE statement of a table from create.sql
+    :param create_script: the content of create.sql
+    :param table: the name of the table
+    :return: the statement
+    """
+    for statement in create_script.split(';'):
+        head = statement.strip().split('(', 1)[0].split()
+        if head[:5] == ['CREATE', 'TABLE', 'IF', 'NOT', 'EXISTS'] and head[5:] == [table]:
+            return statement.strip()
+        if head[:6] == ['CREATE', 'VIRTUAL', 'TABLE', 'IF', 'NOT', 'EXISTS'] and head[6:7] == [table]:
+            return statement.strip()
+    raise ValueError(f"No table {table} in create.sql")
+
+
+def epoch_expression(column: str) -> str:
+    # the 'utc' modifier treats the stored string as local time, just like datetime.timestamp() does
+    return (
+        f"CASE WHEN {column} IS NULL THEN NULL "
+        f"WHEN {column} GLOB '*_*' THEN CAST(strftime('%s', substr({column}, 1, 10) || ' ' || replace(substr({column}, 12), '-', ':'), 'utc') AS INTEGER) "
+        f"ELSE CAST({column} AS INTEGER) END"
+    )
+
+
+def migrate_epoch_timestamps(conn: SQLite_Connection, create_script: str) -> None:
+    """
+    Rebuilds every table with time columns as INTEGER, copying the rows in batches so readers are never blocked for long.
+    An interrupted run resumes from the last copied rowid.
+    :param conn: the database connection, outside a transaction
+    :param create_script: the content of create.sql
+    :return:
+    """
+    for table, columns in EPOCH_COLUMNS.items():
+        new_table = f'{table}_migrating'
+        info = conn.execute(f'PRAGMA table_info({table})').fetchall()
+        types = {row[1]: row[2].upper() for row in info}
+        resuming = bool(conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (new_table,)).fetchone())
+        if not info or (not resuming and all(types.get(column) == 'INTEGER' for column in columns)):
+            continue
+        if not resuming:
+            conn.execute(table_ddl(create_script, table).replace(f'EXISTS {table}', f'EXISTS {new_table}', 1))
+            conn.commit()
+        names = ', '.join(row[1] for row in info)
+        select = ', '.join(epoch_expression(row[1]) if row[1] in columns else row[1] for row in info)
+        copy = f'INSERT INTO {new_table} (rowid, {names}) SELECT rowid, {select} FROM {table} WHERE rowid > ? ORDER BY rowid'
+        while True:
+            last = conn.execute(f'SELECT max(rowid) FROM {new_table}').fetchone()[0] or 0
+            copied = conn.execute(f'{copy} LIMIT ?', (last, MIGRATION_BATCH_SIZE)).rowcount
+            conn.commit()
+            if copied < MIGRATION_BATCH_SIZE:
+                break
+        # rows written since the last batch are copied in the same transaction which swaps the tables
+        conn.execute('BEGIN IMMEDIATE')
+        last = conn.execute(f'SELECT max(rowid) FROM {new_table}').fetchone()[0] or 0
+        conn.execute(copy, (last,))
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {new_table} RENAME TO {table}')
+        conn.commit()
+
+
+# id prefixes and the tables holding their ids as of schema version 2
+ID_PREFIX_TABLES = {
+    'drive': 'drives',
+    'partition': 'partitions',
+    'entry': 'entries',
+    'user': 'users',
+    'tag': 'tags',
+    'upload': 'upload_sessions',
+}
+
+
+def migrate_id_reservations(conn: SQLite_Connection, create_script: str) -> None:
+    """
+    Adds used_ids.table_name and fills it for ids which are held by the primary key of their table, so they can be pruned
+    :param conn: the database connection, outside a transaction
+    :param create_script: unused
+    :return:
+    """
+    info = conn.execute('PRAGMA table_info(used_ids)').fetchall()
+    if not info:
+        return
+    if 'table_name' not in (row[1] for row in info):
+        conn.execute('ALTER TABLE used_ids ADD COLUMN table_name TEXT NULL')
+        conn.commit()
+    for class_, table in ID_PREFIX_TABLES.items():
+        if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone():
+            conn.execute(f"UPDATE used_ids SET table_name=? WHERE id IN (SELECT id FROM {table} WHERE id GLOB ?)", (table, f'{class_}#*'))
+            conn.commit()
+    if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sessions'").fetchone():
+        conn.execute("UPDATE used_ids SET table_name='sessions' WHERE id IN (SELECT id FROM sessions)")
+        conn.commit()
+
+
+def migrate_entry_closure(conn: SQLite_Connection, create_script: str) -> None:
+    """
+    Creates entry_closure and fills it from entries.parent_id, one partition per transaction.
+    Rows already written for new entries are kept.
+    :param conn: the database connection, outside a transaction
+    :param create_script: the content of create.sql
+    :return:
+    """
+    if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='entries'").fetchone():
+        return
+    conn.execute(table_ddl(create_script, 'entry_closure'))
+    conn.commit()
+    for partition_id, in conn.execute('SELECT DISTINCT partition_id FROM entries').fetchall():
+        conn.execute(CLOSURE_FILL, (partition_id,))
+        conn.commit()
+
+
+def migrate_search_index(conn: SQLite_Connection, create_script: str) -> None:
+    """
+    Creates the search index and indexes all entries which are not deleted
+    :param conn: the database connection, outside a transaction
+    :param create_script: the content of create.sql
+    :return:
+    """
+    exists = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE name IN ('entries', 'entry_search')")}
+    if 'entries' not in exists or 'entry_search' in exists:
+        return
+    conn.create_function('scope_token', 1, scope_token, deterministic=True)
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute(table_ddl(create_script, 'entry_search'))
+    conn.execute(table_ddl(create_script, 'entry_search_rows'))
+    conn.execute('INSERT INTO entry_search_rows (entry_id) SELECT id FROM entries WHERE deleted IS NULL ORDER BY id')
+    conn.execute(
+        f"INSERT INTO entry_search (rowid, name, tags, scope) SELECT entry_search_rows.id, entries.name, COALESCE({ENTRY_TAG_TEXT}, ''), scope_token(entries.partition_id) "
+        f"FROM entry_search_rows JOIN entries ON entries.id=entry_search_rows.entry_id"
+    )
+    conn.commit()
+
+
+def migrate_tag_closure(conn: SQLite_Connection, create_script: str) -> None:
+    """
+    Creates tag_closure and fills it from tag_tag_relations, counting the distinct paths of every pair
+    :param conn: the database connection, outside a transaction
+    :param create_script: the content of create.sql
+    :return:
+    """
+    if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='tag_tag_relations'").fetchone():
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute(table_ddl(create_script, 'tag_closure'))
+    conn.execute('DELETE FROM tag_closure')
+    conn.execute(TAG_CLOSURE_FILL, (TAG_MAX_DEPTH,))
+    conn.commit()
+
+
+def migrate_partition_usage(conn: SQLite_Connection, create_script: str) -> None:
+    """
+    Creates partition_usage and fills it from the entries tree, one partition per transaction
+    :param conn: the database connection, outside a transaction
+    :param create_script: the content of create.sql
+    :return:
+    """
+    if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='partitions'").fetchone():
+        return
+    conn.execute(table_ddl(create_script, 'partition_usage'))
+    conn.commit()
+    for partition_id, in conn.execute('SELECT id FROM partitions').fetchall():
+        conn.execute(
+            f'INSERT INTO partition_usage (partition_id, bytes, files) SELECT ?, * FROM ({PARTITION_USAGE}) WHERE true '
+            f'ON CONFLICT (partition_id) DO UPDATE SET bytes=excluded.bytes, files=excluded.files',
+            (partition_id, partition_id)
+        )
+        conn.commit()
+
+
+# the index of a migration plus one is the schema version it produces
+MIGRATIONS: t.List[t.Callable[[SQLite_Connection,str],None]] = [
+    migrate_epoch_timestamps,
+    migrate_id_reservations,
+    migrate_entry_closure,
+    migrate_search_index,
+    migrate_tag_closure,
+    migrate_partition_usage,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def run_migrations(conn: SQLite_Connection, create_script: str) -> int:
+    """
+    Brings an existing database up to SCHEMA_VERSION, tracked in PRAGMA user_version.
+    Runs before create.sql, which then adds missing tables and the indexes of rebuilt tables.
+    :param conn: the database connection, outside a transaction
+    :param create_script: the content of create.sql
+    :return: the amount of migrations which ran
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return 0
+    # tables are rebuilt, so other tables must keep referencing them by name
+    conn.execute('PRAGMA foreign_keys=OFF')
+    conn.execute('PRAGMA legacy_alter_table=ON')
+    try:
+        for i in range(version, SCHEMA_VERSION):
+            MIGRATIONS[i](conn, create_script)
+            conn.execute(f'PRAGMA user_version={i + 1}')
+            conn.commit()
+    finally:
+        conn.execute('PRAGMA legacy_alter_table=OFF')
+        conn.execute('PRAGMA foreign_keys=ON')
+    return SCHEMA_VERSION - version
@@ -0,0 +1,141 @@
+from click import option
+from os import environ, getpid
+from threading import Thread
+from time import sleep
+import typing as t
+
+from .main import pool_stats, query_db
+from ..security.hashing import hash_pool_stats
+from ..security.login import session_cache_stats
+from ..storage.upload import sweep_expired_uploads
+from ..util.logger import GetLogger
+from ..util.misc import now_timestamp
+
+
+__all__ = [
+    'retention_init',
+    'delete_expired',
+    'sweep_expired',
+    'table_sizes',
+    'worker_stats',
+]
+
+
+RETENTION_SWEEPER = environ.get('RETENTION_SWEEPER', '1') == '1'
+RETENTION_INTERVAL = float(environ.get('RETENTION_INTERVAL', '300'))
+RETENTION_BATCH_SIZE = int(environ.get('RETENTION_BATCH_SIZE', '500'))
+RETENTION_PAUSE = float(environ.get('RETENTION_PAUSE', '0.05'))
+# reservations of ids which are held by the primary key of their table are kept until the row had time to be saved
+ID_RESERVATION_TTL = 24 * 60 * 60
+
+# table -> condition on an indexed column, the argument is the cutoff computed by the lambda
+RETENTION_RULES: t.Dict[str,t.Tuple[str,t.Callable[[int],int]]] = {
+    'sessions': ('expires < ?', lambda now: now),
+    'used_totp': ('expiry < ?', lambda now: now),
+    'used_ids': ('table_name IS NOT NULL AND created < ?', lambda now: now - ID_RESERVATION_TTL),
+}
+
+_sweeper_pid: t.Union[int,None] = None
+
+
+def delete_expired(table: str, batch_size: int=RETENTION_BATCH_SIZE, pause: float=RETENTION_PAUSE) -> int:
+    """
+    Deletes the expired rows of a table in small transactions, so writers are never blocked for long
+    :param table: a table of RETENTION_RULES
+    :param batch_size: the amount of rows deleted per transaction
+    :param pause: seconds to sleep between batches
+    :return: the amount of deleted rows
+    """
+    condition, cutoff = RETENTION_RULES[table]
+    cutoff = cutoff(now_timestamp())
+    deleted = 0
+    while True:
+        count = len(query_db(
+            f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {condition} LIMIT ?) RETURNING rowid',
+            (cutoff, batch_size)
+        ))
+        deleted += count
+        if count < batch_size:
+            return deleted
+        sleep(pause)
+
+
+def sweep_expired(batch_size: int=RETENTION_BATCH_SIZE, pause: float=RETENTION_PAUSE) -> t.Dict[str,int]:
+    """
+    Deletes expired sessions, used TOTPs, stale id reservations and expired uploads along with their temporary files
+    :param batch_size: the amount of rows deleted per transaction
+    :param pause: seconds to sleep between batches
+    :return: the amount of deleted rows per table
+    """
+    deleted = {table: delete_expired(table, batch_size, pause) for table in RETENTION_RULES}
+    deleted['upload_sessions'] = sweep_expired_uploads(batch_size, pause)
+    return deleted
+
+
+def table_sizes() -> t.Dict[str,int]:
+    """
+    Counts the rows of the tables under retention and the size of the database file
+    :return: the amount of rows per table and the size of the database in bytes
+    """
+    sizes = {table: query_db(f'SELECT COUNT(*) FROM {table}', (), True)[0] for table in [*RETENTION_RULES, 'upload_sessions']}
+    page_size = query_db('PRAGMA page_size', (), True)[0]
+    sizes['database_bytes'] = query_db('PRAGMA page_count', (), True)[0] * page_size
+    sizes['free_bytes'] = query_db('PRAGMA freelist_count', (), True)[0] * page_size
+    return sizes
+
+
+def worker_stats() -> t.Dict[str,dict]:
+    """
+    Collects the usage statistics of the pools and caches of this worker process
+    :return: the statistics per pool or cache
+    """
+    return {
+        'database_pool': pool_stats(),
+        'session_cache': session_cache_stats(),
+        'hash_pool': hash_pool_stats(),
+    }
+
+
+def run_sweeper(app) -> None:
+    while True:
+        sleep(RETENTION_INTERVAL)
+        try:
+            with app.app_context():
+                deleted = sweep_expired()
+            if any(deleted.values()):
+                GetLogger('debug').info(f"retention sweep deleted {deleted}")
+        except Exception as e:
+            GetLogger('debug').warning(f"retention sweep failed: {e}")
+        # the counters live in the memory of each worker, so every worker logs its own
+        GetLogger('debug').info(f"worker {getpid()} stats: {worker_stats()}")
+
+
+def retention_init(app) -> None:
+    @app.before_request
+    def start_sweeper() -> None:
+        """
+        Starts the background sweeper in every worker process, threads do not survive a fork
+        :return:
+        """
+        global _sweeper_pid
+        if RETENTION_SWEEPER and _sweeper_pid != getpid():
+            _sweeper_pid = getpid()
+            Thread(target=run_sweeper, args=(app,), name='retention-sweeper', daemon=True).start()
+
+    @app.cli.command('sweep-expired')
+    @option('--batch-size', default=RETENTION_BATCH_SIZE, show_default=True, help='Rows deleted per transaction.')
+    @option('--pause', default=RETENTION_PAUSE, show_default=True, help='Seconds to sleep between batches.')
+    def sweep_expired_command(batch_size: int, pause: float) -> None:
+        """
+        Deletes expired sessions, used TOTPs, stale id reservations and expired uploads
+        """
+        for table, deleted in sweep_expired(batch_size, pause).items():
+            print(f"{table}: deleted {deleted} rows")
+
+    @app.cli.command('table-sizes')
+    def table_sizes_command() -> None:
+        """
+        Reports the size of the tables under retention and of the database
+        """
+        for name, size in table_sizes().items():
+            print(f"{name}: {size}")
@@ -0,0 +1,155 @@
+from hashlib import sha256
+from json import dumps as json_dumps
+from time import sleep
+import typing as t
+
+from .main import query_db, query_db_in, transaction
+
+
+__all__ = [
+    'search_init',
+    'search_index_entries',
+    'search_remove_entries',
+    'search_entries',
+    'rebuild_search_index',
+    'MIN_QUERY_LENGTH',
+    'ENTRY_TAG_TEXT',
+    'scope_token',
+]
+
+
+# the trigram tokenizer cannot match shorter substrings
+MIN_QUERY_LENGTH = 3
+SEARCH_BATCH_SIZE = 1000
+# an OR over more scope tokens costs more than filtering the matches afterwards
+MAX_SCOPE_TOKENS = 64
+# first character of the CJK unified ideographs block, scope tokens are three characters of 14 bits each from it
+SCOPE_TOKEN_BASE = 0x4E00
+# the names and descriptions of the tags of an entry, as one text
+ENTRY_TAG_TEXT = (
+    "(SELECT group_concat(tags.name || ' ' || tags.description, ' ') FROM tag_relations JOIN tags ON tags.id=tag_relations.tag_id "
+    "WHERE tag_relations.entry_id=entries.id)"
+)
+
+
+def scope_token(partition_id: str) -> str:
+    """
+    Derives the text of the scope column from a partition id. The trigram tokenizer folds case while partition ids are case-sensitive,
+    so the id itself cannot be matched. Three characters make exactly one trigram, restricting a query to a partition is a single term lookup.
+    Two partitions sharing a token only cost speed, access is decided by the exact partition filter.
+    :param partition_id: the id of the partition
+    :return: the token
+    """
+    n = int.from_bytes(sha256(partition_id.encode()).digest()[:6], 'big')
+    return ''.join(chr(SCOPE_TOKEN_BASE + (n >> (14 * i) & 0x3FFF)) for i in range(3))
+
+
+def _search_rowids(entry_ids: t.List[str]) -> t.Dict[str,int]:
+    rows = dict(query_db_in('SELECT entry_id, id FROM entry_search_rows WHERE entry_id IN ({})', entry_ids))
+    for entry_id in entry_ids:
+        if entry_id not in rows:
+            rows[entry_id] = query_db('INSERT INTO entry_search_rows (entry_id) VALUES (?) RETURNING id', (entry_id,), True)[0]
+    return rows
+
+
+def search_remove_entries(entry_ids: t.Iterable[str]) -> None:
+    """
+    Removes entries from the search index
+    :param entry_ids: the ids of the entries
+    :return:
+    """
+    entry_ids = list(entry_ids)
+    with transaction():
+        for row in query_db_in('DELETE FROM entry_search_rows WHERE entry_id IN ({}) RETURNING id', entry_ids):
+            query_db('DELETE FROM entry_search WHERE rowid=?', (row[0],))
+
+
+def search_index_entries(entry_ids: t.Iterable[str]) -> None:
+    """
+    Writes the name, the names and descriptions of the tags and the scope token of the partition of entries to the search index,
+    entries which are deleted or do not exist anymore are removed from it
+    :param entry_ids: the ids of the entries
+    :return:
+    """
+    entry_ids = list(entry_ids)
+    with transaction():
+        rows = query_db_in(
+            f"SELECT entries.id, entries.name, entries.partition_id, {ENTRY_TAG_TEXT} "
+            f"FROM entries WHERE entries.deleted IS NULL AND entries.id IN ({{}})",
+            entry_ids
+        )
+        indexed = {row[0] for row in rows}
+        search_remove_entries([entry_id for entry_id in entry_ids if entry_id not in indexed])
+        rowids = _search_rowids(list(indexed))
+        for entry_id, name, partition_id, tags in rows:
+            query_db('DELETE FROM entry_search WHERE rowid=?', (rowids[entry_id],))
+            query_db(
+                'INSERT INTO entry_search (rowid, name, tags, scope) VALUES (?, ?, ?, ?)',
+                (rowids[entry_id], name, tags or '', scope_token(partition_id))
+            )
+
+
+def _phrase(text: str) -> str:
+    # user input is matched as one literal phrase, never as FTS5 query syntax
+    return '"' + text.replace('"', '""') + '"'
+
+
+def search_entries(text: str, partition_ids: t.Iterable[str], limit: int=50, offset: int=0) -> t.List[str]:
+    """
+    Finds entries whose name or tags contain a substring.
+    Matches in the name come before matches in the tags only, shorter names first, which is the order bm25 gives a single phrase.
+    bm25 itself counts the matches in the whole index first, which makes common words slow no matter how few the caller can access.
+    :param text: the substring, at least MIN_QUERY_LENGTH characters
+    :param partition_ids: the partitions to search in
+    :param limit: the maximum amount of results
+    :param offset: the amount of results to skip
+    :return: the ids of the matching entries
+    """
+    partition_ids = list(partition_ids)
+    if len(text) < MIN_QUERY_LENGTH:
+        raise ValueError(f"The search text must be at least {MIN_QUERY_LENGTH} characters long")
+    if not partition_ids:
+        return []
+    expression = f'{{name tags}}: {_phrase(text)}'
+    # the scope keeps the full-text query to the rows of the caller, access is decided by the exact partition of the entry
+    if len(partition_ids) <= MAX_SCOPE_TOKENS:
+        expression += f" AND scope: ({' OR '.join(_phrase(scope_token(partition_id)) for partition_id in partition_ids)})"
+    return [row[0] for row in query_db(
+        'SELECT entry_search_rows.entry_id FROM entry_search JOIN entry_search_rows ON entry_search_rows.id=entry_search.rowid '
+        'JOIN entries ON entries.id=entry_search_rows.entry_id '
+        'WHERE entry_search MATCH ? AND entries.partition_id IN (SELECT value FROM json_each(?)) AND entries.deleted IS NULL '
+        'ORDER BY instr(lower(entry_search.name), lower(?))=0, length(entry_search.name), entry_search.rowid LIMIT ? OFFSET ?',
+        (expression, json_dumps(partition_ids), text, limit, offset)
+    )]
+
+
+def rebuild_search_index(batch_size: int=SEARCH_BATCH_SIZE, pause: float=0.0) -> int:
+    """
+    Indexes all entries again, in batches
+    :param batch_size: the amount of entries per transaction
+    :param pause: seconds to sleep between batches
+    :return: the amount of indexed entries
+    """
+    with transaction():
+        query_db('DELETE FROM entry_search')
+        query_db('DELETE FROM entry_search_rows')
+    count = 0
+    last = ''
+    while True:
+        entry_ids = [row[0] for row in query_db('SELECT id FROM entries WHERE id>? AND deleted IS NULL ORDER BY id LIMIT ?', (last, batch_size))]
+        search_index_entries(entry_ids)
+        count += len(entry_ids)
+        if len(entry_ids) < batch_size:
+            query_db("INSERT INTO entry_search (entry_search) VALUES ('optimize')")
+            return count
+        last = entry_ids[-1]
+        sleep(pause)
+
+
+def search_init(app) -> None:
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command() -> None:
+        """
+        Indexes the names and tags of all entries again
+        """
+        print(f"indexed {rebuild_search_index()} entries")
@@ -0,0 +1,90 @@
+import typing as t
+
+from .classes.entry import Entry
+from .main import query_db
+
+
+__all__ = [
+    'MAX_EXPRESSION_TAGS',
+    'compile_expression',
+    'query_tagged_entries',
+]
+
+
+MAX_EXPRESSION_TAGS = 64
+MAX_PAGE_SIZE = 1000
+
+# entries tagged with the tag or any tag below it
+TAGGED_WITH_DESCENDANTS = (
+    'SELECT tag_relations.entry_id AS id FROM tag_closure JOIN tag_relations ON tag_relations.tag_id=tag_closure.descendant_id '
+    'WHERE tag_closure.ancestor_id=?'
+)
+TAGGED_EXACTLY = 'SELECT tag_relations.entry_id AS id FROM tag_relations WHERE tag_relations.tag_id=?'
+ALL_ENTRIES = 'SELECT entries.id AS id FROM entries WHERE entries.partition_id=? AND entries.deleted IS NULL'
+
+
+def _combine(operator: str, parts: t.List[t.Tuple[str,list]]) -> t.Tuple[str,list]:
+    # SQLite does not allow parentheses around the members of a compound select, so each member becomes a subquery
+    return f' {operator} '.join(f'SELECT id FROM ({sql})' for sql, _ in parts), [arg for _, args in parts for arg in args]
+
+
+def compile_expression(expression: t.Any, partition_id: str, counter: t.Union[t.List[int],None]=None) -> t.Tuple[str,list]:
+    """
+    Compiles a tag expression to a query for the ids of the matching entries.
+    An expression is a tag id, {"tag": id, "descendants": bool}, {"and": [...]}, {"or": [...]} or {"not": expression}.
+    A tag matches entries tagged with it or, unless descendants is false, with any tag below it.
+    :param expression: the expression, as decoded from JSON
+    :param partition_id: the partition which NOT is evaluated against
+    :param counter: the amount of tags compiled so far, used internally
+    :return: the query and its arguments
+    :raises ValueError: if the expression is malformed or too large
+    """
+    if counter is None:
+        counter = [0]
+    if isinstance(expression, str):
+        expression = {'tag': expression}
+    if not isinstance(expression, dict) or (len(expression) != 1 and 'tag' not in expression):
+        raise ValueError('Invalid tag expression')
+    if 'tag' in expression:
+        counter[0] += 1
+        if counter[0] > MAX_EXPRESSION_TAGS or not isinstance(expression['tag'], str):
+            raise ValueError('Invalid tag expression')
+        return (TAGGED_WITH_DESCENDANTS if expression.get('descendants', True) else TAGGED_EXACTLY), [expression['tag']]
+    if 'not' in expression:
+        return _combine('EXCEPT', [(ALL_ENTRIES, [partition_id]), compile_expression(expression['not'], partition_id, counter)])
+    operator, children = next(iter(expression.items()))
+    if operator not in ('and', 'or') or not isinstance(children, list) or not children:
+        raise ValueError('Invalid tag expression')
+    if operator == 'or':
+        return _combine('UNION', [compile_expression(child, partition_id, counter) for child in children])
+    # negated members are subtracted from the intersection of the others instead of being complemented on their own
+    positive = [child for child in children if not (isinstance(child, dict) and 'not' in child)]
+    negative = [child['not'] for child in children if isinstance(child, dict) and 'not' in child]
+    if positive:
+        result = _combine('INTERSECT', [compile_expression(child, partition_id, counter) for child in positive])
+    else:
+        result = ALL_ENTRIES, [partition_id]
+    if negative:
+        result = _combine('EXCEPT', [result, *(compile_expression(child, partition_id, counter) for child in negative)])
+    return result
+
+
+def query_tagged_entries(partition_id: str, expression: t.Any, limit: int=100, after: t.Union[str,None]=None) -> t.Tuple[t.List[Entry],t.Union[str,None]]:
+    """
+    Finds the entries of a partition which match a tag expression, one page at a time
+    :param partition_id: the id of the partition
+    :param expression: the expression, see compile_expression
+    :param limit: the maximum amount of entries per page
+    :param after: the cursor returned with the previous page, None for the first page
+    :return: the entries ordered by id and the cursor of the next page, None if this is the last page
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    sql, args = compile_expression(expression, partition_id)
+    result = Entry.from_rows(query_db(
+        f'SELECT {Entry.COLUMNS} FROM entries WHERE entries.id IN ({sql}) AND entries.partition_id=? AND entries.deleted IS NULL AND entries.id>? '
+        f'ORDER BY entries.id LIMIT ?',
+        (*args, partition_id, after or '', limit + 1)
+    ))
+    if len(result) > limit:
+        return result[:limit], result[limit - 1].id_
+    return result, None
@@ -0,0 +1,152 @@
+from click import option
+from time import sleep
+import typing as t
+
+from .main import query_db, transaction
+from ..util.misc import now_timestamp
+
+
+__all__ = [
+    'usage_init',
+    'subtree_usage',
+    'apply_usage_delta',
+    'partition_usage',
+    'free_space',
+    'has_capacity',
+    'reconcile_usage',
+    'PARTITION_USAGE',
+]
+
+
+USAGE_BATCH_SIZE = 100
+# the bytes and amount of files of a partition, the argument is the id of the partition.
+# walks the tree instead of entry_closure, so drift of the closure table cannot hide drift of the counters
+PARTITION_USAGE = (
+    "WITH RECURSIVE visible(id) AS ("
+    "SELECT id FROM entries WHERE partition_id=? AND parent_id IS NULL AND deleted IS NULL "
+    "UNION ALL SELECT entries.id FROM visible JOIN entries ON entries.parent_id=visible.id WHERE entries.deleted IS NULL"
+    ") SELECT COALESCE(SUM(entries.size), 0), COUNT(*) FROM visible JOIN entries ON entries.id=visible.id WHERE entries.type='file'"
+)
+
+
+def subtree_usage(entry_id: str) -> t.Dict[str,t.Tuple[int,int]]:
+    """
+    Sums the files an entry contributes to the usage of its partition:
+    itself if it is a file, else all files below it, skipping deleted entries and everything below them
+    :param entry_id: the id of the entry
+    :return: the bytes and amount of files per partition id
+    """
+    return {row[0]: (row[1], row[2]) for row in query_db(
+        "SELECT entries.partition_id, COALESCE(SUM(entries.size), 0), COUNT(*) FROM entry_closure AS below JOIN entries ON entries.id=below.descendant_id "
+        "WHERE below.ancestor_id=? AND entries.type='file' AND entries.deleted IS NULL AND NOT EXISTS ("
+        "SELECT 1 FROM entry_closure AS above JOIN entries AS ancestor ON ancestor.id=above.ancestor_id "
+        "WHERE above.descendant_id=below.descendant_id AND above.depth>0 AND ancestor.deleted IS NOT NULL"
+        ") GROUP BY entries.partition_id",
+        (entry_id,)
+    )}
+
+
+def apply_usage_delta(before: t.Dict[str,t.Tuple[int,int]], after: t.Dict[str,t.Tuple[int,int]]) -> None:
+    """
+    Updates the usage counters by the difference of two results of subtree_usage, inside the transaction of the change
+    :param before: the usage before the change
+    :param after: the usage after the change
+    :return:
+    """
+    for partition_id in before.keys() | after.keys():
+        old_bytes, old_files = before.get(partition_id, (0, 0))
+        new_bytes, new_files = after.get(partition_id, (0, 0))
+        if (old_bytes, old_files) != (new_bytes, new_files):
+            query_db(
+                'INSERT INTO partition_usage VALUES (?, ?, ?) '
+                'ON CONFLICT (partition_id) DO UPDATE SET bytes=bytes + excluded.bytes, files=files + excluded.files',
+                (partition_id, new_bytes - old_bytes, new_files - old_files)
+            )
+
+
+def partition_usage(partition_id: str) -> t.Tuple[int,int]:
+    """
+    Gets the usage counters of a partition
+    :param partition_id: the id of the partition
+    :return: the bytes and amount of files which are not deleted
+    """
+    return query_db('SELECT bytes, files FROM partition_usage WHERE partition_id=?', (partition_id,), True) or (0, 0)
+
+
+def free_space(partition_id: str) -> t.Union[int,None]:
+    """
+    Computes the free space of a partition, counting the space reserved by unfinished uploads as used
+    :param partition_id: the id of the partition
+    :return: the free bytes, None if the partition has no capacity limit
+    """
+    db_result = query_db(
+        'SELECT partitions.capacity, '
+        '(SELECT bytes FROM partition_usage WHERE partition_id=partitions.id), '
+        '(SELECT SUM(size) FROM upload_sessions WHERE partition_id=partitions.id AND expires>?) '
+        'FROM partitions WHERE partitions.id=?',
+        (now_timestamp(), partition_id),
+        True
+    )
+    if not db_result:
+        return 0
+    capacity, used, reserved = db_result
+    # a capacity of 0 means the partition is not limited
+    if capacity <= 0:
+        return None
+    return capacity - (used or 0) - (reserved or 0)
+
+
+def has_capacity(partition_id: str, size: int) -> bool:
+    """
+    Checks if a file fits into a partition, counting the space reserved by unfinished uploads
+    :param partition_id: the id of the partition
+    :param size: the size of the new file in bytes
+    :return: True if the file fits or the partition has no capacity limit
+    """
+    free = free_space(partition_id)
+    return free is None or size <= free
+
+
+def reconcile_usage(batch_size: int=USAGE_BATCH_SIZE, pause: float=0.0, dry_run: bool=False) -> t.Dict[str,int]:
+    """
+    Recomputes the usage counters from the entries tree, one partition per transaction
+    :param batch_size: the amount of partitions loaded per query
+    :param pause: seconds to sleep between batches
+    :param dry_run: only report the drift
+    :return: the amount of checked and drifted partitions and the total drift in bytes and files
+    """
+    report = {'partitions': 0, 'drifted': 0, 'bytes': 0, 'files': 0}
+    last = ''
+    while True:
+        partition_ids = [row[0] for row in query_db('SELECT id FROM partitions WHERE id>? ORDER BY id LIMIT ?', (last, batch_size))]
+        for partition_id in partition_ids:
+            with transaction():
+                expected = query_db(PARTITION_USAGE, (partition_id,), True)
+                actual = partition_usage(partition_id)
+                report['partitions'] += 1
+                if tuple(expected) != tuple(actual):
+                    report['drifted'] += 1
+                    report['bytes'] += abs(expected[0] - actual[0])
+                    report['files'] += abs(expected[1] - actual[1])
+                    if not dry_run:
+                        query_db(
+                            'INSERT INTO partition_usage VALUES (?, ?, ?) ON CONFLICT (partition_id) DO UPDATE SET bytes=excluded.bytes, files=excluded.files',
+                            (partition_id, expected[0], expected[1])
+                        )
+        if len(partition_ids) < batch_size:
+            return report
+        last = partition_ids[-1]
+        sleep(pause)
+
+
+def usage_init(app) -> None:
+    @app.cli.command('reconcile-usage')
+    @option('--batch-size', default=USAGE_BATCH_SIZE, show_default=True, help='Partitions loaded per query.')
+    @option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+    @option('--dry-run', is_flag=True, help='Only report the drift.')
+    def reconcile_usage_command(batch_size: int, pause: float, dry_run: bool) -> None:
+        """
+        Recomputes the usage counters of all partitions and reports drift
+        """
+        report = reconcile_usage(batch_size, pause, dry_run)
+        print(f"checked {report['partitions']} partitions, {report['drifted']} drifted by {report['bytes']} bytes and {report['files']} files")
@@ -0,0 +1,133 @@
+from click import option
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from hashlib import pbkdf2_hmac
+from os import cpu_count, environ, getpid, urandom
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+import typing as t
+
+
+__all__ = [
+    'hashing_init',
+    'HashingBusy',
+    'pbkdf2',
+    'hash_pool_stats',
+    'calibrate_iterations',
+]
+
+
+load_dotenv()
+
+HASH_POOL_SIZE = int(environ.get('HASH_POOL_SIZE', '') or max(1, (cpu_count() or 2) // 2))
+HASH_QUEUE_DEPTH = int(environ.get('HASH_QUEUE_DEPTH', '') or 2 * HASH_POOL_SIZE)
+HASH_RETRY_AFTER = 1
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class HashPool:
+
+    def __init__(self, size: int, queue_depth: int):
+        self._size = size
+        self._queue_depth = queue_depth
+        self._lock = Lock()
+        self._executor: t.Union[ThreadPoolExecutor,None] = None
+        self._slots = BoundedSemaphore(size + queue_depth)
+        self._pid = getpid()
+        self._stats = {'submitted': 0, 'rejected': 0}
+        # request threads update the counters concurrently, += on a dict item is not atomic
+        self._stats_lock = Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            # worker threads do not survive a fork, each process gets its own pool
+            if self._executor is None or self._pid != getpid():
+                self._pid = getpid()
+                self._slots = BoundedSemaphore(self._size + self._queue_depth)
+                self._executor = ThreadPoolExecutor(self._size, thread_name_prefix='hash')
+            return self._executor
+
+    def run(self, function: t.Callable, *args) -> t.Any:
+        executor = self._get_executor()
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            with self._stats_lock:
+                self._stats['rejected'] += 1
+            raise HashingBusy('Too many password hashes in progress')
+        with self._stats_lock:
+            self._stats['submitted'] += 1
+        try:
+            future = executor.submit(function, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future.result()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {**self._stats, 'size': self._size, 'queue_depth': self._queue_depth}
+
+
+_pool = HashPool(HASH_POOL_SIZE, HASH_QUEUE_DEPTH)
+
+
+def pbkdf2(password: bytes, salt: bytes, iterations: int) -> bytes:
+    """
+    Derives a password hash on the bounded hash pool, so a burst of logins cannot occupy every request thread
+    :param password: the peppered password
+    :param salt: the salt
+    :param iterations: the amount of iterations
+    :return: the derived key
+    :raises HashingBusy: if the pool and its queue are full
+    """
+    return _pool.run(pbkdf2_hmac, 'sha3_512', password, salt, iterations)
+
+
+def hash_pool_stats() -> dict:
+    """
+    Gets the usage statistics of the hash pool of this worker
+    :return: the amount of submitted and rejected hashes and the size of the pool
+    """
+    return _pool.stats()
+
+
+def calibrate_iterations(target: float, samples: int=3) -> t.Tuple[int,float]:
+    """
+    Finds the amount of iterations which takes about the target time on this host
+    :param target: the target latency of one hash in seconds
+    :param samples: the amount of measurements to take the fastest of
+    :return: the amount of iterations and the measured latency in seconds
+    """
+    def measure(iterations: int) -> float:
+        password, salt = urandom(32), urandom(32)
+        fastest = float('inf')
+        for _ in range(samples):
+            start = perf_counter()
+            pbkdf2_hmac('sha3_512', password, salt, iterations)
+            fastest = min(fastest, perf_counter() - start)
+        return fastest
+
+    iterations = 10000
+    elapsed = measure(iterations)
+    # grow the probe until it is long enough to extrapolate from reliably
+    while elapsed < target / 4:
+        iterations *= 4
+        elapsed = measure(iterations)
+    iterations = max(1, round(iterations * target / elapsed))
+    return iterations, measure(iterations)
+
+
+def hashing_init(app) -> None:
+    @app.cli.command('calibrate-hash')
+    @option('--target-ms', default=250.0, show_default=True, help='Target latency of one password hash.')
+    @option('--samples', default=3, show_default=True, help='Measurements per probe, the fastest is used.')
+    def calibrate_hash(target_ms: float, samples: int) -> None:
+        """
+        Suggests a value for HASH_ITERATIONS which takes the target latency on this host
+        """
+        iterations, elapsed = calibrate_iterations(target_ms / 1000, samples)
+        print(f"HASH_ITERATIONS={iterations}  # {elapsed * 1000:.0f} ms per hash, current: {environ.get('HASH_ITERATIONS', 'unset')}")
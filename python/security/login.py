@@ -2,18 +2,20 @@ from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from flask import request, session, Blueprint
-from hashlib import pbkdf2_hmac
 from logging import log
 from os import environ
 from pydantic import BaseModel, ValidationError
 from pyotp import TOTP
 from secrets import randbelow
 from time import sleep
-from user_agents import parse
 
+from .hashing import pbkdf2, HashingBusy, HASH_RETRY_AFTER
+from .totp import claim_totp
+from .user_agent import user_agent_fingerprint
 from ..database.classes.user import User
-from ..database.main import query_db
-from ..util.misc import DATE_FORMAT
+from ..database.main import query_db, transaction
+from ..util.cache import LRUCache
+from ..util.misc import now_timestamp
 from ..util.rand import rand_base64, rand_salt
 
 
@@ -27,44 +29,62 @@ load_dotenv()
 
 
 def hash_password(password: str, salt: str):
-    return urlsafe_b64encode(pbkdf2_hmac(
-        hash_name='sha3_512',
+    return urlsafe_b64encode(pbkdf2(
         password=urlsafe_b64decode(environ['HASH_PEPPER_1']) + password.encode() + urlsafe_b64decode(environ['HASH_PEPPER_2']),
         salt=urlsafe_b64decode(salt),
         iterations=int(environ['HASH_ITERATIONS']),
     )).decode()
 
 
-def is_totp_used(user_id: str, otp: str) -> bool:
-    cleanup_expired_totps()
-    result = query_db('SELECT otp FROM used_totp WHERE user_id=? AND otp=?', (user_id, otp), True)
-    return result is not None
+busy_error = {'error': 'busy', 'message': 'Too many requests, please try again.'}, 503, {'Retry-After': str(HASH_RETRY_AFTER)}
 
 
-def store_used_totp(user_id: str, otp: str) -> None:
-    expiry = (datetime.now() + timedelta(minutes=2)).strftime(DATE_FORMAT)
-    query_db('INSERT INTO used_totp (otp, expiry, user_id) VALUES (?, ?, ?)', (otp, expiry, user_id))
+SESSION_CACHE_SIZE = int(environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL = float(environ.get('SESSION_CACHE_TTL', '60'))
 
-
-def cleanup_expired_totps() -> None:
-    now = datetime.now().strftime(DATE_FORMAT)
-    query_db('DELETE FROM used_totp WHERE expiry < ?', (now,))
+# token -> (user id, expiry, browser fingerprint)
+_session_cache = LRUCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+_session_generation = 0
 
 
 def parse_login_user_agent() -> str:
-    ua = parse(request.headers.get('User-Agent', ''))
-    os_name = ua.os.family or 'Unknown'
-    browser_name = ua.browser.family or 'Unknown'
-    return f"{os_name.replace(' ', '')}-{browser_name.replace(' ', '')}"
+    return user_agent_fingerprint(request.headers.get('User-Agent', ''))
+
+
+def sessions_generation() -> int:
+    result = query_db("SELECT generation FROM cache_generations WHERE name='sessions'", (), True)
+    return result[0] if result else 0
+
+
+def bump_sessions_generation() -> None:
+    query_db("INSERT INTO cache_generations VALUES ('sessions', 1) ON CONFLICT(name) DO UPDATE SET generation=generation+1")
+
+
+def session_cache_stats() -> dict:
+    """
+    Gets the usage statistics of the session cache of this worker
+    :return: the hits, misses and size of the cache
+    """
+    return _session_cache.stats()
 
 
 def get_user_id(no_invalidation=False):
-    if 'token' in session:
+    global _session_generation
+    if 'token' in session and session['token']:
+        # a cheap primary key lookup tells if any worker invalidated a session since the cache was filled
+        generation = sessions_generation()
+        if generation != _session_generation:
+            _session_cache.clear()
+            _session_generation = generation
+        cached = _session_cache.get(session['token'])
+        if cached and cached[1] > now_timestamp() and cached[2] == parse_login_user_agent():
+            return cached[0]
         db_result = query_db('SELECT id, user_id, created, expires, browser FROM sessions WHERE id=?', (session['token'],), True)
         if db_result:
-            if db_result[3] > datetime.now().strftime(DATE_FORMAT):
+            if db_result[3] > now_timestamp():
                 if db_result[4] == parse_login_user_agent():
                     if query_db('SELECT id FROM users WHERE id=?', (db_result[1],), True):
+                        _session_cache.put(session['token'], (db_result[1], db_result[3], db_result[4]), db_result[3] - now_timestamp())
                         return db_result[1]
                     elif not no_invalidation:
                         invalidate_session()
@@ -74,13 +94,17 @@ def get_user_id(no_invalidation=False):
 
 
 def create_session(user_id: str):
-    session['token'] = rand_base64(64)
-    query_db('INSERT INTO sessions (id, user_id, created, expires, browser) VALUES (?, ?, ?, ?, ?)', (session['token'], user_id, datetime.now().strftime(DATE_FORMAT), (datetime.now() + timedelta(days=32)).strftime(DATE_FORMAT), parse_login_user_agent()))
+    session['token'] = rand_base64(64, 'sessions')
+    now = now_timestamp()
+    query_db('INSERT INTO sessions (id, user_id, created, expires, browser) VALUES (?, ?, ?, ?, ?)', (session['token'], user_id, now, now + int(timedelta(days=32).total_seconds()), parse_login_user_agent()))
 
 
 def invalidate_session():
     if 'token' in session:
-        query_db('UPDATE sessions SET expires=? WHERE id=?', (datetime.now().strftime(DATE_FORMAT), session['token']))
+        _session_cache.pop(session['token'])
+        with transaction():
+            query_db('UPDATE sessions SET expires=? WHERE id=?', (now_timestamp(), session['token']))
+            bump_sessions_generation()
     session['token'] = ''
 
 
@@ -106,14 +130,17 @@ def r_login():
         return authentication_error
     user_id: str = user_id[0]
     user = User.load(user_id)
-    if user.password != hash_password(login_data['password'], user.salt):
+    try:
+        password_hash = hash_password(login_data['password'], user.salt)
+    except HashingBusy:
+        return busy_error
+    if user.password != password_hash:
         return authentication_error
-    if is_totp_used(user_id, login_data['totp']):
+    # invalid codes are claimed too, so each code can only be tried once
+    if not claim_totp(user_id, login_data['totp']):
         return authentication_error
     totp = TOTP(user.totp)
-    totp_valid = totp.verify(login_data['totp'], valid_window=1)
-    store_used_totp(user_id, login_data['totp'])
-    if not totp_valid:
+    if not totp.verify(login_data['totp'], valid_window=1):
         return authentication_error
     create_session(user_id)
     user.last_login = datetime.now()
@@ -147,7 +174,10 @@ def r_hash__password():
     if not password:
         return {'error': 'Password is required'}, 400
     salt = rand_salt()
-    hashed_password = hash_password(password, salt)
+    try:
+        hashed_password = hash_password(password, salt)
+    except HashingBusy:
+        return busy_error
     return {
         'success': 'success',
         'salt': salt,
@@ -0,0 +1,69 @@
+from threading import Lock
+from time import time
+import typing as t
+
+from ..database.main import query_db
+from ..util.misc import now_timestamp
+
+
+__all__ = [
+    'TOTP_REPLAY_WINDOW',
+    'TOTPReplayCache',
+    'claim_totp',
+]
+
+
+# a code is valid for its own 30 second step and one step on each side
+TOTP_REPLAY_WINDOW = 2 * 60
+TOTP_BUCKET_SECONDS = 30
+
+
+class TOTPReplayCache:
+
+    def __init__(self, window: int, bucket_seconds: int):
+        self._window = window
+        self._bucket_seconds = bucket_seconds
+        self._buckets: t.Dict[int,t.Set[t.Tuple[str,str]]] = {}
+        self._lock = Lock()
+
+    def _expire(self, now: float) -> None:
+        oldest = int(now - self._window) // self._bucket_seconds
+        for bucket in [bucket for bucket in self._buckets if bucket < oldest]:
+            del self._buckets[bucket]
+
+    def __contains__(self, key: t.Tuple[str,str]) -> bool:
+        with self._lock:
+            self._expire(time())
+            return any(key in bucket for bucket in self._buckets.values())
+
+    def add(self, key: t.Tuple[str,str]) -> None:
+        now = time()
+        with self._lock:
+            self._expire(now)
+            self._buckets.setdefault(int(now) // self._bucket_seconds, set()).add(key)
+
+
+_used_totps = TOTPReplayCache(TOTP_REPLAY_WINDOW, TOTP_BUCKET_SECONDS)
+
+
+def claim_totp(user_id: str, otp: str) -> bool:
+    """
+    Marks a TOTP as used for the replay window.
+    Codes seen by this worker are rejected from memory, otherwise a single conditional insert decides across workers.
+    Expired rows are deleted by the retention sweeper.
+    :param user_id: the id of the user
+    :param otp: the submitted code
+    :return: True if the code had not been used in the window, False if this is a replay
+    """
+    key = (user_id, otp)
+    if key in _used_totps:
+        return False
+    now = now_timestamp()
+    claimed = query_db(
+        'INSERT INTO used_totp (otp, expiry, user_id) SELECT ?, ?, ? '
+        'WHERE NOT EXISTS (SELECT 1 FROM used_totp WHERE user_id=? AND otp=? AND expiry>=?) RETURNING otp',
+        (otp, now + TOTP_REPLAY_WINDOW, user_id, user_id, otp, now),
+        True
+    ) is not None
+    _used_totps.add(key)
+    return claimed
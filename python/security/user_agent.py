@@ -0,0 +1,43 @@
+from dotenv import load_dotenv
+from functools import lru_cache
+from os import environ
+from user_agents import parse
+import typing as t
+
+try:
+    from ua_parser.user_agent_parser import ParseOS, ParseUserAgent
+except ImportError:
+    ParseOS = ParseUserAgent = None
+
+
+__all__ = [
+    'USER_AGENT_FAST_PATH',
+    'user_agent_fingerprint',
+]
+
+
+load_dotenv()
+
+USER_AGENT_CACHE_SIZE = int(environ.get('USER_AGENT_CACHE_SIZE', '1024'))
+USER_AGENT_FAST_PATH = environ.get('USER_AGENT_FAST_PATH', '1') == '1' and ParseOS is not None
+
+
+def full_families(user_agent: str) -> t.Tuple[str,str]:
+    ua = parse(user_agent)
+    return ua.os.family, ua.browser.family
+
+
+def fast_families(user_agent: str) -> t.Tuple[str,str]:
+    # only the two families of the fingerprint are parsed, the device regexes are skipped
+    return ParseOS(user_agent)['family'], ParseUserAgent(user_agent)['family']
+
+
+@lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
+def user_agent_fingerprint(user_agent: str) -> str:
+    """
+    Reduces a User-Agent header to the operating system and browser, sessions are bound to it
+    :param user_agent: the raw header
+    :return: the fingerprint, e.g. `Windows-Chrome`
+    """
+    os_name, browser_name = (fast_families if USER_AGENT_FAST_PATH else full_families)(user_agent)
+    return f"{(os_name or 'Unknown').replace(' ', '')}-{(browser_name or 'Unknown').replace(' ', '')}"
@@ -0,0 +1,42 @@
+from flask import request, send_file, Blueprint
+from mimetypes import guess_type
+from os.path import exists
+
+from ..database.classes.entry import Entry
+from ..security.login import get_user_id
+
+
+download_blueprint = Blueprint('download', __name__)
+
+
+@download_blueprint.route('/api/v1/entries/<entry_id>/content', methods=['GET', 'HEAD'])
+def r_entry_content(entry_id: str):
+    user_id = get_user_id()
+    if not user_id:
+        return {'error': 'authentication error', 'message': 'Invalid session.'}, 401
+    try:
+        entry = Entry.load(entry_id)
+    except ValueError:
+        return {'error': 'not found', 'message': 'Entry not found.'}, 404
+    if entry.type_ != 'file' or entry.deleted or not entry.hash_ or not entry.can_user_access(user_id):
+        return {'error': 'not found', 'message': 'Entry not found.'}, 404
+    path = entry.get_path()
+    if not exists(path):
+        return {'error': 'not found', 'message': 'Entry content not found.'}, 404
+    # blobs are content-addressed, so the hash is a strong validator and the content never changes
+    response = send_file(
+        path,
+        mimetype=guess_type(entry.name)[0] or 'application/octet-stream',
+        as_attachment=request.args.get('download', '') == '1',
+        download_name=entry.name,
+        conditional=True,
+        etag=entry.hash_,
+        last_modified=entry.edited,
+        max_age=0,
+    )
+    response.headers['Cache-Control'] = 'private, no-cache'
+    # a player seeking through a file sends many range requests, only the one reading from the start counts as a view
+    if request.method == 'GET' and response.status_code in [200, 206] and (request.range is None or request.range.ranges[0][0] == 0):
+        entry.update_viewed()
+        entry.save()
+    return response
@@ -0,0 +1,160 @@
+from click import option
+from os import remove, rmdir, scandir, stat
+from os.path import dirname
+from time import sleep, time
+import typing as t
+
+from ..database.main import query_db, query_db_in
+from ..util.blob import blob_path
+
+
+__all__ = [
+    'gc_init',
+    'iter_blobs',
+    'unreferenced_hashes',
+    'collect_hashes',
+    'collect_garbage',
+]
+
+
+GC_BATCH_SIZE = 500
+GC_MIN_AGE = 60 * 60
+
+
+def iter_blobs(location: str) -> t.Iterator[t.Tuple[str,str,float,int]]:
+    """
+    Lazily walks the content-addressed layout of a drive, skipping the temporary directory
+    :param location: the location of the drive
+    :return: an iterator over the hash, path, modification time and size of each blob
+    """
+    with scandir(location) as level_1:
+        for d1 in level_1:
+            if len(d1.name) != 2 or not d1.is_dir():
+                continue
+            with scandir(d1.path) as level_2:
+                for d2 in level_2:
+                    if len(d2.name) != 2 or not d2.is_dir():
+                        continue
+                    with scandir(d2.path) as level_3:
+                        for blob in level_3:
+                            if blob.is_file():
+                                info = blob.stat()
+                                yield d1.name + d2.name + blob.name, blob.path, info.st_mtime, info.st_size
+
+
+def unreferenced_hashes(drive_id: str, hashes: t.List[str]) -> t.Set[str]:
+    """
+    Finds the hashes which are not used by any entry of a drive, including trashed entries
+    :param drive_id: the id of the drive
+    :param hashes: the candidate hashes
+    :return: the hashes without a reference
+    """
+    if not hashes:
+        return set()
+    referenced = query_db_in(
+        'SELECT DISTINCT entries.hash FROM entries JOIN partitions ON partitions.id=entries.partition_id WHERE partitions.drive_id=? AND entries.hash IN ({})',
+        hashes,
+        (drive_id,)
+    )
+    return set(hashes) - {row[0] for row in referenced}
+
+
+def _stale_blobs(drive_id: str, location: str, hashes: t.List[str], cutoff: float) -> t.Iterator[t.Tuple[str,int]]:
+    """
+    Checks candidates right before they are deleted: the references, then the modification time of each blob just before it is yielded.
+    An upload which re-uses a blob touches it before its entry is saved, so a blob touched since it was listed is kept
+    :param drive_id: the id of the drive
+    :param location: the location of the drive
+    :param hashes: the candidate hashes
+    :param cutoff: blobs modified at or after this unix time are kept
+    :return: an iterator over the path and size of each blob which may be deleted
+    """
+    for hash_ in unreferenced_hashes(drive_id, hashes):
+        path = blob_path(location, hash_)
+        try:
+            info = stat(path)
+        except FileNotFoundError:
+            continue
+        if info.st_mtime < cutoff:
+            yield path, info.st_size
+
+
+def _remove_blob(path: str) -> None:
+    remove(path)
+    for directory in [dirname(path), dirname(dirname(path))]:
+        try:
+            rmdir(directory)
+        except OSError:
+            break
+
+
+def collect_hashes(hashes: t.Iterable[str], min_age: float=GC_MIN_AGE, dry_run: bool=False) -> t.Dict[str,int]:
+    """
+    Deletes the blobs of specific hashes on every drive if nothing references them anymore
+    :param hashes: the hashes which might have been freed
+    :param min_age: blobs written or re-used within this amount of seconds are kept
+    :param dry_run: only report what would be deleted
+    :return: the amount of deleted blobs and reclaimed bytes
+    """
+    report = {'scanned': 0, 'deleted': 0, 'bytes': 0}
+    cutoff = time() - min_age
+    hashes = list(set(hashes))
+    for drive_id, location in query_db('SELECT id, location FROM drives'):
+        for i in range(0, len(hashes), GC_BATCH_SIZE):
+            batch = hashes[i:i + GC_BATCH_SIZE]
+            report['scanned'] += len(batch)
+            for path, size in _stale_blobs(drive_id, location, batch, cutoff):
+                if not dry_run:
+                    _remove_blob(path)
+                report['deleted'] += 1
+                report['bytes'] += size
+    return report
+
+
+def collect_garbage(batch_size: int=GC_BATCH_SIZE, min_age: float=GC_MIN_AGE, pause: float=0.0, dry_run: bool=False) -> t.Dict[str,int]:
+    """
+    Mark-and-sweep over all drives: every blob on disk is checked against the entries in bounded batches
+    :param batch_size: the amount of blobs checked with one query
+    :param min_age: blobs younger than this amount of seconds are kept, as their entry might not be saved yet
+    :param pause: seconds to sleep between two batches, to leave room for the request path
+    :param dry_run: only report what would be deleted
+    :return: the amount of scanned and deleted blobs and reclaimed bytes
+    """
+    report = {'scanned': 0, 'deleted': 0, 'bytes': 0}
+    cutoff = time() - min_age
+    for drive_id, location in query_db('SELECT id, location FROM drives'):
+        batch: t.List[str] = []
+        blobs = iter_blobs(location)
+        while True:
+            for hash_, path, mtime, size in blobs:
+                report['scanned'] += 1
+                if mtime < cutoff:
+                    batch.append(hash_)
+                if len(batch) >= batch_size:
+                    break
+            if not batch:
+                break
+            # the listing is stale by now, an upload may have re-used a blob since
+            for path, size in _stale_blobs(drive_id, location, batch, cutoff):
+                if not dry_run:
+                    _remove_blob(path)
+                report['deleted'] += 1
+                report['bytes'] += size
+            batch = []
+            if pause:
+                sleep(pause)
+    return report
+
+
+def gc_init(app) -> None:
+    @app.cli.command('gc-blobs')
+    @option('--batch-size', default=GC_BATCH_SIZE, show_default=True, help='Blobs checked per query.')
+    @option('--min-age', default=GC_MIN_AGE, show_default=True, help='Keep blobs younger than this many seconds.')
+    @option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+    @option('--dry-run', is_flag=True, help='Only report what would be deleted.')
+    def gc_blobs(batch_size: int, min_age: int, pause: float, dry_run: bool) -> None:
+        """
+        Deletes blobs which are not referenced by any entry
+        """
+        report = collect_garbage(batch_size, min_age, pause, dry_run)
+        print(f"scanned {report['scanned']} blobs, {'would delete' if dry_run else 'deleted'} {report['deleted']} blobs, reclaimed {report['bytes']} bytes")
@@ -0,0 +1,173 @@
+from click import option
+from os import environ
+from time import sleep
+import typing as t
+
+from .gc import collect_hashes, GC_MIN_AGE
+from .upload import delete_upload_rows, discard_upload_file, upload_path
+from ..database.hierarchy import closure_delete
+from ..database.main import query_db, query_db_in, transaction
+from ..database.search import search_remove_entries
+from ..util.logger import GetLogger
+from ..util.misc import now_timestamp
+
+
+__all__ = [
+    'purge_init',
+    'purge_entries',
+    'purge_trash',
+]
+
+
+TRASH_RETENTION = int(environ.get('TRASH_RETENTION_DAYS', '30')) * 24 * 60 * 60
+PURGE_BATCH_SIZE = 500
+
+
+def _empty_report() -> t.Dict[str,int]:
+    return {'roots': 0, 'partitions': 0, 'entries': 0, 'links': 0, 'tag_relations': 0, 'entry_shares': 0, 'uploads': 0, 'blobs': 0, 'bytes': 0}
+
+
+def _delete_uploads(where: str, values: t.List[str]) -> t.List[t.Tuple[str,str]]:
+    # the temporary files are left for _discard_upload_files, which runs after the commit
+    uploads = query_db_in(
+        f'SELECT upload_sessions.id, drives.location FROM upload_sessions JOIN partitions ON partitions.id=upload_sessions.partition_id '
+        f'JOIN drives ON drives.id=partitions.drive_id WHERE {where} IN ({{}})',
+        values
+    )
+    for upload_id, _ in uploads:
+        delete_upload_rows(upload_id)
+    return [(upload_id, upload_path(location, upload_id)) for upload_id, location in uploads]
+
+
+def _discard_upload_files(uploads: t.List[t.Tuple[str,str]]) -> None:
+    for upload_id, path in uploads:
+        discard_upload_file(upload_id, path)
+
+
+def purge_entries(entry_ids: t.List[str], report: t.Dict[str,int], dry_run: bool=False) -> t.Set[str]:
+    """
+    Hard-deletes entries, which must not have children outside the list, in one transaction.
+    Links pointing at them, their tags, shares, search rows, closure rows and unfinished uploads into them go with them.
+    :param entry_ids: the ids of the entries, children before their parents
+    :param report: the counters to add to
+    :param dry_run: only count what would be deleted
+    :return: the hashes of the deleted files
+    """
+    with transaction():
+        purged = set(entry_ids)
+        links = list({row[0] for row in query_db_in('SELECT id FROM entries WHERE target_id IN ({})', entry_ids)} - purged)
+        entry_ids = links + entry_ids
+        report['links'] += len(links)
+        report['entries'] += len(entry_ids)
+        hashes = {row[0] for row in query_db_in("SELECT hash FROM entries WHERE type='file' AND hash IS NOT NULL AND id IN ({})", entry_ids)}
+        if dry_run:
+            report['tag_relations'] += sum(row[0] for row in query_db_in('SELECT COUNT(*) FROM tag_relations WHERE entry_id IN ({})', entry_ids))
+            report['entry_shares'] += sum(row[0] for row in query_db_in('SELECT COUNT(*) FROM entry_shares WHERE entry_id IN ({})', entry_ids))
+            return hashes
+        report['tag_relations'] += len(query_db_in('DELETE FROM tag_relations WHERE entry_id IN ({}) RETURNING id', entry_ids))
+        report['entry_shares'] += len(query_db_in('DELETE FROM entry_shares WHERE entry_id IN ({}) RETURNING id', entry_ids))
+        uploads = _delete_uploads('upload_sessions.parent_id', entry_ids)
+        report['uploads'] += len(uploads)
+        search_remove_entries(entry_ids)
+        closure_delete(entry_ids)
+        # foreign keys are checked per statement, batches keep the children ahead of their parents
+        query_db_in('DELETE FROM entries WHERE id IN ({})', entry_ids)
+    _discard_upload_files(uploads)
+    return hashes
+
+
+def _purge_subtree(root_id: str, report: t.Dict[str,int], batch_size: int, pause: float, dry_run: bool) -> t.Set[str]:
+    # deepest entries first, so every chunk only removes entries whose children are already gone
+    subtree = [row[0] for row in query_db('SELECT descendant_id FROM entry_closure WHERE ancestor_id=? ORDER BY depth DESC', (root_id,))] or [root_id]
+    hashes = set()
+    for i in range(0, len(subtree), batch_size):
+        hashes |= purge_entries(subtree[i:i + batch_size], report, dry_run)
+        if pause:
+            sleep(pause)
+    return hashes
+
+
+def purge_trash(
+        retention: int=TRASH_RETENTION,
+        batch_size: int=PURGE_BATCH_SIZE,
+        pause: float=0.0,
+        dry_run: bool=False,
+        progress: t.Union[t.Callable[[t.Dict[str,int]],None],None]=None,
+) -> t.Dict[str,int]:
+    """
+    Hard-deletes entries and partitions which have been in the trash for longer than the retention, including everything below them,
+    then deletes the blobs nothing references anymore
+    :param retention: seconds an entry stays in the trash
+    :param batch_size: the maximum amount of entries deleted per transaction
+    :param pause: seconds to sleep between two transactions, to leave room for the request path
+    :param dry_run: only report what would be deleted
+    :param progress: called with the counters after every trashed entry or partition
+    :return: the amount of deleted roots, partitions, entries, links, tags, shares, uploads, blobs and reclaimed bytes
+    """
+    report = _empty_report()
+    cutoff = now_timestamp() - retention
+    hashes = set()
+    # in a dry run nothing disappears, entries already counted as part of an earlier subtree are skipped
+    seen = set()
+    last = (-1, '')
+    while True:
+        roots = query_db(
+            'SELECT deleted, id FROM entries WHERE deleted IS NOT NULL AND deleted<? AND (deleted>? OR (deleted=? AND id>?)) ORDER BY deleted, id LIMIT ?',
+            (cutoff, last[0], last[0], last[1], batch_size)
+        )
+        for deleted, root_id in roots:
+            if root_id in seen or not query_db('SELECT id FROM entries WHERE id=?', (root_id,), True):
+                continue
+            before = report['entries']
+            hashes |= _purge_subtree(root_id, report, batch_size, pause, dry_run)
+            report['roots'] += 1
+            if dry_run:
+                seen |= {row[0] for row in query_db('SELECT descendant_id FROM entry_closure WHERE ancestor_id=?', (root_id,))}
+            if progress and report['entries'] > before:
+                progress(report)
+        if len(roots) < batch_size:
+            break
+        last = tuple(roots[-1])
+    for partition_id, in query_db('SELECT id FROM partitions WHERE deleted IS NOT NULL AND deleted<?', (cutoff,)):
+        for root_id, in query_db('SELECT id FROM entries WHERE partition_id=? AND parent_id IS NULL', (partition_id,)):
+            if root_id not in seen:
+                hashes |= _purge_subtree(root_id, report, batch_size, pause, dry_run)
+        if not dry_run:
+            # links into the partition root folder have no target entry
+            links = [row[0] for row in query_db('SELECT id FROM entries WHERE target_partition_id=? AND target_id IS NULL', (partition_id,))]
+            if links:
+                hashes |= purge_entries(links, report)
+            with transaction():
+                uploads = _delete_uploads('upload_sessions.partition_id', [partition_id])
+                report['uploads'] += len(uploads)
+                query_db('DELETE FROM partition_shares WHERE partition_id=?', (partition_id,))
+                query_db('DELETE FROM partition_usage WHERE partition_id=?', (partition_id,))
+                query_db('DELETE FROM partitions WHERE id=?', (partition_id,))
+            _discard_upload_files(uploads)
+        report['partitions'] += 1
+        if progress:
+            progress(report)
+    if hashes:
+        collected = collect_hashes(hashes, GC_MIN_AGE, dry_run)
+        report['blobs'] += collected['deleted']
+        report['bytes'] += collected['bytes']
+    if report['entries'] or report['partitions']:
+        GetLogger('debug').info(f"trash purge{' (dry run)' if dry_run else ''}: {report}")
+    return report
+
+
+def purge_init(app) -> None:
+    @app.cli.command('purge-trash')
+    @option('--retention-days', default=TRASH_RETENTION // (24 * 60 * 60), show_default=True, help='Days an entry stays in the trash.')
+    @option('--batch-size', default=PURGE_BATCH_SIZE, show_default=True, help='Entries deleted per transaction.')
+    @option('--pause', default=0.0, show_default=True, help='Seconds to sleep between transactions.')
+    @option('--dry-run', is_flag=True, help='Only report what would be deleted.')
+    def purge_trash_command(retention_days: int, batch_size: int, pause: float, dry_run: bool) -> None:
+        """
+        Deletes entries and partitions which have been in the trash for longer than the retention
+        """
+        def print_progress(report: t.Dict[str,int]) -> None:
+            print(f"{report['roots']} trashed entries and {report['partitions']} partitions, {report['entries']} entries so far")
+
+        report = purge_trash(retention_days * 24 * 60 * 60, batch_size, pause, dry_run, print_progress)
+        print(', '.join(f"{value} {name}" for name, value in report.items()) + (' would be deleted' if dry_run else ' deleted'))
@@ -0,0 +1,40 @@
+from flask import request, Blueprint
+
+from ..database.classes.entry import Entry
+from ..database.classes.user import User
+from ..database.search import search_entries, MIN_QUERY_LENGTH
+from ..security.login import get_user_id
+
+
+MAX_SEARCH_RESULTS = 100
+
+
+search_blueprint = Blueprint('search', __name__)
+
+
+@search_blueprint.route('/api/v1/search', methods=['GET'])
+def r_search():
+    user_id = get_user_id()
+    if not user_id:
+        return {'error': 'authentication error', 'message': 'Invalid session.'}, 401
+    text = request.args.get('q', '').strip()
+    if len(text) < MIN_QUERY_LENGTH:
+        return {'error': 'Invalid data', 'message': f"The search text must be at least {MIN_QUERY_LENGTH} characters long."}, 400
+    try:
+        limit = min(max(int(request.args.get('limit', '50')), 1), MAX_SEARCH_RESULTS)
+        offset = max(int(request.args.get('offset', '0')), 0)
+    except ValueError:
+        return {'error': 'Invalid data'}, 400
+    partition_ids = [partition.id_ for partition in User.load(user_id).get_accessible_partitions() if not partition.deleted]
+    if request.args.get('partition_id'):
+        if request.args['partition_id'] not in partition_ids:
+            return {'error': 'not found', 'message': 'Partition not found.'}, 404
+        partition_ids = [request.args['partition_id']]
+    # one more result than requested tells if there is a next page
+    entry_ids = search_entries(text, partition_ids, limit + 1, offset)
+    entries = Entry.load_many(entry_ids[:limit])
+    return {
+        'success': 'success',
+        'entries': [entry.to_json() for entry in entries],
+        'next_offset': offset + limit if len(entry_ids) > limit else None,
+    }, 200
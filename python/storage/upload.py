@@ -0,0 +1,375 @@
+from datetime import timedelta
+from flask import request, Blueprint
+from hashlib import sha3_256
+from logging import log
+from os import remove
+from os.path import exists, join
+from pydantic import BaseModel, ValidationError
+from shutil import copyfile
+from threading import Lock
+from time import sleep
+import typing as t
+
+from ..database.classes.drive import Drive
+from ..database.classes.entry import Entry
+from ..database.classes.partition import Partition
+from ..database.classes.user import User
+from ..database.main import query_db, query_db_in, transaction
+from ..database.usage import has_capacity
+from ..security.login import get_user_id
+from ..util.blob import CHUNK_SIZE, commit_blob, iter_blob, temp_dir
+from ..util.misc import format_timestamp, now_timestamp
+from ..util.rand import rand_id
+
+
+DEFAULT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_LIFETIME = timedelta(days=1)
+# a chunk claimed for longer than this is assumed to be abandoned by its writer and may be claimed again
+CHUNK_CLAIM_TIMEOUT = 60 * 60
+
+
+class RUploadData(BaseModel):
+    partition_id: str
+    parent_id: t.Union[str,None] = None
+    name: str
+    size: int
+    chunk_size: int = DEFAULT_UPLOAD_CHUNK_SIZE
+
+
+# running sha3_256 state per upload: the hasher and the index of the next chunk it expects
+_hash_states: t.Dict[str,t.Tuple[t.Any,int]] = {}
+# a state is only read or written while holding the lock of its upload, _hash_lock only guards the dictionaries
+_hash_locks: t.Dict[str,Lock] = {}
+_hash_lock = Lock()
+
+
+def chunk_count(size: int, chunk_size: int) -> int:
+    return (size + chunk_size - 1) // chunk_size
+
+
+def upload_path(location: str, upload_id: str) -> str:
+    return join(temp_dir(location), 'upload-' + sha3_256(upload_id.encode()).hexdigest())
+
+
+def upload_lock(upload_id: str) -> Lock:
+    with _hash_lock:
+        return _hash_locks.setdefault(upload_id, Lock())
+
+
+def drop_hash_state(upload_id: str) -> None:
+    with _hash_lock:
+        _hash_states.pop(upload_id, None)
+        _hash_locks.pop(upload_id, None)
+
+
+def load_upload(upload_id: str, user_id: str) -> t.Union[tuple,None]:
+    db_result = query_db(
+        'SELECT id, user_id, partition_id, parent_id, name, size, chunk_size, created, expires, state FROM upload_sessions WHERE id=?',
+        (upload_id,),
+        True
+    )
+    if not db_result or db_result[1] != user_id or db_result[8] <= now_timestamp() or db_result[9] != 'open':
+        return None
+    return db_result
+
+
+def received_chunks(upload_id: str) -> t.List[int]:
+    return [row[0] for row in query_db('SELECT idx FROM upload_chunks WHERE upload_id=? AND claimed IS NULL ORDER BY idx', (upload_id,))]
+
+
+def advance_hash(upload_id: str, path: str, chunk_size: int) -> None:
+    """
+    Feeds chunks that are already on disk into the running hash as long as they are contiguous
+    :param upload_id: the id of the upload session
+    :param path: the path to the partially written file
+    :param chunk_size: the size of a chunk of this upload
+    :return:
+    """
+    with upload_lock(upload_id):
+        state = _hash_states.get(upload_id)
+        if state is None:
+            return
+        hasher, next_index = state
+        received = set(received_chunks(upload_id))
+        while next_index in received:
+            for data in iter_blob(path, CHUNK_SIZE, next_index * chunk_size, chunk_size):
+                hasher.update(data)
+            next_index += 1
+        _hash_states[upload_id] = (hasher, next_index)
+
+
+def delete_upload_rows(upload_id: str) -> None:
+    with transaction():
+        query_db('DELETE FROM upload_chunks WHERE upload_id=?', (upload_id,))
+        query_db('DELETE FROM upload_sessions WHERE id=?', (upload_id,))
+
+
+def discard_upload_file(upload_id: str, path: str) -> None:
+    # only called once the deletion of the rows is committed, a rollback must not leave sessions without their file
+    drop_hash_state(upload_id)
+    if exists(path):
+        remove(path)
+
+
+def delete_upload(upload_id: str, path: str) -> None:
+    delete_upload_rows(upload_id)
+    discard_upload_file(upload_id, path)
+
+
+def sweep_expired_uploads(batch_size: int=500, pause: float=0.0) -> int:
+    """
+    Deletes the sessions, chunks and temporary files of expired uploads,
+    then forgets the hash states this process holds for uploads which are gone
+    :param batch_size: the amount of uploads deleted per query
+    :param pause: seconds to sleep between batches
+    :return: the amount of deleted uploads
+    """
+    now = now_timestamp()
+    deleted = 0
+    while True:
+        uploads = query_db(
+            'SELECT upload_sessions.id, drives.location FROM upload_sessions JOIN partitions ON partitions.id=upload_sessions.partition_id '
+            'JOIN drives ON drives.id=partitions.drive_id WHERE upload_sessions.expires<? LIMIT ?',
+            (now, batch_size)
+        )
+        for upload_id, location in uploads:
+            delete_upload(upload_id, upload_path(location, upload_id))
+        deleted += len(uploads)
+        if len(uploads) < batch_size:
+            break
+        sleep(pause)
+    with _hash_lock:
+        known = set(_hash_states) | set(_hash_locks)
+    alive = {row[0] for row in query_db_in('SELECT id FROM upload_sessions WHERE expires>=? AND id IN ({})', known, (now,))}
+    for upload_id in known - alive:
+        drop_hash_state(upload_id)
+    return deleted
+
+
+upload_blueprint = Blueprint('upload', __name__)
+
+
+@upload_blueprint.route('/api/v1/uploads', methods=['POST'])
+def r_upload_create():
+    user_id = get_user_id()
+    if not user_id:
+        return {'error': 'authentication error', 'message': 'Invalid session.'}, 401
+    try:
+        data = dict(request.get_json(silent=True))
+    except Exception as e:
+        log(20, e)
+        return {'error': 'Invalid JSON'}, 400
+    try:
+        upload_data = dict(RUploadData(**data))
+    except ValidationError as e:
+        log(20, e.errors())
+        return {'error': 'Invalid data'}, 400
+    if upload_data['size'] < 0 or not 0 < upload_data['chunk_size'] <= MAX_UPLOAD_CHUNK_SIZE or not upload_data['name']:
+        return {'error': 'Invalid data'}, 400
+    try:
+        partition = Partition.load(upload_data['partition_id'])
+    except ValueError:
+        return {'error': 'not found', 'message': 'Partition not found.'}, 404
+    if partition.deleted or not partition.can_user_edit(User.load(user_id)):
+        return {'error': 'not found', 'message': 'Partition not found.'}, 404
+    if upload_data['parent_id']:
+        try:
+            parent = Entry.load(upload_data['parent_id'])
+        except ValueError:
+            return {'error': 'not found', 'message': 'Parent not found.'}, 404
+        if parent.type_ != 'folder' or parent.deleted or parent.partition_id != partition.id_:
+            return {'error': 'not found', 'message': 'Parent not found.'}, 404
+    upload_id = rand_id('upload')
+    now = now_timestamp()
+    # space of unfinished uploads is reserved, so concurrent uploads cannot overcommit the partition
+    with transaction():
+        if not has_capacity(partition.id_, upload_data['size']):
+            return {'error': 'insufficient storage', 'message': 'The partition does not have enough free space.'}, 507
+        query_db(
+            'INSERT INTO upload_sessions (id, user_id, partition_id, parent_id, name, size, chunk_size, created, expires) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                upload_id,
+                user_id,
+                partition.id_,
+                upload_data['parent_id'],
+                upload_data['name'],
+                upload_data['size'],
+                upload_data['chunk_size'],
+                now,
+                now + int(UPLOAD_LIFETIME.total_seconds()),
+            )
+        )
+    with open(upload_path(Drive.get_location_of_partition(partition.id_), upload_id), 'wb') as f:
+        f.truncate(upload_data['size'])
+    with upload_lock(upload_id):
+        _hash_states[upload_id] = (sha3_256(), 0)
+    return {
+        'success': 'success',
+        'upload_id': upload_id,
+        'chunk_size': upload_data['chunk_size'],
+        'chunk_count': chunk_count(upload_data['size'], upload_data['chunk_size']),
+    }, 200
+
+
+@upload_blueprint.route('/api/v1/uploads/<upload_id>', methods=['GET'])
+def r_upload_status(upload_id: str):
+    user_id = get_user_id()
+    if not user_id:
+        return {'error': 'authentication error', 'message': 'Invalid session.'}, 401
+    upload = load_upload(upload_id, user_id)
+    if not upload:
+        return {'error': 'not found', 'message': 'Upload not found.'}, 404
+    received = received_chunks(upload_id)
+    return {
+        'success': 'success',
+        'size': upload[5],
+        'chunk_size': upload[6],
+        'chunk_count': chunk_count(upload[5], upload[6]),
+        'received': received,
+        'offsets': [index * upload[6] for index in received],
+        'expires': format_timestamp(upload[8]),
+    }, 200
+
+
+@upload_blueprint.route('/api/v1/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def r_upload_chunk(upload_id: str, index: int):
+    user_id = get_user_id()
+    if not user_id:
+        return {'error': 'authentication error', 'message': 'Invalid session.'}, 401
+    upload = load_upload(upload_id, user_id)
+    if not upload:
+        return {'error': 'not found', 'message': 'Upload not found.'}, 404
+    size, chunk_size = upload[5], upload[6]
+    if not 0 <= index < chunk_count(size, chunk_size):
+        return {'error': 'Invalid chunk index'}, 400
+    checksum = request.headers.get('X-Chunk-SHA3-256', '').lower()
+    if not checksum:
+        return {'error': 'Missing chunk checksum'}, 400
+    existing = query_db('SELECT hash, claimed FROM upload_chunks WHERE upload_id=? AND idx=?', (upload_id, index), True)
+    if existing and existing[1] is None:
+        if existing[0] != checksum:
+            return {'error': 'conflict', 'message': 'A different chunk has already been received at this index.'}, 409
+        return {'success': 'success', 'index': index}, 200
+    # the index is claimed before anything is written, so no two requests write the same chunk
+    claimed = now_timestamp()
+    if not query_db(
+        'INSERT INTO upload_chunks (upload_id, idx, hash, claimed) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (upload_id, idx) DO UPDATE SET hash=excluded.hash, claimed=excluded.claimed WHERE upload_chunks.claimed<? RETURNING idx',
+        (upload_id, index, checksum, claimed, claimed - CHUNK_CLAIM_TIMEOUT),
+        True
+    ):
+        return {'error': 'conflict', 'message': 'This chunk is being received by another request.'}, 409
+    offset = index * chunk_size
+    expected = min(chunk_size, size - offset)
+    with upload_lock(upload_id):
+        state = _hash_states.get(upload_id)
+        if state is None and index == 0:
+            state = (sha3_256(), 0)
+        running = state[0].copy() if state is not None and state[1] == index else None
+    chunk_hasher = sha3_256()
+    received = 0
+    path = upload_path(Drive.get_location_of_partition(upload[2]), upload_id)
+    try:
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            while received < expected:
+                data = request.stream.read(min(CHUNK_SIZE, expected - received))
+                if not data:
+                    break
+                chunk_hasher.update(data)
+                if running is not None:
+                    running.update(data)
+                f.write(data)
+                received += len(data)
+        error = None
+        if received != expected or request.stream.read(1):
+            error = 'Invalid chunk size'
+        elif chunk_hasher.hexdigest() != checksum:
+            error = 'Invalid chunk checksum'
+    except BaseException:
+        query_db('DELETE FROM upload_chunks WHERE upload_id=? AND idx=? AND claimed=?', (upload_id, index, claimed))
+        raise
+    if error:
+        query_db('DELETE FROM upload_chunks WHERE upload_id=? AND idx=? AND claimed=?', (upload_id, index, claimed))
+        return {'error': error}, 400
+    if not query_db(
+        'UPDATE upload_chunks SET claimed=NULL WHERE upload_id=? AND idx=? AND claimed=? AND hash=? RETURNING idx',
+        (upload_id, index, claimed, checksum),
+        True
+    ):
+        return {'error': 'conflict', 'message': 'This chunk is being received by another request.'}, 409
+    if running is not None:
+        with upload_lock(upload_id):
+            state = _hash_states.get(upload_id)
+            if state is None or state[1] == index:
+                _hash_states[upload_id] = (running, index + 1)
+    advance_hash(upload_id, path, chunk_size)
+    return {'success': 'success', 'index': index}, 200
+
+
+@upload_blueprint.route('/api/v1/uploads/<upload_id>/finalize', methods=['POST'])
+def r_upload_finalize(upload_id: str):
+    user_id = get_user_id()
+    if not user_id:
+        return {'error': 'authentication error', 'message': 'Invalid session.'}, 401
+    upload = load_upload(upload_id, user_id)
+    if not upload:
+        return {'error': 'not found', 'message': 'Upload not found.'}, 404
+    size, chunk_size = upload[5], upload[6]
+    with transaction():
+        received = set(received_chunks(upload_id))
+        missing = [index for index in range(chunk_count(size, chunk_size)) if index not in received]
+        if missing:
+            return {'error': 'incomplete', 'message': 'Not all chunks have been received.', 'missing': missing}, 409
+        # only one request turns the chunks into an entry, chunks are not accepted anymore from here on
+        if not query_db("UPDATE upload_sessions SET state='finalizing' WHERE id=? AND state='open' RETURNING id", (upload_id,), True):
+            return {'error': 'conflict', 'message': 'The upload is already being finalized.'}, 409
+    location = Drive.get_location_of_partition(upload[2])
+    path = upload_path(location, upload_id)
+    blob = None
+    committed = False
+    try:
+        with upload_lock(upload_id):
+            hasher, next_index = _hash_states.pop(upload_id, None) or (sha3_256(), 0)
+        # only the part that has not been hashed while the chunks arrived is read again
+        for data in iter_blob(path, CHUNK_SIZE, next_index * chunk_size):
+            hasher.update(data)
+        hash_ = hasher.hexdigest()
+        entry = Entry(
+            type_='file',
+            name=upload[4],
+            parent_id=upload[3],
+            owner_id=user_id,
+            partition_id=upload[2],
+            size=size,
+            hash_=hash_,
+        )
+        # the blob is in the store before the entry referencing it becomes visible
+        with transaction():
+            blob = commit_blob(location, path, hash_)
+            entry.save()
+            delete_upload_rows(upload_id)
+        committed = True
+        drop_hash_state(upload_id)
+    except BaseException:
+        if not committed:
+            # the temporary file is gone once the blob is committed, a retry needs it back.
+            # it is copied, the blob may be shared with other entries and the temporary file is written to
+            if blob is not None and not exists(path):
+                copyfile(blob, path)
+            query_db("UPDATE upload_sessions SET state='open' WHERE id=?", (upload_id,))
+        raise
+    return {'success': 'success', 'message': 'Successfully uploaded.', 'entry': entry.to_json()}, 200
+
+
+@upload_blueprint.route('/api/v1/uploads/<upload_id>', methods=['DELETE'])
+def r_upload_abort(upload_id: str):
+    user_id = get_user_id()
+    if not user_id:
+        return {'error': 'authentication error', 'message': 'Invalid session.'}, 401
+    upload = load_upload(upload_id, user_id)
+    if not upload:
+        return {'error': 'not found', 'message': 'Upload not found.'}, 404
+    delete_upload(upload_id, upload_path(Drive.get_location_of_partition(upload[2]), upload_id))
+    return {'success': 'success', 'message': 'Upload aborted.'}, 200
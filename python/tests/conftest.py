@@ -0,0 +1,5 @@
+from os.path import abspath, dirname
+import sys
+
+# the modules import each other relative to the python package, so its parent has to be importable
+sys.path.insert(0, dirname(dirname(dirname(abspath(__file__)))))
@@ -0,0 +1,107 @@
+from ast import Assign, Attribute, Call, ClassDef, Constant, FunctionDef, JoinedStr, Name, parse, walk
+from flask import Flask, g
+from glob import glob
+from os.path import dirname, join
+from sqlite3 import connect as sqlite_connect
+import pytest
+import typing as t
+
+from python.database.main import explain_query
+from python.database.migrations import run_migrations
+
+
+PYTHON_ROOT = dirname(dirname(__file__))
+# the modules whose statements run on the request path
+MODULES = ['database/acl.py', 'database/usage.py', 'database/hierarchy.py', *sorted(glob('database/classes/[!_]*.py', root_dir=PYTHON_ROOT))]
+QUERY_FUNCTIONS = {'query_db', 'query_db_in'}
+# maintenance commands walk whole tables by design
+MAINTENANCE_FUNCTIONS = {'reconcile_usage', 'rebuild_closure', 'check_closure', 'rebuild_tag_closure'}
+
+
+def render(node, constants: t.Dict[str,str], class_name: str='') -> t.Union[str,None]:
+    """
+    Resolves the SQL of a query argument from string literals, f-strings, module level constants and class constants like Entry.COLUMNS
+    """
+    if isinstance(node, Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, Name):
+        return constants.get(node.id)
+    if isinstance(node, Attribute):
+        # cls.COLUMNS, self.COLUMNS, Entry.COLUMNS and entry_module.Entry.COLUMNS
+        owner = node.value.attr if isinstance(node.value, Attribute) else getattr(node.value, 'id', '')
+        return constants.get(f'{class_name if owner in ("cls", "self") else owner}.{node.attr}')
+    if isinstance(node, JoinedStr):
+        parts = [value.value if isinstance(value, Constant) else render(value.value, constants, class_name) for value in node.values]
+        return None if None in parts else ''.join(parts)
+    return None
+
+
+def parse_module(module: str):
+    with open(join(PYTHON_ROOT, module), 'r') as f:
+        return parse(f.read())
+
+
+def module_constants(tree) -> t.Dict[str,str]:
+    constants = {}
+    for node in tree.body:
+        prefix = ''
+        body = [node]
+        if isinstance(node, ClassDef):
+            prefix = node.name + '.'
+            body = node.body
+        for item in body:
+            if isinstance(item, Assign) and len(item.targets) == 1 and isinstance(item.targets[0], Name):
+                value = render(item.value, constants)
+                if value is not None:
+                    constants[prefix + item.targets[0].id] = value
+    return constants
+
+
+def module_statements(module: str, class_constants: t.Dict[str,str]) -> t.List[t.Tuple[str,str]]:
+    tree = parse_module(module)
+    constants = {**class_constants, **module_constants(tree)}
+    result = []
+    for scope in walk(tree):
+        if not isinstance(scope, ClassDef) and scope is not tree:
+            continue
+        class_name = scope.name if isinstance(scope, ClassDef) else ''
+        for function in scope.body:
+            if not isinstance(function, FunctionDef) or function.name in MAINTENANCE_FUNCTIONS:
+                continue
+            for node in walk(function):
+                if isinstance(node, Call) and isinstance(node.func, Name) and node.func.id in QUERY_FUNCTIONS and node.args:
+                    query = render(node.args[0], constants, class_name)
+                    assert query is not None, f'{module}:{node.lineno} passes SQL which the test cannot resolve'
+                    if node.func.id == 'query_db_in':
+                        query = query.format('?')
+                    result.append((f'{module}:{node.lineno} {function.name}', query))
+    return result
+
+
+CLASS_CONSTANTS = {key: value for module in MODULES for key, value in module_constants(parse_module(module)).items() if '.' in key}
+STATEMENTS = [statement for module in MODULES for statement in module_statements(module, CLASS_CONSTANTS)]
+
+
+@pytest.fixture(scope='module')
+def app():
+    app = Flask(__name__)
+    with open(join(PYTHON_ROOT, 'database/create.sql'), 'r') as f:
+        create = f.read()
+    conn = sqlite_connect(':memory:')
+    # the same order as database_init
+    run_migrations(conn, create)
+    conn.executescript(create)
+    conn.commit()
+    with app.app_context():
+        g._database = conn
+        yield app
+    conn.close()
+
+
+def test_statements_found():
+    assert {location.split(':')[0] for location, _ in STATEMENTS} == set(MODULES)
+
+
+@pytest.mark.parametrize('location, query', STATEMENTS, ids=[location for location, _ in STATEMENTS])
+def test_no_large_table_scan(app, location, query):
+    assert explain_query(query, (None,) * query.count('?')) == []
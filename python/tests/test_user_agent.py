@@ -0,0 +1,18 @@
+from os.path import dirname, join
+import pytest
+
+from python.security.user_agent import fast_families, full_families, user_agent_fingerprint
+
+
+with open(join(dirname(__file__), 'user_agents.txt'), 'r') as _f:
+    CORPUS = [line.rstrip('\n') for line in _f if line.strip()] + ['']
+
+
+@pytest.mark.parametrize('user_agent', CORPUS)
+def test_fast_path_matches_full_parse(user_agent):
+    assert fast_families(user_agent) == full_families(user_agent)
+
+
+def test_fingerprint():
+    assert user_agent_fingerprint(CORPUS[0]) == 'Windows-Chrome'
+    assert user_agent_fingerprint('') == 'Other-Other'
@@ -0,0 +1,190 @@
+from errno import EXDEV
+from hashlib import sha3_256
+from os import close, fdopen, makedirs, remove, replace, utime
+from os.path import dirname, exists, join
+from shutil import copyfile
+from tempfile import mkstemp
+import typing as t
+
+
+__all__ = [
+    'CHUNK_SIZE',
+    'blob_path',
+    'temp_dir',
+    'iter_chunks',
+    'iter_blob',
+    'commit_blob',
+    'store_stream',
+    'hash_file',
+    'move_into_store',
+]
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def blob_path(location: str, hash_: str) -> str:
+    """
+    Builds the path of a blob inside the content-addressed layout of a drive
+    :param location: the location of the drive
+    :param hash_: the sha3_256 hex digest of the content
+    :return: the path to the blob
+    """
+    return join(location, hash_[:2], hash_[2:4], hash_[4:])
+
+
+def temp_dir(location: str) -> str:
+    """
+    Gets the directory for partially written blobs of a drive, on the same filesystem as the blobs themselves
+    :param location: the location of the drive
+    :return: the path to the directory
+    """
+    path = join(location, 'tmp')
+    makedirs(path, exist_ok=True)
+    return path
+
+
+def iter_chunks(source: t.Union[t.BinaryIO,t.Iterable[bytes]], chunk_size: int=CHUNK_SIZE) -> t.Iterator[bytes]:
+    """
+    Iterates over the content of a file-like object or an iterable of bytes
+    :param source: a file-like object with a read method or an iterable of bytes
+    :param chunk_size: the amount of bytes read at once from a file-like object
+    :return: an iterator over non-empty chunks
+    """
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in source:
+            if chunk:
+                yield chunk
+
+
+def iter_blob(path: str, chunk_size: int=CHUNK_SIZE, start: int=0, length: t.Union[int,None]=None) -> t.Iterator[bytes]:
+    """
+    Reads a blob chunk by chunk
+    :param path: the path to the blob
+    :param chunk_size: the maximum size of a chunk
+    :param start: the offset of the first byte
+    :param length: the amount of bytes to read, None to read until the end
+    :return: an iterator over the chunks
+    """
+    with open(path, 'rb') as f:
+        if start:
+            f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def commit_blob(location: str, tmp_path: str, hash_: str) -> str:
+    """
+    Atomically moves a fully written temporary file into the content-addressed layout of a drive
+    :param location: the location of the drive
+    :param tmp_path: the path to the temporary file, which has to be on the same filesystem
+    :param hash_: the sha3_256 hex digest of the content
+    :return: the path to the blob
+    """
+    dest_path = blob_path(location, hash_)
+    # the garbage collector must treat the blob as new until the hash is referenced.
+    # an existing blob is touched before the temporary file is removed, so one collected in between is written again
+    try:
+        utime(dest_path)
+    except FileNotFoundError:
+        makedirs(dirname(dest_path), exist_ok=True)
+        replace(tmp_path, dest_path)
+        # a moved file keeps its old modification time
+        utime(dest_path)
+    else:
+        remove(tmp_path)
+    return dest_path
+
+
+def store_stream(
+        location: str,
+        source: t.Union[t.BinaryIO,t.Iterable[bytes]],
+        chunk_size: int=CHUNK_SIZE,
+        max_size: t.Union[int,None]=None,
+) -> t.Tuple[str,int]:
+    """
+    Writes content into a drive while hashing it, without holding more than one chunk in memory
+    :param location: the location of the drive
+    :param source: a file-like object with a read method or an iterable of bytes
+    :param chunk_size: the amount of bytes read at once from a file-like object
+    :param max_size: the maximum size of the content, None for no limit
+    :return: the sha3_256 hex digest and the size of the content
+    :raises ValueError: if the content is larger than max_size, nothing beyond the limit is written
+    """
+    hasher = sha3_256()
+    size = 0
+    fd, tmp_path = mkstemp(dir=temp_dir(location))
+    try:
+        with fdopen(fd, 'wb') as f:
+            for chunk in iter_chunks(source, chunk_size):
+                if max_size is not None and size + len(chunk) > max_size:
+                    raise ValueError('The partition does not have enough free space')
+                hasher.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        hash_ = hasher.hexdigest()
+        commit_blob(location, tmp_path, hash_)
+    except BaseException:
+        if exists(tmp_path):
+            remove(tmp_path)
+        raise
+    return hash_, size
+
+
+def hash_file(path: str, chunk_size: int=CHUNK_SIZE) -> t.Tuple[str,int]:
+    """
+    Hashes a file in-process, reusing a single read buffer
+    :param path: the path to the file
+    :param chunk_size: the size of the read buffer
+    :return: the sha3_256 hex digest and the size of the file
+    """
+    hasher = sha3_256()
+    size = 0
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(view[:n])
+            size += n
+    return hasher.hexdigest(), size
+
+
+def move_into_store(location: str, path: str, hash_: str) -> str:
+    """
+    Moves an existing file into the content-addressed layout of a drive, copying it if it lives on another filesystem
+    :param location: the location of the drive
+    :param path: the path to the file, which is removed afterwards
+    :param hash_: the sha3_256 hex digest of the content
+    :return: the path to the blob
+    """
+    try:
+        return commit_blob(location, path, hash_)
+    except OSError as e:
+        if e.errno != EXDEV:
+            raise
+    fd, tmp_path = mkstemp(dir=temp_dir(location))
+    close(fd)
+    try:
+        copyfile(path, tmp_path)
+        dest_path = commit_blob(location, tmp_path, hash_)
+    except BaseException:
+        if exists(tmp_path):
+            remove(tmp_path)
+        raise
+    remove(path)
+    return dest_path
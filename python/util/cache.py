@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+import typing as t
+
+
+__all__ = [
+    'LRUCache',
+]
+
+
+_MISSING = object()
+
+
+class LRUCache:
+
+    def __init__(self, max_size: int, ttl: t.Union[float,None]=None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: t.Hashable, default: t.Any=None) -> t.Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and (item[1] is None or item[1] > monotonic()):
+                self._data.move_to_end(key)
+                self._hits += 1
+                return item[0]
+            if item is not _MISSING:
+                del self._data[key]
+            self._misses += 1
+            return default
+
+    def put(self, key: t.Hashable, value: t.Any, ttl: t.Union[float,None]=None) -> None:
+        if ttl is None:
+            ttl = self._ttl
+        elif self._ttl is not None:
+            ttl = min(ttl, self._ttl)
+        with self._lock:
+            self._data[key] = (value, None if ttl is None else monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: t.Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / total if total else 0.0,
+                'size': len(self._data),
+                'max_size': self._max_size,
+            }
@@ -1,12 +1,64 @@
+from datetime import datetime
 from dotenv import load_dotenv
 from os import environ
+from time import time
+import typing as t
 
 
 __all__ = [
     'DATE_FORMAT',
     'DEVELOPMENT',
+    'to_timestamp',
+    'from_timestamp',
+    'format_timestamp',
+    'now_timestamp',
 ]
 
 load_dotenv()
 DATE_FORMAT = '%Y-%m-%d_%H-%M-%S'
 DEVELOPMENT = environ.get('ENVIRONMENT', '') == 'dev'
+
+
+def to_timestamp(value: t.Union[datetime,str,int,None]) -> t.Union[int,None]:
+    """
+    Converts a point in time to unix seconds, as stored in the database
+    :param value: a datetime, a string in DATE_FORMAT, unix seconds or None
+    :return: the unix seconds or None
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    if isinstance(value, str):
+        if value.isdigit():
+            return int(value)
+        return int(datetime.strptime(value, DATE_FORMAT).timestamp())
+    return int(value)
+
+
+def from_timestamp(value: int) -> datetime:
+    """
+    Converts unix seconds from the database to a local datetime
+    :param value: the unix seconds
+    :return: the datetime
+    """
+    return datetime.fromtimestamp(value)
+
+
+def format_timestamp(value: t.Union[int,None]) -> t.Union[str,None]:
+    """
+    Formats unix seconds from the database in DATE_FORMAT, as used by the API
+    :param value: the unix seconds or None
+    :return: the formatted string or None
+    """
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value).strftime(DATE_FORMAT)
+
+
+def now_timestamp() -> int:
+    """
+    Gets the current time in unix seconds
+    :return: the unix seconds
+    """
+    return int(time())
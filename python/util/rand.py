@@ -1,26 +1,51 @@
 from base64 import urlsafe_b64encode
-from datetime import datetime
 from os import urandom
+import typing as t
 
 from ..database.main import query_db
-from .misc import DATE_FORMAT
-
-
-def rand_base64(digits: int) -> str:
+from .misc import now_timestamp
+
+
+# the table whose primary key holds the ids of each class once they are saved
+ID_TABLES = {
+    'drive': 'drives',
+    'partition': 'partitions',
+    'entry': 'entries',
+    'user': 'users',
+    'tag': 'tags',
+    'tag_relation': 'tag_relations',
+    'tag_tag_relation': 'tag_tag_relations',
+    'upload': 'upload_sessions',
+}
+
+
+def claim_id(n: str, table: t.Union[str,None]=None) -> bool:
+    """
+    Registers an id as used, in a single atomic round trip
+    :param n: the candidate id
+    :param table: the table the id will be saved in, its primary key keeps the id unique after the reservation is pruned
+    :return: True if the id was free and is now taken, False if it was already used
+    """
+    if table is None:
+        return query_db('INSERT INTO used_ids VALUES (?, ?, NULL) ON CONFLICT DO NOTHING RETURNING id', (n, now_timestamp()), True) is not None
+    return query_db(
+        f'INSERT INTO used_ids SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE id=?) ON CONFLICT DO NOTHING RETURNING id',
+        (n, now_timestamp(), table, n),
+        True
+    ) is not None
+
+
+def rand_base64(digits: int, table: t.Union[str,None]=None) -> str:
     while True:
         n = urlsafe_b64encode(urandom(digits)).decode()[:digits]
-        result = query_db('SELECT * FROM used_ids WHERE id=?', (n,), True)
-        if not result:
-            query_db('INSERT INTO used_ids VALUES (?, ?)', (n, datetime.now().strftime(DATE_FORMAT)))
+        if claim_id(n, table):
             return n
 
 
 def rand_base16(digits: int) -> str:
     while True:
         n = urandom(digits).hex()[:digits]
-        result = query_db('SELECT * FROM used_ids WHERE id=?', (n,), True)
-        if not result:
-            query_db('INSERT INTO used_ids VALUES (?, ?)', (n, datetime.now().strftime(DATE_FORMAT)))
+        if claim_id(n):
             return n
 
 
@@ -31,7 +56,6 @@ def rand_salt() -> str:
 def rand_id(class_: str, digits: int=16) -> str:
     while True:
         n = f"{class_}#{urlsafe_b64encode(urandom(digits)).decode()[:digits]}"
-        result = query_db('SELECT * FROM used_ids WHERE id=?', (n,), True)
-        if not result:
-            query_db('INSERT INTO used_ids VALUES (?, ?)', (n, datetime.now().strftime(DATE_FORMAT)))
+        if claim_id(n, ID_TABLES.get(class_)):
             return n
+
@@ -0,0 +1,116 @@
+from flask import request, Response
+from gzip import compress as gzip_compress
+from hashlib import sha256
+from mimetypes import guess_type
+from os import walk
+from os.path import isdir, join, relpath
+from re import compile as re_compile
+import typing as t
+
+try:
+    from brotli import compress as brotli_compress
+except ImportError:
+    brotli_compress = None
+
+
+__all__ = [
+    'StaticManifest',
+]
+
+
+# esbuild names bundles like main-ABCD1234.js, the older webpack builder like main.0123456789abcdef.js
+HASHED_NAME = re_compile(r'(-[0-9A-Z]{8}|\.[0-9a-f]{16,})\.[0-9a-z]+$')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'application/xml', 'application/manifest+json')
+# smaller files do not get shorter by compression
+MIN_COMPRESS_SIZE = 1024
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+class StaticAsset:
+    __slots__ = ('mimetype', 'cache_control', 'variants')
+
+    def __init__(self, mimetype: str, cache_control: str, variants: t.Dict[str,t.Tuple[bytes,str]]):
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        # content encoding ('identity', 'br', 'gzip') -> (body, quoted etag)
+        self.variants = variants
+
+
+class StaticManifest:
+
+    def __init__(self, directory: str, index: str='index.html'):
+        self._directory = directory
+        self._index = index
+        self._assets: t.Dict[str,StaticAsset] = {}
+        self.build()
+
+    def build(self) -> None:
+        """
+        Reads every file of the directory into memory, along with its compressed variants
+        :return:
+        """
+        assets = {}
+        if isdir(self._directory):
+            files = {
+                relpath(join(root, name), self._directory).replace('\\', '/'): join(root, name)
+                for root, _, names in walk(self._directory)
+                for name in names
+            }
+            for name, path in files.items():
+                if any(name.endswith(suffix) and name[:-len(suffix)] in files for _, suffix in ENCODINGS):
+                    continue
+                assets[name] = self._load(name, path, files)
+        self._assets = assets
+
+    @staticmethod
+    def _load(name: str, path: str, files: t.Dict[str,str]) -> StaticAsset:
+        with open(path, 'rb') as f:
+            body = f.read()
+        mimetype = guess_type(name)[0] or 'application/octet-stream'
+        digest = sha256(body).hexdigest()[:32]
+        variants = {'identity': (body, f'"{digest}"')}
+        for encoding, suffix in ENCODINGS:
+            if name + suffix in files:
+                with open(files[name + suffix], 'rb') as f:
+                    compressed = f.read()
+            elif len(body) >= MIN_COMPRESS_SIZE and mimetype.startswith(COMPRESSIBLE_TYPES):
+                if encoding == 'br':
+                    if brotli_compress is None:
+                        continue
+                    compressed = brotli_compress(body)
+                else:
+                    compressed = gzip_compress(body, 9, mtime=0)
+            else:
+                continue
+            if len(compressed) < len(body):
+                variants[encoding] = (compressed, f'"{digest}-{encoding}"')
+        cache_control = IMMUTABLE_CACHE_CONTROL if HASHED_NAME.search(name) else REVALIDATE_CACHE_CONTROL
+        return StaticAsset(mimetype, cache_control, variants)
+
+    def response(self, path: str) -> Response:
+        """
+        Serves a file of the manifest, paths which are not files get the index of the single page application
+        :param path: the path of the request
+        :return: the response
+        """
+        asset = self._assets.get(path.lstrip('/')) or self._assets.get(self._index)
+        if asset is None:
+            return Response('Not found', 404, mimetype='text/plain')
+        encoding = 'identity'
+        for candidate, _ in ENCODINGS:
+            if candidate in asset.variants and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        body, etag = asset.variants[encoding]
+        headers = {'ETag': etag, 'Cache-Control': asset.cache_control, 'Vary': 'Accept-Encoding'}
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        if_none_match = request.headers.get('If-None-Match', '')
+        if if_none_match:
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            if '*' in tags or etag in tags:
+                return Response(status=304, headers=headers)
+        return Response(body, 200, headers=headers, mimetype=asset.mimetype)
+